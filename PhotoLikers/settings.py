@@ -149,7 +149,15 @@ CACHES = {
     'default': {
         'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
         'LOCATION': 'unique-snowflake',
-    }
+    },
+    # списки фото по тегам: без истечения и без случайного вытеснения,
+    # объем ограничивается бюджетом photo_likers.settings.INDEX_MEMORY_BUDGET_BYTES
+    'photo_index': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+        'LOCATION': 'photo-index',
+        'TIMEOUT': None,
+        'OPTIONS': {'MAX_ENTRIES': 1000000},
+    },
 }
 
 LOGIN_URL = 'photo_likers:login'
\ No newline at end of file
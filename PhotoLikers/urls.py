@@ -15,11 +15,8 @@ Including another URLconf
 """
 from django.conf.urls import include, url
 from django.contrib import admin
-from photo_likers.loading_startup_cache import load_start_cache
 
 urlpatterns = [
     url(r'^', include('photo_likers.urls')),
     url(r'^admin/', admin.site.urls),
 ]
-
-load_start_cache()
\ No newline at end of file
@@ -12,5 +12,7 @@ import os
 from django.core.wsgi import get_wsgi_application
 
 os.environ.setdefault("DJANGO_SETTINGS_MODULE", "PhotoLikers.settings")
+# процессы wsgi-сервера обслуживают запросы и запускают индекс (см. PhotoLikersConfig.ready)
+os.environ.setdefault("PHOTO_LIKERS_START_INDEX", "1")
 
 application = get_wsgi_application()
@@ -1,5 +1,26 @@
+import os
+import sys
 from django.apps import AppConfig
+from photo_likers.settings import INDEX_STARTUP_ENV_VAR
+
+
+def is_index_startup_enabled(argv, environ) -> bool:
+    """Запуск индекса включен явно: переменной окружения INDEX_STARTUP_ENV_VAR (выставляется в wsgi.py)
+        или командой runserver (кроме наблюдающего процесса автоперезагрузки).
+        Остальные процессы (команды manage.py, тесты, shell) индекс не запускают"""
+    if environ.get(INDEX_STARTUP_ENV_VAR) == '1':
+        return True
+    if len(argv) < 2 or os.path.basename(argv[0]) != 'manage.py' or argv[1] != 'runserver':
+        return False
+    return environ.get('RUN_MAIN') == 'true' or '--noreload' in argv
 
 
 class PhotoLikersConfig(AppConfig):
     name = 'photo_likers'
+
+    def ready(self):
+        from photo_likers import signals  # noqa: F401
+        if is_index_startup_enabled(sys.argv, os.environ):
+            # подсистема индекса импортируется и запускается только там, где обслуживаются запросы
+            from photo_likers.loading_startup_cache import load_start_cache
+            load_start_cache()
@@ -0,0 +1,209 @@
+import pickle
+import random
+import resource
+import statistics
+import time
+import tracemalloc
+from collections import namedtuple
+from datetime import datetime, date, timedelta
+from photo_likers.photo_caches import SortedPhotoLikeCache
+from photo_likers.settings import PHOTOS_PER_PAGE
+from photo_likers.utils.compressed_posting_list import CompressedPostingList
+from photo_likers.utils.sorted_list_searcher import SortedListSearcher
+from photo_likers.utils.sorted_list_utils import sorted_list_merge
+
+BenchmarkPhoto = namedtuple('BenchmarkPhoto', ['id', 'likes_cnt', 'created_date'])
+BenchmarkTag = namedtuple('BenchmarkTag', ['id'])
+MIN_HASH = (-1, -1)
+
+
+class SyntheticIndex:
+    """Синтетические упорядоченные списки фото по тегам без БД.
+
+       Каждое фото получает каждый тег с вероятностью density,
+       лайки равномерные от 0 до max_likes.
+    """
+
+    def __init__(self, cnt_photos: int, cnt_tags: int, density: float, max_likes: int = 1000, seed: int = 0):
+        self.cnt_photos = cnt_photos
+        self.cnt_tags = cnt_tags
+        self.density = density
+        random_gen = random.Random(seed)
+        self.photos = [BenchmarkPhoto(id=photo_id, likes_cnt=random_gen.randint(0, max_likes),
+                                      created_date=date.today() - timedelta(days=random_gen.randint(1, 1000)))
+                       for photo_id in range(1, cnt_photos + 1)]
+        self.tag_photos = [[photo for photo in self.photos if random_gen.random() < density]
+                           for _ in range(cnt_tags)]  # type: list[list[BenchmarkPhoto]]
+        self.all_photos_list = self.get_sorted_list(self.photos)
+        self.tag_lists = [self.get_sorted_list(photos) for photos in self.tag_photos]
+
+    @staticmethod
+    def get_sorted_list(photos):
+        res = sorted(((photo.likes_cnt, photo.id) for photo in photos), reverse=True)
+        res.append(MIN_HASH)
+        return res
+
+    def get_lists(self, cnt_include_tags: int, cnt_exclude_tags: int = 0):
+        """Списки и индикаторы включения для запроса по первым тегам
+            (без включающих тегов первым идет список всех фото)"""
+        sorted_lists = self.tag_lists[:cnt_include_tags]
+        if len(sorted_lists) == 0:
+            sorted_lists = [self.all_photos_list]
+        inclusion_indicators = [True] * len(sorted_lists)
+        sorted_lists = sorted_lists + self.tag_lists[cnt_include_tags:cnt_include_tags + cnt_exclude_tags]
+        inclusion_indicators += [False] * (len(sorted_lists) - len(inclusion_indicators))
+        return sorted_lists, inclusion_indicators
+
+
+def measure(func, repeat: int):
+    """:return: dict с минимальным и медианным временем выполнения (сек.) и результатом последнего запуска"""
+    timings = []
+    res = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        res = func()
+        timings.append(time.perf_counter() - start)
+    return {'min_seconds': min(timings), 'median_seconds': statistics.median(timings), 'result': res}
+
+
+def benchmark_merge(index: SyntheticIndex, tag_counts, repeat: int):
+    results = []
+    for cnt_tags in tag_counts:
+        sorted_lists, inclusion_indicators = index.get_lists(cnt_tags)
+        timing = measure(lambda: sum(1 for _ in sorted_list_merge(sorted_lists, inclusion_indicators)), repeat)
+        scanned = sum(len(sorted_list) for sorted_list in sorted_lists)
+        results.append({'name': 'sorted_list_merge', 'tags': cnt_tags, 'found': timing.pop('result'),
+                        'elements_per_second': scanned / max(timing['min_seconds'], 1e-9), **timing})
+
+        compressed_lists = [CompressedPostingList.from_sorted(sorted_list) for sorted_list in sorted_lists]
+        timing = measure(lambda: sum(1 for _ in sorted_list_merge(compressed_lists, inclusion_indicators)), repeat)
+        results.append({'name': 'sorted_list_merge_compressed', 'tags': cnt_tags, 'found': timing.pop('result'),
+                        'elements_per_second': scanned / max(timing['min_seconds'], 1e-9),
+                        'pickled_bytes': sum(len(pickle.dumps(x)) for x in compressed_lists),
+                        'uncompressed_pickled_bytes': sum(len(pickle.dumps(x)) for x in sorted_lists), **timing})
+    return results
+
+
+def benchmark_search(index: SyntheticIndex, tag_counts, page_numbers, repeat: int, searcher_class=SortedListSearcher,
+                     page_step: int = 50):
+    """Холодный поиск (с расчетом числа страниц и отметок) и
+        теплый поиск страниц на разной глубине по сохраненной информации"""
+    results = []
+    for cnt_tags in tag_counts:
+        sorted_lists, inclusion_indicators = index.get_lists(cnt_tags)
+        searcher = searcher_class(sorted_lists=sorted_lists, inclusion_indicators=inclusion_indicators,
+                                  page_step=page_step)
+        cold = measure(lambda: searcher.search_page(page_number=1, compute_search_info=True), repeat)
+        _, search_info = cold.pop('result')
+        results.append({'name': 'search_cold', 'tags': cnt_tags, 'num_pages': search_info.num_pages, **cold})
+        for page_number in page_numbers:
+            if page_number > search_info.num_pages:
+                continue
+            warm = measure(lambda: searcher.search_page(page_number=page_number, search_info=search_info), repeat)
+            warm.pop('result')
+            results.append({'name': 'search_warm', 'tags': cnt_tags, 'page': page_number, **warm})
+    return results
+
+
+def benchmark_load_tag_cache(index: SyntheticIndex, repeat: int):
+    """Построение кэша тега (сортировка хэшей и запись в кэш django)"""
+    photo_cache = SortedPhotoLikeCache()
+    tag = BenchmarkTag(id=0)
+    timing = measure(lambda: photo_cache.load_one_tag_cache(tag=tag, tag_photos=index.photos,
+                                                            snapshot_date=datetime.now()), repeat)
+    timing.pop('result')
+    return [{'name': 'load_one_tag_cache', 'photos': index.cnt_photos, **timing}]
+
+
+def measure_index_memory(cnt_photos: int, cnt_tags: int, density: float, seed: int = 0):
+    """Память под упорядоченные списки тегов (байт) и пиковая память процесса"""
+    tracemalloc.start()
+    index = SyntheticIndex(cnt_photos=cnt_photos, cnt_tags=cnt_tags, density=density, seed=seed)
+    before_lists = tracemalloc.get_traced_memory()[0]
+    index.tag_photos = None
+    index.photos = None
+    lists_bytes = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    return {'name': 'memory', 'index_bytes': lists_bytes, 'index_with_photos_bytes': before_lists,
+            'max_rss_kilobytes': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss}
+
+
+def replay_slow_queries(entries, searcher_classes, repeat: int, tags, page_step: int = 50):
+    """Воспроизведение записей журнала медленных запросов на текущем индексе
+        для сравнения реализаций поиска. Поиск повторяется в том же режиме,
+        что и записанный: с расчетом числа страниц или по сохраненной информации.
+        Условие "лайкнуто мной" воспроизводится по лайкам записанного пользователя.
+        Записи, которые нельзя разобрать на текущих тегах (тег удален, нет пользователя
+        для условия "лайкнуто мной"), пропускаются и перечисляются в 'skipped'
+
+    :param entries: iterable[dict] записи SlowQueryLog
+    :param searcher_classes: list классов поиска
+    :param tags: все теги (для разбора условий запроса)
+    """
+    from photo_likers.cache_manager import CacheManager
+    from photo_likers.page_searcher import PageSearcher
+    from photo_likers.utils.photo_request import PhotosRequest
+    from photo_likers.utils.range_filter import RangeFilter
+
+    tags = list(tags)
+    results = []
+    skipped = []
+    totals = {searcher_class.__name__: 0.0 for searcher_class in searcher_classes}
+    for entry in entries:
+        try:
+            photo_request = PhotosRequest(page_number=str(entry['page']), sort_field=str(entry['sort']),
+                                          tags_conditions=";".join(entry['tags']), tags=tags,
+                                          user_id=entry.get('user'))
+        except KeyError as e:
+            skipped.append({'sort': entry['sort'], 'tags': entry['tags'], 'page': entry['page'],
+                            'reason': "unknown tag {0}".format(e.args[0])})
+            continue
+        photo_request.range_filters = [RangeFilter.from_key(key) for key in entry.get('ranges', [])]
+        ordered_conditions = PageSearcher.order_tag_conditions(photo_request)
+        page_searcher = PageSearcher(CacheManager.get_sorted_photo_cache(photo_request))
+        sorted_lists = page_searcher.load_ordered_photo_lists(ordered_conditions)
+        inclusion_indicators = [condition.inclusive for condition in ordered_conditions]
+        bounds = PageSearcher.get_sort_field_bounds(photo_request, sorted_lists[0])
+        res = {'sort': entry['sort'], 'tags': entry['tags'], 'ranges': entry.get('ranges', []), 'page': entry['page'],
+               'search_cached': entry.get('search_cached', False), 'recorded_seconds': entry.get('seconds'),
+               'plan': PageSearcher.get_plan(ordered_conditions, sorted_lists),
+               'searchers': {}}
+        for searcher_class in searcher_classes:
+            searcher = searcher_class(sorted_lists=sorted_lists, inclusion_indicators=inclusion_indicators,
+                                      page_step=page_step, bounds=bounds)
+            if res['search_cached']:
+                _, search_info = searcher.search_page(page_number=1, compute_search_info=True)
+                timing = measure(lambda: searcher.search_page(page_number=entry['page'], search_info=search_info),
+                                 repeat)
+            else:
+                timing = measure(lambda: searcher.search_page(page_number=entry['page'], compute_search_info=True),
+                                 repeat)
+            _, search_info = timing.pop('result')
+            timing['num_pages'] = search_info.num_pages
+            res['searchers'][searcher_class.__name__] = timing
+            totals[searcher_class.__name__] += timing['min_seconds']
+        results.append(res)
+    return {'config': {'repeat': repeat,
+                       'searchers': [cls.__module__ + '.' + cls.__name__ for cls in searcher_classes]},
+            'totals_min_seconds': totals,
+            'results': results,
+            'skipped': skipped}
+
+
+def run_benchmarks(cnt_photos: int, cnt_tags: int, density: float, seed: int = 0, repeat: int = 3,
+                   tag_counts=(0, 1, 2, 3), page_numbers=(1, 10, 100, 1000), searcher_class=SortedListSearcher):
+    """Запуск всех замеров
+
+    :return: dict для сохранения в JSON
+    """
+    index = SyntheticIndex(cnt_photos=cnt_photos, cnt_tags=cnt_tags, density=density, seed=seed)
+    tag_counts = [cnt for cnt in tag_counts if cnt <= cnt_tags]
+    results = benchmark_merge(index, tag_counts, repeat)
+    results += benchmark_search(index, tag_counts, page_numbers, repeat, searcher_class=searcher_class)
+    results += benchmark_load_tag_cache(index, repeat)
+    del index
+    results.append(measure_index_memory(cnt_photos, cnt_tags, density, seed))
+    return {'config': {'photos': cnt_photos, 'tags': cnt_tags, 'density': density, 'seed': seed, 'repeat': repeat,
+                       'photos_per_page': PHOTOS_PER_PAGE,
+                       'searcher': searcher_class.__module__ + '.' + searcher_class.__name__},
+            'results': results}
@@ -1,51 +1,287 @@
+import threading
+from collections import Counter
 from datetime import datetime
 from django.core.cache import cache
-from photo_likers.models import Tag
+from django.db.models import Max
+from photo_likers.likes_leaderboard import LikesLeaderboard
+from photo_likers.metrics import metrics
+from photo_likers.models import Tag, Photo, PhotoLikes
 from photo_likers.photo_caches import SortedPhotoCacheBase, SortedPhotoLikeCache, SortedPhotoDateCache
+from photo_likers.settings import SEARCH_CACHE_TEMPLATE_KEY
+from photo_likers.user_likes_index import user_likes_index
 from photo_likers.utils.dummy_tag import DummyTag
 from photo_likers.utils.photo_request import SortType, PhotosRequest
 from photo_likers.utils.sorted_list_searcher import SearchRequestInfo
+from photo_likers.utils.tag_condition import TagCondition, TagOrGroup
 
 
 class CacheManager:
     """Класс менеджер для изменения и получения кэшей"""
     CACHE_TYPES = {SortType.likes: SortedPhotoLikeCache(),
                    SortType.dates: SortedPhotoDateCache()}  # type: dict[SortType,SortedPhotoCacheBase]
+    # живой рейтинг по лайкам для страниц без условий на теги
+    LIKES_LEADERBOARD = LikesLeaderboard()
     SEARCH_CACHES_SECONDS_TIMEOUT = 600
     # с каким шагом запоминать отметки (указатели в упорядоченных списках)
     # для ускорения поиска по кэшируемым запросам
     SEARCH_CACHES_MEMORY_PAGE_STEP = 50
+    # версии списков (вид сортировки, id тега): изменение лайков увеличивает версию измененного списка
+    # до и после изменения (нечетная - список меняется). Версии списков запроса входят в ключ
+    # сохраненного поиска, чтобы не использовать отметки, указывающие в старые списки
+    LIST_VERSIONS = Counter()  # type: Counter[tuple[int, int]]
     NUM_PAGES_KEY = 'num_pages'
     CHECKPOINTS_KEY = 'checkpoints'
+    # публикация версии индекса и изменения лайков не выполняются одновременно
+    INDEX_VERSION_LOCK = threading.RLock()
+    __reload_lock = threading.Lock()
+    # изменения лайков за время построения новой версии индекса (None - версия не строится)
+    __pending_likes_changes = None  # type: list[dict[int, tuple[int, int]]]
+    # время начала построения опубликованной версии индекса (или создания ее снимка)
+    INDEX_CREATED = None  # type: datetime
+    # наибольшие id фото и лайка в БД к началу построения опубликованной версии (см. get_high_water_mark):
+    # все, что добавлено позже, в снимке индекса может отсутствовать
+    INDEX_HIGH_WATER_MARK = None  # type: dict[str, int]
 
     @staticmethod
-    def get_sorted_photo_cache(photo_request: PhotosRequest):
-        return CacheManager.CACHE_TYPES[photo_request.sort_field]
+    def get_sorted_photo_cache(photo_request: PhotosRequest) -> SortedPhotoCacheBase:
+        """Кэш вида сортировки запроса, закрепленный за опубликованной версией индекса"""
+        return CacheManager.CACHE_TYPES[photo_request.sort_field].at_version(SortedPhotoCacheBase.INDEX_VERSION)
 
     @staticmethod
-    def load_photos_cache():
-        """Загрузка кэшей с фотками по всем тегам и видам сортировки"""
-        cache.clear()
+    def load_photos_cache(snapshot: dict = None):
+        """Загрузка кэшей с фотками по всем тегам и видам сортировки в новую версию индекса.
+
+           Версия строится рядом с опубликованной, которую продолжают читать запросы.
+           Изменения лайков за время построения запоминаются и применяются к новой версии
+           перед публикацией - заменой номера версии. После этого списки старых версий удаляются:
+           запросы, начатые на старой версии, дочитывают уже полученные списки
+
+        :param snapshot: снимок индекса (см. IndexSnapshotStore): списки берутся из него, а не из БД,
+            к ним добавляются фото и применяются изменения лайков после отметки снимка (high_water_mark)
+        """
+        with CacheManager.__reload_lock:
+            new_version = SortedPhotoCacheBase.INDEX_VERSION + 1
+            created = snapshot['created'] if snapshot is not None else datetime.now()
+            # отметка берется до чтения БД: добавленное во время построения догоняется при следующей загрузке
+            high_water_mark = CacheManager.get_high_water_mark()
+            with CacheManager.INDEX_VERSION_LOCK:
+                CacheManager.__pending_likes_changes = []
+            try:
+                if snapshot is None:
+                    CacheManager.__build_index_version(new_version)
+                else:
+                    CacheManager.__load_snapshot_version(snapshot, new_version)
+                    CacheManager.__add_photos_since(snapshot, new_version)
+                    CacheManager.__apply_likes_changes_to_version(
+                        CacheManager.__get_likes_changes_since(snapshot), new_version)
+                with CacheManager.INDEX_VERSION_LOCK:
+                    for likes_changes in CacheManager.__pending_likes_changes:
+                        CacheManager.__apply_likes_changes_to_version(likes_changes, new_version)
+                    CacheManager.LIKES_LEADERBOARD.load(
+                        CacheManager.CACHE_TYPES[SortType.likes].at_version(new_version)
+                        .get_photo_hashes_for_tag(DummyTag().id))
+                    SortedPhotoCacheBase.INDEX_VERSION = new_version
+                    CacheManager.INDEX_CREATED = created
+                    CacheManager.INDEX_HIGH_WATER_MARK = high_water_mark
+            finally:
+                with CacheManager.INDEX_VERSION_LOCK:
+                    CacheManager.__pending_likes_changes = None
+                SortedPhotoCacheBase.drop_index_versions(keep_version=SortedPhotoCacheBase.INDEX_VERSION)
+
+    @staticmethod
+    def __build_index_version(version: int):
         tags = list(Tag.objects.all())
         tags.append(DummyTag())
         for tag in tags:
             snapshot_date = datetime.now()
             tag_photos = tag.photo_set.filter(created_date__lte=snapshot_date)
-            for cache_type_id, photo_cache in CacheManager.CACHE_TYPES.items():
-                photo_cache.load_one_tag_cache(tag=tag, tag_photos=tag_photos, snapshot_date=snapshot_date)
+            for photo_cache in CacheManager.CACHE_TYPES.values():
+                photo_cache.at_version(version).load_one_tag_cache(tag=tag, tag_photos=tag_photos,
+                                                                   snapshot_date=snapshot_date)
+
+    @staticmethod
+    def __load_snapshot_version(snapshot: dict, version: int):
+        for sort_field, tag_lists in snapshot['lists'].items():
+            photo_cache = CacheManager.CACHE_TYPES[SortType(sort_field)].at_version(version)
+            for tag_id, tag_photo_hashes in tag_lists.items():
+                photo_cache.save_tag_list(tag_id=tag_id, tag_photo_hashes=tag_photo_hashes,
+                                          snapshot_date=snapshot['created'])
+
+    @staticmethod
+    def get_high_water_mark() -> dict:
+        """Наибольшие id фото и лайка в БД. Id выдаются по возрастанию, поэтому фото и лайки,
+            добавленные после отметки (любым способом и с любой датой лайка), - это записи с большими id
+
+        :return: dict[str, int] {'photo_id': ..., 'like_id': ...}
+        """
+        return {'photo_id': Photo.objects.aggregate(Max('id'))['id__max'] or 0,
+                'like_id': PhotoLikes.objects.aggregate(Max('id'))['id__max'] or 0}
+
+    @staticmethod
+    def __add_photos_since(snapshot: dict, version: int):
+        """Добавление в списки версии фото, созданных после отметки снимка"""
+        snapshot_date = datetime.now()
+        photos = list(Photo.objects.filter(id__gt=snapshot['high_water_mark']['photo_id'],
+                                           created_date__lte=snapshot_date))
+        if len(photos) == 0:
+            return
+        photo_tags = Photo.tags.through.objects.filter(photo_id__in=[photo.id for photo in photos]) \
+            .values_list('photo_id', 'tag_id')
+        for photo_cache in CacheManager.CACHE_TYPES.values():
+            photo_cache = photo_cache.at_version(version)
+            # пара (хэш, хэш): хэш удаляется и добавляется, так что фото не попадет в список дважды
+            hash_changes = {photo.id: (photo_cache.get_photo_hash(photo),) * 2 for photo in photos}
+            tag_hash_changes = {DummyTag().id: list(hash_changes.values())}
+            for photo_id, tag_id in photo_tags:
+                tag_hash_changes.setdefault(tag_id, []).append(hash_changes[photo_id])
+            for tag_id, changes in tag_hash_changes.items():
+                photo_cache.apply_hash_changes(tag_id, changes)
+
+    @staticmethod
+    def __get_likes_changes_since(snapshot: dict):
+        """Изменения числа лайков фото из снимка, лайкнутых после отметки снимка
+
+        :return: dict[int, tuple[int, int]] id фото -> (число лайков в снимке, текущее)
+        """
+        snapshot_likes = {photo_id: likes_cnt for likes_cnt, photo_id
+                          in snapshot['lists'][SortType.likes.value][DummyTag().id] if photo_id >= 0}
+        liked_photo_ids = PhotoLikes.objects.filter(id__gt=snapshot['high_water_mark']['like_id']) \
+            .values_list('photo_id', flat=True).distinct()
+        photo_likes = Photo.objects.filter(id__in=list(liked_photo_ids)).values_list('id', 'likes_cnt')
+        return {photo_id: (snapshot_likes[photo_id], likes_cnt) for photo_id, likes_cnt in photo_likes
+                if photo_id in snapshot_likes and snapshot_likes[photo_id] != likes_cnt}
+
+    @staticmethod
+    def get_index_snapshot() -> dict:
+        """Списки всех тегов опубликованной версии индекса для записи снимка (см. IndexSnapshotStore)"""
+        version = SortedPhotoCacheBase.INDEX_VERSION
+        tags = list(Tag.objects.all())
+        tags.append(DummyTag())
+        lists = {}
+        for sort_type, photo_cache in CacheManager.CACHE_TYPES.items():
+            photo_cache = photo_cache.at_version(version)
+            tag_lists = photo_cache.load_necessary_caches(
+                tag_conditions=[TagCondition(tag=tag, inclusive=True) for tag in tags])
+            lists[sort_type.value] = {tag.id: tag_list if type(tag_list) is list else tag_list.to_list()
+                                      for tag, tag_list in zip(tags, tag_lists)}
+        return {'created': CacheManager.INDEX_CREATED or datetime.now(),
+                'high_water_mark': CacheManager.INDEX_HIGH_WATER_MARK or CacheManager.get_high_water_mark(),
+                'lists': lists}
 
     @staticmethod
-    def get_search_cache(photo_request: PhotosRequest) -> SearchRequestInfo:
-        return cache.get(CacheManager.__get_search_cache_key(photo_request))
+    def apply_likes_changes(likes_changes):
+        """Применение изменения лайков к кэшам тегов и рейтингу по лайкам одним изменением на тег
+
+        :param likes_changes: dict[int, tuple[int, int]] id фото -> (старое, новое число лайков)
+        """
+        if len(likes_changes) == 0:
+            return
+        tag_hash_changes = CacheManager.__get_tag_hash_changes(likes_changes)
+        list_keys = [(SortType.likes.value, tag_id) for tag_id in tag_hash_changes]
+        with CacheManager.INDEX_VERSION_LOCK:
+            if CacheManager.__pending_likes_changes is not None:
+                CacheManager.__pending_likes_changes.append(likes_changes)
+            CacheManager.LIST_VERSIONS.update(list_keys)
+            try:
+                CacheManager.__apply_tag_hash_changes(tag_hash_changes, SortedPhotoCacheBase.INDEX_VERSION)
+                SortedPhotoCacheBase.drop_derived_lists(likes_changes)
+            finally:
+                CacheManager.LIST_VERSIONS.update(list_keys)
+
+            for photo_id, (_, new_likes_cnt) in likes_changes.items():
+                CacheManager.LIKES_LEADERBOARD.update(photo_id, new_likes_cnt)
+
+    @staticmethod
+    def __apply_likes_changes_to_version(likes_changes, version: int):
+        CacheManager.__apply_tag_hash_changes(CacheManager.__get_tag_hash_changes(likes_changes), version)
+
+    @staticmethod
+    def __get_tag_hash_changes(likes_changes):
+        """:return: dict[int, list[tuple[tuple, tuple]]] id тега -> изменения хэшей его фото по лайкам"""
+        hash_changes = {photo_id: ((old_likes_cnt, photo_id), (new_likes_cnt, photo_id))
+                        for photo_id, (old_likes_cnt, new_likes_cnt) in likes_changes.items()}
+        tag_hash_changes = {DummyTag().id: list(hash_changes.values())}
+        photo_tags = Photo.tags.through.objects.filter(photo_id__in=list(likes_changes)) \
+            .values_list('photo_id', 'tag_id')
+        for photo_id, tag_id in photo_tags:
+            tag_hash_changes.setdefault(tag_id, []).append(hash_changes[photo_id])
+        return tag_hash_changes
+
+    @staticmethod
+    def __apply_tag_hash_changes(tag_hash_changes, version: int):
+        photo_cache = CacheManager.CACHE_TYPES[SortType.likes].at_version(version)
+        for tag_id, changes in tag_hash_changes.items():
+            photo_cache.apply_hash_changes(tag_id, changes)
+        photo_cache.apply_derived_hash_changes(tag_hash_changes[DummyTag().id])
+
+    @staticmethod
+    def get_search_key(photo_request: PhotosRequest) -> str:
+        """Канонический ключ запроса: тип сортировки, упорядоченные условия на теги
+            и условия на диапазоны (не зависит от порядка тегов в запросе и номера страницы)"""
+        key = str(photo_request.sort_field.value) + "#" + ";".join(
+            sorted(x.key() for x in photo_request.tags_conditions))
+        if len(photo_request.range_filters) > 0:
+            key += "#" + ";".join(sorted(x.key() for x in photo_request.range_filters))
+        liked_condition = photo_request.get_liked_condition()
+        if liked_condition is not None:
+            # список лайков свой у каждого пользователя и меняется с его поколением
+            user_id = liked_condition.tag.user_id
+            key += "#u{0}g{1}".format(user_id, user_likes_index.get_generation(user_id))
+        return key
+
+    @staticmethod
+    def get_search_cache(search_cache_key: str) -> SearchRequestInfo:
+        """:param search_cache_key: ключ из get_search_cache_key (None - сохраненного поиска нет)"""
+        if search_cache_key is None:
+            return None
+        return cache.get(search_cache_key)
 
     @staticmethod
-    def save_search_cache(photo_request: PhotosRequest, search_info: SearchRequestInfo):
-        cache.set(
-            CacheManager.__get_search_cache_key(photo_request),
-            search_info,
-            CacheManager.SEARCH_CACHES_SECONDS_TIMEOUT)
+    def save_search_cache(search_cache_key: str, search_info: SearchRequestInfo):
+        if search_cache_key is not None:
+            cache.set(search_cache_key, search_info, CacheManager.SEARCH_CACHES_SECONDS_TIMEOUT)
 
     @staticmethod
-    def __get_search_cache_key(photo_request: PhotosRequest):
-        return str(photo_request.sort_field.value) + "#" + ";".join(
-            str(x.tag.id) for x in photo_request.tags_conditions)
+    def get_search_cache_key(photo_request: PhotosRequest, plan_key: str = "", index_version: int = None) -> str:
+        """Ключ сохраненного поиска: запрос, план, версия индекса и версии списков запроса.
+            Берется до чтения списков и сравнивается с ключом после чтения (см. PageSearcher):
+            поиск сохраняется и берется из кэша, только если списки не менялись, пока читались
+
+        :param plan_key: ключ плана поиска (порядка и состава списков): отметки поиска
+            указывают в конкретные списки, поэтому сохраненный поиск годится только для того же плана
+        :param index_version: версия индекса, по спискам которой идет поиск (по умолчанию опубликованная)
+        :return: str или None, если какой-то из списков запроса сейчас меняется
+        """
+        list_versions = [CacheManager.LIST_VERSIONS[list_key]
+                         for list_key in CacheManager.__get_list_keys(photo_request)]
+        if any(list_version % 2 == 1 for list_version in list_versions):
+            return None
+        return SEARCH_CACHE_TEMPLATE_KEY.format(
+            CacheManager.get_search_key(photo_request) + "@" + plan_key,
+            SortedPhotoCacheBase.INDEX_VERSION if index_version is None else index_version,
+            ".".join(str(list_version) for list_version in list_versions))
+
+    @staticmethod
+    def __get_list_keys(photo_request: PhotosRequest):
+        """Списки, от которых зависит поиск: списки тегов запроса, список всех фото
+            (без включающих тегов) и, для условий на диапазоны, списки всех фото по полю условия
+            и по полю сортировки (из них строятся списки диапазонов)
+
+        :return: list[tuple[int, int]] (вид сортировки, id тега)
+        """
+        sort_field = photo_request.sort_field.value
+        list_keys = {(sort_field, tag.id) for condition in photo_request.tags_conditions
+                     for tag in (condition.tags if isinstance(condition, TagOrGroup) else [condition.tag])}
+        if not any(condition.inclusive for condition in photo_request.tags_conditions) \
+                or len(photo_request.range_filters) > 0:
+            list_keys.add((sort_field, DummyTag().id))
+        list_keys.update((range_filter.field, DummyTag().id) for range_filter in photo_request.range_filters)
+        return sorted(list_keys)
+
+
+metrics.set_gauge_callback('photo_likers_tag_cache_lists', lambda: len(SortedPhotoCacheBase.INDEX_MEMORY))
+metrics.set_gauge_callback('photo_likers_tag_cache_hashes', SortedPhotoCacheBase.INDEX_MEMORY.get_cnt_hashes)
+metrics.set_gauge_callback('photo_likers_index_memory_bytes', lambda: SortedPhotoCacheBase.INDEX_MEMORY.used_bytes)
+metrics.set_gauge_callback('photo_likers_index_evictions_total',
+                           lambda: SortedPhotoCacheBase.INDEX_MEMORY.evictions)
+metrics.set_gauge_callback('photo_likers_likes_leaderboard_photos', lambda: len(CacheManager.LIKES_LEADERBOARD))
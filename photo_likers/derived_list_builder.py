@@ -0,0 +1,74 @@
+import logging
+import queue
+import threading
+
+logger = logging.getLogger(__name__)
+
+
+class DerivedListBuilder:
+    """Построение производных списков (объединений и пересечений списков тегов) без повторов.
+
+       Если список уже строится другим потоком, запрос ждет окончания этого построения
+       и берет готовый список из кэша индекса, а не строит его еще раз.
+       Списки, без которых поиск может обойтись (пересечения пар тегов), строятся
+       в фоновом потоке (build_in_background), а запрос пока ищет по исходным спискам.
+    """
+
+    def __init__(self):
+        self.__lock = threading.Lock()
+        self.__building = {}  # type: dict[str, threading.Event]  ключ списка -> окончание построения
+        self.__queued = set()  # type: set[str]
+        self.__queue = queue.Queue()
+        self.__thread = None  # type: threading.Thread
+
+    def get_or_build(self, key: str, get_func, build_func):
+        """:param key: ключ списка в кэше индекса
+        :param get_func: callable() -> list[tuple] готовый список или None
+        :param build_func: callable() -> list[tuple] построение и сохранение списка
+        :return: list[tuple]
+        """
+        while True:
+            res = get_func()
+            if res is not None:
+                return res
+            with self.__lock:
+                event = self.__building.get(key)
+                if event is None:
+                    self.__building[key] = threading.Event()
+                    break
+            event.wait()
+        try:
+            return build_func()
+        finally:
+            with self.__lock:
+                self.__building.pop(key).set()
+
+    def build_in_background(self, key: str, get_func, build_func):
+        """Постановка построения списка в очередь фонового потока (если его там еще нет)"""
+        with self.__lock:
+            if key in self.__queued:
+                return
+            self.__queued.add(key)
+            if self.__thread is None or not self.__thread.is_alive():
+                self.__thread = threading.Thread(target=self.__run, name="derived-list-builder", daemon=True)
+                self.__thread.start()
+        self.__queue.put((key, get_func, build_func))
+
+    def join(self):
+        """Ожидание построения всех списков из очереди"""
+        self.__queue.join()
+
+    def __run(self):
+        while True:
+            key, get_func, build_func = self.__queue.get()
+            try:
+                self.get_or_build(key, get_func, build_func)
+            except Exception:
+                logger.exception("Failed to build derived list %s", key)
+            finally:
+                with self.__lock:
+                    self.__queued.discard(key)
+                self.__queue.task_done()
+
+
+derived_list_builder = DerivedListBuilder()
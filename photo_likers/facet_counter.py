@@ -0,0 +1,66 @@
+import itertools
+import sys
+from photo_likers.photo_caches import SortedPhotoCacheBase
+from photo_likers.settings import FACET_BITMAP_CACHE_TEMPLATE_KEY
+from photo_likers.utils.rank_select_bitmap import popcount
+from photo_likers.utils.tag_condition import TagCondition
+
+
+class FacetCounts:
+    """Число найденных фото и число фото с каждым тегом среди них"""
+
+    def __init__(self, cnt_found: int, tag_counts):
+        self.cnt_found = cnt_found
+        self.tag_counts = tag_counts  # type: dict[int, int]
+
+    def get_count(self, tag_id: int, inclusive: bool) -> int:
+        """Число фото после добавления условия на тег (None, если для тега не считалось)"""
+        cnt_with_tag = self.tag_counts.get(tag_id)
+        if cnt_with_tag is None:
+            return None
+        return cnt_with_tag if inclusive else self.cnt_found - cnt_with_tag
+
+
+class FacetCounter:
+    """Подсчет числа результатов для ссылок на добавление тегов без отдельного поиска на каждый тег.
+
+       Найденные фото и фото каждого тега представляются битовыми масками по id фото (числа python),
+       и число результатов с тегом - число единиц в их пересечении. Маски тегов не зависят
+       от сортировки и лайков и хранятся в кэше индекса вместе с версией индекса
+       (с учетом в бюджете памяти индекса)
+    """
+
+    def __init__(self, photo_cache: SortedPhotoCacheBase):
+        self.__photo_cache = photo_cache
+
+    def count(self, result_hashes, tags) -> FacetCounts:
+        """:param result_hashes: iterable[tuple] хэши всех найденных фото
+        :param tags: iterable[Tag] теги, для которых нужны числа
+        """
+        photo_ids = [self.__photo_cache.get_photo_id_by_hash(hash_value) for hash_value in result_hashes]
+        result_bitmap = self.get_ids_bitmap(photo_ids)
+        tag_counts = {tag.id: popcount(result_bitmap & self.get_tag_bitmap(tag)) for tag in tags}
+        return FacetCounts(cnt_found=len(photo_ids), tag_counts=tag_counts)
+
+    def get_tag_bitmap(self, tag) -> int:
+        photo_cache = self.__photo_cache
+        key = FACET_BITMAP_CACHE_TEMPLATE_KEY.format(tag.id, photo_cache.version)
+        bitmap = photo_cache.get_index_value(key)
+        if bitmap is None:
+            tag_list = next(photo_cache.load_necessary_caches(tag_conditions=[TagCondition(tag=tag, inclusive=True)]))
+            # без фиктивного значения в конце
+            bitmap = self.get_ids_bitmap(photo_cache.get_photo_id_by_hash(hash_value)
+                                         for hash_value in itertools.islice(tag_list, len(tag_list) - 1))
+            photo_cache.save_index_value(key, bitmap, sys.getsizeof(bitmap))
+        return bitmap
+
+    @staticmethod
+    def get_ids_bitmap(photo_ids) -> int:
+        """Битовая маска с единицами на позициях id фото"""
+        bits = bytearray()
+        for photo_id in photo_ids:
+            byte_index = photo_id >> 3
+            if byte_index >= len(bits):
+                bits.extend(bytes(byte_index - len(bits) + 1))
+            bits[byte_index] |= 1 << (photo_id & 7)
+        return int.from_bytes(bits, 'little')
@@ -0,0 +1,122 @@
+import sys
+import threading
+from collections import OrderedDict
+from photo_likers.settings import INDEX_MEMORY_BUDGET_BYTES, INDEX_HOT_HITS
+
+# оценка памяти под один хэш (кортеж из двух int) в списке тега
+HASH_BYTES = sys.getsizeof((0, 0)) + 2 * sys.getsizeof(2 ** 20) + 8
+
+
+def estimate_list_bytes(sorted_list) -> int:
+    """Оценка памяти под упорядоченный список хэшей (список, кортежи и числа)"""
+    if hasattr(sorted_list, 'get_size_bytes'):
+        return sorted_list.get_size_bytes()
+    return sys.getsizeof(sorted_list) + len(sorted_list) * HASH_BYTES
+
+
+class IndexMemoryManager:
+    """Учет памяти под списки тегов в кэше индекса и соблюдение бюджета.
+
+       Для каждого ключа хранится оценка размера списка в байтах и число обращений.
+       При превышении бюджета вытесняются давно не использованные (LRU) списки;
+       горячий список (не менее hot_hits обращений) получает второй шанс - его счетчик
+       уменьшается вдвое, и он переносится в конец очереди. Закрепленные ключи
+       (списки DummyTag) не вытесняются никогда.
+    """
+
+    def __init__(self, budget_bytes: int = INDEX_MEMORY_BUDGET_BYTES, hot_hits: int = INDEX_HOT_HITS):
+        self.budget_bytes = budget_bytes
+        self.hot_hits = hot_hits
+        self.__lock = threading.RLock()
+        self.__entries = OrderedDict()  # type: dict[str, dict] key -> bytes, length, hits, pinned
+        self.used_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def add(self, key: str, sorted_list, pinned: bool = False):
+        """Учет загруженного (или измененного) списка
+
+        :return: list[str] ключи, которые нужно удалить из кэша для соблюдения бюджета
+        """
+        return self.add_bytes(key, estimate_list_bytes(sorted_list), length=len(sorted_list), pinned=pinned)
+
+    def add_bytes(self, key: str, size_bytes: int, length: int = 0, pinned: bool = False):
+        """Учет значения кэша индекса заданного размера (например, битовой маски тега)
+
+        :param length: число хэшей в значении (для статистики)
+        :return: list[str] ключи, которые нужно удалить из кэша для соблюдения бюджета
+        """
+        with self.__lock:
+            entry = self.__entries.pop(key, None)
+            if entry is not None:
+                self.used_bytes -= entry['bytes']
+                pinned = pinned or entry['pinned']
+            self.__entries[key] = {'bytes': size_bytes, 'length': length, 'pinned': pinned,
+                                   'hits': entry['hits'] if entry is not None else 0}
+            self.used_bytes += size_bytes
+            return self.__evict(keep_key=key)
+
+    def touch(self, key: str):
+        """Учет обращения к загруженному списку"""
+        with self.__lock:
+            self.hits += 1
+            entry = self.__entries.get(key)
+            if entry is not None:
+                entry['hits'] += 1
+                self.__entries.move_to_end(key)
+
+    def note_miss(self, key: str):
+        """Учет обращения к списку, которого нет в кэше (список будет загружен заново)"""
+        with self.__lock:
+            self.misses += 1
+            self.discard(key)
+
+    def discard(self, key: str):
+        with self.__lock:
+            entry = self.__entries.pop(key, None)
+            if entry is not None:
+                self.used_bytes -= entry['bytes']
+
+    def clear(self):
+        with self.__lock:
+            self.__entries.clear()
+            self.used_bytes = 0
+
+    def __contains__(self, key: str) -> bool:
+        return key in self.__entries
+
+    def __len__(self):
+        return len(self.__entries)
+
+    def get_cnt_hashes(self) -> int:
+        with self.__lock:
+            return sum(entry['length'] for entry in self.__entries.values())
+
+    def get_stats(self) -> dict:
+        """Статистика размещения списков в памяти"""
+        with self.__lock:
+            return {'budget_bytes': self.budget_bytes, 'used_bytes': self.used_bytes,
+                    'resident_lists': len(self.__entries),
+                    'pinned_lists': sum(1 for entry in self.__entries.values() if entry['pinned']),
+                    'hits': self.hits, 'misses': self.misses, 'evictions': self.evictions}
+
+    def __evict(self, keep_key: str):
+        evicted = []
+        if self.budget_bytes is None:
+            return evicted
+        candidates = [key for key, entry in self.__entries.items() if not entry['pinned'] and key != keep_key]
+        # каждый проход уменьшает счетчики горячих списков вдвое, поэтому цикл конечен
+        while self.used_bytes > self.budget_bytes and len(candidates) > 0:
+            key = candidates.pop(0)
+            entry = self.__entries[key]
+            if entry['hits'] >= self.hot_hits:
+                entry['hits'] //= 2
+                self.__entries.move_to_end(key)
+                candidates.append(key)
+                continue
+            del self.__entries[key]
+            self.used_bytes -= entry['bytes']
+            self.evictions += 1
+            evicted.append(key)
+        return evicted
@@ -0,0 +1,91 @@
+import hashlib
+import json
+import os
+import pickle
+import tempfile
+from photo_likers.settings import INDEX_SNAPSHOT_DIR, INDEX_SNAPSHOT_KEEP
+
+MANIFEST_FILE_NAME = "manifest.json"
+SNAPSHOT_FILE_TEMPLATE = "index_{0}.pickle"
+# 2: снимок и манифест содержат отметку high_water_mark (см. CacheManager.get_high_water_mark)
+SNAPSHOT_FORMAT = 2
+
+
+class IndexSnapshotError(Exception):
+    """Снимка индекса нет или он поврежден"""
+
+
+class IndexSnapshotStore:
+    """Снимки индекса в общем каталоге: индекс строится по БД один раз, а загружается многими узлами.
+
+       Сборщик (команда publish_index_snapshot) записывает снимок - списки всех тегов для всех видов
+       сортировки - и манифест с именем файла снимка и его sha256. Веб-узел читает манифест,
+       проверяет контрольную сумму и загружает списки без запросов фото к БД.
+       Файлы записываются во временные и переименовываются, поэтому читатель видит
+       либо старый, либо новый манифест целиком, а указанный в нем снимок уже записан.
+       Снимок - pickle, поэтому записывать в каталог должен только сборщик.
+    """
+
+    def __init__(self, directory: str = INDEX_SNAPSHOT_DIR, keep_snapshots: int = INDEX_SNAPSHOT_KEEP):
+        self.directory = directory
+        self.keep_snapshots = keep_snapshots
+
+    def publish(self, snapshot: dict) -> dict:
+        """Запись снимка и манифеста, удаление старых снимков
+
+        :param snapshot: dict с временем создания 'created', отметкой 'high_water_mark' и списками 'lists'
+            (см. CacheManager.get_index_snapshot)
+        :return: dict манифест
+        """
+        os.makedirs(self.directory, exist_ok=True)
+        data = pickle.dumps(dict(snapshot, format=SNAPSHOT_FORMAT), protocol=pickle.HIGHEST_PROTOCOL)
+        file_name = SNAPSHOT_FILE_TEMPLATE.format(snapshot['created'].strftime('%Y%m%d%H%M%S%f'))
+        self.__write_atomic(file_name, data)
+        manifest = {'file': file_name, 'sha256': hashlib.sha256(data).hexdigest(), 'size': len(data),
+                    'created': snapshot['created'].isoformat(), 'high_water_mark': snapshot['high_water_mark'],
+                    'format': SNAPSHOT_FORMAT}
+        self.__write_atomic(MANIFEST_FILE_NAME, json.dumps(manifest, indent=2).encode('utf-8'))
+        self.__remove_old_snapshots(keep_file_name=file_name)
+        return manifest
+
+    def get_manifest(self):
+        """:return: dict манифест последнего снимка или None, если снимков нет"""
+        path = os.path.join(self.directory, MANIFEST_FILE_NAME)
+        if not os.path.exists(path):
+            return None
+        with open(path, encoding='utf-8') as manifest_file:
+            return json.load(manifest_file)
+
+    def load(self) -> dict:
+        """Чтение последнего снимка с проверкой контрольной суммы"""
+        manifest = self.get_manifest()
+        if manifest is None:
+            raise IndexSnapshotError("No index snapshot in {0}".format(self.directory))
+        with open(os.path.join(self.directory, manifest['file']), 'rb') as snapshot_file:
+            data = snapshot_file.read()
+        if hashlib.sha256(data).hexdigest() != manifest['sha256']:
+            raise IndexSnapshotError("Checksum mismatch for index snapshot {0}".format(manifest['file']))
+        snapshot = pickle.loads(data)
+        if snapshot.get('format') != SNAPSHOT_FORMAT:
+            raise IndexSnapshotError("Unsupported index snapshot format: {0}".format(snapshot.get('format')))
+        return snapshot
+
+    def __write_atomic(self, file_name: str, data: bytes):
+        fd, tmp_path = tempfile.mkstemp(dir=self.directory, prefix='.' + file_name)
+        try:
+            with os.fdopen(fd, 'wb') as tmp_file:
+                tmp_file.write(data)
+                tmp_file.flush()
+                os.fsync(tmp_file.fileno())
+            os.replace(tmp_path, os.path.join(self.directory, file_name))
+        except BaseException:
+            os.unlink(tmp_path)
+            raise
+
+    def __remove_old_snapshots(self, keep_file_name: str):
+        prefix, suffix = SNAPSHOT_FILE_TEMPLATE.split('{0}')
+        file_names = sorted((x for x in os.listdir(self.directory) if x.startswith(prefix) and x.endswith(suffix)),
+                            reverse=True)
+        for file_name in file_names[max(self.keep_snapshots, 1):]:
+            if file_name != keep_file_name:
+                os.remove(os.path.join(self.directory, file_name))
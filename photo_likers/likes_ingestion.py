@@ -0,0 +1,121 @@
+import atexit
+import logging
+import threading
+from collections import Counter
+from datetime import date
+from django.db import transaction
+from django.db.models import Case, When, F, IntegerField
+from photo_likers.cache_manager import CacheManager
+from photo_likers.models import Photo, PhotoLikes
+from photo_likers.settings import LIKES_BATCH_MAX_SIZE, LIKES_BATCH_FLUSH_SECONDS, LIKES_BATCH_MAX_RETRIES
+from photo_likers.user_likes_index import user_likes_index
+
+logger = logging.getLogger(__name__)
+
+
+class LikesBatcher:
+    """Пакетная запись лайков.
+
+       Лайки копятся в памяти, а изменения числа лайков группируются по фото.
+       Пачка сохраняется при достижении max_batch_size лайков или через flush_seconds
+       после первого лайка в пачке: один bulk_create для PhotoLikes, один
+       UPDATE ... CASE для Photo.likes_cnt и одно изменение кэшей тегов
+       и лайков загруженных пользователей на пачку.
+
+       Повторный лайк того же фото тем же пользователем (в пачке или уже сохраненный) не учитывается.
+       Неудачно сохраненная пачка возвращается в очередь и сохраняется по таймеру снова,
+       после max_retries неудачных попыток подряд она отбрасывается. Ошибки сохранения
+       только записываются в лог: запрос лайка, на котором пачка заполнилась, не падает
+    """
+
+    def __init__(self, max_batch_size: int = LIKES_BATCH_MAX_SIZE, flush_seconds: float = LIKES_BATCH_FLUSH_SECONDS,
+                 max_retries: int = LIKES_BATCH_MAX_RETRIES):
+        self.max_batch_size = max_batch_size
+        self.flush_seconds = flush_seconds
+        self.max_retries = max_retries
+        self.__lock = threading.Lock()
+        # сохранения пачек идут по очереди, чтобы изменения кэшей применялись в том же порядке
+        self.__flush_lock = threading.Lock()
+        self.__likes = {}  # type: dict[tuple[int, int], PhotoLikes]
+        self.__failed_attempts = 0
+        self.__timer = None  # type: threading.Timer
+
+    def add_like(self, user, photo_id: int, like_date: date = None):
+        with self.__lock:
+            self.__likes.setdefault((user.id, photo_id),
+                                    PhotoLikes(photo_id=photo_id, user=user, like_date=like_date or date.today()))
+            batch_size = len(self.__likes)
+            self.__schedule_flush()
+        if batch_size >= self.max_batch_size:
+            self.flush()
+
+    def flush(self):
+        """Сохранение накопленных лайков"""
+        with self.__flush_lock:
+            with self.__lock:
+                likes = self.__likes
+                self.__likes = {}
+                if self.__timer is not None:
+                    self.__timer.cancel()
+                    self.__timer = None
+            if len(likes) == 0:
+                return
+
+            try:
+                saved_likes, likes_changes = self.__save(list(likes.values()))
+                self.__failed_attempts = 0
+            except Exception:
+                self.__failed_attempts += 1
+                if self.__failed_attempts >= self.max_retries:
+                    logger.exception("Dropped a batch of %d likes after %d failed attempts",
+                                     len(likes), self.__failed_attempts)
+                    self.__failed_attempts = 0
+                else:
+                    logger.exception("Failed to save a batch of %d likes", len(likes))
+                    with self.__lock:
+                        likes.update(self.__likes)
+                        self.__likes = likes
+                return
+            finally:
+                with self.__lock:
+                    if len(self.__likes) > 0:
+                        self.__schedule_flush()
+            CacheManager.apply_likes_changes(likes_changes)
+            user_likes_index.apply_likes(saved_likes, likes_changes)
+
+    def __schedule_flush(self):
+        """Запуск таймера сохранения, если он еще не запущен (под self.__lock)"""
+        if self.__timer is None:
+            self.__timer = threading.Timer(self.flush_seconds, self.flush)
+            self.__timer.daemon = True
+            self.__timer.start()
+
+    @staticmethod
+    def __save(likes):
+        """Сохранение лайков, которых еще нет в БД
+
+        :param likes: list[PhotoLikes] лайки с разными парами (пользователь, фото)
+        :return: tuple[list[PhotoLikes], dict[int, tuple[int, int]]] сохраненные лайки
+            и id фото -> (старое, новое число лайков)
+        """
+        with transaction.atomic():
+            saved_pairs = set(PhotoLikes.objects.filter(
+                photo_id__in={like.photo_id for like in likes},
+                user_id__in={like.user_id for like in likes}).values_list('user_id', 'photo_id'))
+            likes = [like for like in likes if (like.user_id, like.photo_id) not in saved_pairs]
+            if len(likes) == 0:
+                return likes, {}
+            likes_deltas = Counter(like.photo_id for like in likes)
+            photo_ids = list(likes_deltas)
+            PhotoLikes.objects.bulk_create(likes)
+            Photo.objects.filter(id__in=photo_ids).update(
+                likes_cnt=Case(*[When(id=photo_id, then=F('likes_cnt') + delta)
+                                 for photo_id, delta in likes_deltas.items()],
+                               default=F('likes_cnt'), output_field=IntegerField()))
+            new_likes = Photo.objects.filter(id__in=photo_ids).values_list('id', 'likes_cnt')
+            return likes, {photo_id: (likes_cnt - likes_deltas[photo_id], likes_cnt)
+                           for photo_id, likes_cnt in new_likes}
+
+
+likes_batcher = LikesBatcher()
+atexit.register(likes_batcher.flush)
@@ -0,0 +1,113 @@
+import threading
+from photo_likers.settings import PHOTOS_PER_PAGE, LEADERBOARD_CACHED_PAGES
+from photo_likers.utils.indexable_skip_list import IndexableSkipList
+
+
+class LikesLeaderboard:
+    """Живой рейтинг всех фото по лайкам для страниц без условий на теги.
+
+       Хэши (likes_cnt, id) хранятся в skip list-е с доступом по индексу,
+       поэтому изменение лайков фото и получение любой страницы делаются за O(log n),
+       без перезагрузки всего кэша DummyTag.
+       Для первых LEADERBOARD_CACHED_PAGES страниц дополнительно кэшируются сами фото,
+       чтобы не ходить за ними в БД.
+    """
+
+    def __init__(self):
+        self.__lock = threading.RLock()
+        # в skip list-е значения по возрастанию, поэтому храним (-likes_cnt, -id)
+        self.__ranking = IndexableSkipList()
+        self.__likes = {}  # type: dict[int, int]
+        self.__top_photos = {}  # type: dict[int, Photo]
+        self.is_loaded = False
+
+    def load(self, photo_hashes):
+        """Загрузка рейтинга по упорядоченному по убыванию списку хэшей (likes_cnt, id)"""
+        likes = {}
+        ranking_values = []
+        for likes_cnt, photo_id in photo_hashes:
+            if photo_id < 0:  # фиктивное значение в конце списка
+                continue
+            likes[photo_id] = likes_cnt
+            ranking_values.append((-likes_cnt, -photo_id))
+        ranking = IndexableSkipList.from_sorted(ranking_values, expected_size=len(ranking_values))
+        with self.__lock:
+            self.__ranking = ranking
+            self.__likes = likes
+            self.__top_photos = {}
+            self.is_loaded = True
+
+    def __len__(self):
+        return len(self.__ranking)
+
+    def get_likes(self, photo_id: int) -> int:
+        return self.__likes.get(photo_id)
+
+    def update(self, photo_id: int, likes_cnt: int):
+        """Изменение (или добавление) числа лайков фото"""
+        if not self.is_loaded:
+            return
+        with self.__lock:
+            old_likes_cnt = self.__likes.get(photo_id)
+            if old_likes_cnt == likes_cnt:
+                return
+            if old_likes_cnt is not None:
+                self.__ranking.remove((-old_likes_cnt, -photo_id))
+            self.__ranking.insert((-likes_cnt, -photo_id))
+            self.__likes[photo_id] = likes_cnt
+
+            photo = self.__top_photos.pop(photo_id, None)
+            if photo is not None and self.__is_top(photo_id):
+                photo.likes_cnt = likes_cnt
+                self.__top_photos[photo_id] = photo
+
+    def remove(self, photo_id: int):
+        if not self.is_loaded:
+            return
+        with self.__lock:
+            likes_cnt = self.__likes.pop(photo_id, None)
+            if likes_cnt is not None:
+                self.__ranking.remove((-likes_cnt, -photo_id))
+            self.__top_photos.pop(photo_id, None)
+
+    def get_page(self, page_number: int):
+        """:return: list[tuple] хэши (likes_cnt, id) фото на странице"""
+        if page_number < 1:
+            raise ValueError("Page number must be positive: {0}".format(page_number))
+        start = (page_number - 1) * PHOTOS_PER_PAGE
+        with self.__lock:
+            return [(-likes_cnt, -photo_id)
+                    for likes_cnt, photo_id in self.__ranking.islice(start, start + PHOTOS_PER_PAGE)]
+
+    def get_num_pages(self) -> int:
+        num_pages, rest = divmod(len(self.__ranking), PHOTOS_PER_PAGE)
+        return num_pages + 1 if rest > 0 else num_pages
+
+    def get_photos(self, photo_ids, fetch_photos):
+        """Фото по списку id в том же порядке: из кэша топа рейтинга,
+            а недостающие - через fetch_photos (и кэшируются, если они в топе)
+
+        :param photo_ids: list[int]
+        :param fetch_photos: callable(list[int]) -> list[Photo]
+        """
+        with self.__lock:
+            cached_photos = {photo_id: self.__top_photos[photo_id]
+                             for photo_id in photo_ids if photo_id in self.__top_photos}
+        missing_ids = [photo_id for photo_id in photo_ids if photo_id not in cached_photos]
+        if len(missing_ids) > 0:
+            fetched_photos = fetch_photos(missing_ids)
+            with self.__lock:
+                for photo in fetched_photos:
+                    cached_photos[photo.id] = photo
+                    if self.__is_top(photo.id) and self.__likes[photo.id] == photo.likes_cnt:
+                        self.__top_photos[photo.id] = photo
+                if len(self.__top_photos) > 2 * LEADERBOARD_CACHED_PAGES * PHOTOS_PER_PAGE:
+                    # убираем фото, вытесненные из топа другими фото
+                    self.__top_photos = {photo_id: photo for photo_id, photo in self.__top_photos.items()
+                                         if self.__is_top(photo_id)}
+        return [cached_photos[photo_id] for photo_id in photo_ids if photo_id in cached_photos]
+
+    def __is_top(self, photo_id: int) -> bool:
+        likes_cnt = self.__likes.get(photo_id)
+        return likes_cnt is not None and \
+            self.__ranking.index((-likes_cnt, -photo_id)) < LEADERBOARD_CACHED_PAGES * PHOTOS_PER_PAGE
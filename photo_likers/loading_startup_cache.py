@@ -1,14 +1,137 @@
 from .cache_manager import CacheManager
-from photo_likers.settings import LOAD_CACHES_ON_START, LOAD_CACHES_ON_START_ASYNC
+from .index_snapshot import IndexSnapshotStore, IndexSnapshotError
+from .metrics import metrics
+from .photo_caches import SortedPhotoCacheBase
+from .search_warmer import search_warmer
+from .sharded_index import ShardCoordinator, PROCESS_SHARD_CLIENT, LOCAL_SHARD_CLIENT
+from photo_likers.settings import LOAD_CACHES_ON_START, LOAD_CACHES_ON_START_ASYNC, SEARCH_WARMER_ENABLED, \
+    INDEX_SNAPSHOT_DIR, INDEX_SHARDS, INDEX_SHARD_CLIENT
+import logging
 import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+NOT_STARTED = 'not_started'
+LOADING = 'loading'
+READY = 'ready'
+FAILED = 'failed'
+
+
+class IndexStartup:
+    """Запуск подсистемы индекса (загрузка кэшей и прогрев) и состояние готовности.
+
+       Запускается из PhotoLikersConfig.ready только в процессах, где запуск индекса включен явно.
+       Хранит время от запуска до готовности индекса и до первого запроса страницы.
+       Если включены шарды (INDEX_SHARDS), после загрузки кэшей один раз запускает их
+       по последнему снимку индекса: shard_coordinator передается в PageSearcher
+    """
+
+    def __init__(self, load_on_start: bool = LOAD_CACHES_ON_START, load_async: bool = LOAD_CACHES_ON_START_ASYNC,
+                 warmer_enabled: bool = SEARCH_WARMER_ENABLED, reload_func=None, cnt_shards: int = INDEX_SHARDS,
+                 shard_client: str = INDEX_SHARD_CLIENT, snapshot_directory: str = INDEX_SNAPSHOT_DIR):
+        """:param reload_func: callable() загрузка индекса (по умолчанию reload_caches)
+        :param cnt_shards: число шардов (0 - страницы ищутся только по кэшам процесса)
+        :param shard_client: где работают шарды (PROCESS_SHARD_CLIENT или LOCAL_SHARD_CLIENT)
+        :param snapshot_directory: каталог снимков индекса, из последнего снимка загружаются шарды
+        """
+        if shard_client not in (PROCESS_SHARD_CLIENT, LOCAL_SHARD_CLIENT):
+            raise ValueError("Unknown shard client type: {0}".format(shard_client))
+        self.load_on_start = load_on_start
+        self.load_async = load_async
+        self.warmer_enabled = warmer_enabled
+        self.cnt_shards = cnt_shards
+        self.shard_client = shard_client
+        self.snapshot_directory = snapshot_directory
+        self.shard_coordinator = None  # type: ShardCoordinator
+        self.__reload_func = reload_func
+        self.status = NOT_STARTED
+        self.error = None  # type: str
+        self.ready_seconds = None  # type: float
+        self.first_request_seconds = None  # type: float
+        self.__started_at = None  # type: float
+        self.__lock = threading.Lock()
+
+    def start(self):
+        """Загрузка кэшей (в фоне при load_async) и запуск фонового прогрева"""
+        with self.__lock:
+            self.status = LOADING
+            self.error = None
+            self.ready_seconds = None
+            self.first_request_seconds = None
+            self.__started_at = time.monotonic()
+        if self.load_on_start:
+            if self.load_async:
+                threading.Thread(target=self.__load, name="index-startup", daemon=True).start()
+            else:
+                self.__load()
+        else:
+            self.__set_ready()
+        if self.warmer_enabled:
+            search_warmer.start()
+
+    def is_ready(self) -> bool:
+        return self.status == READY
+
+    def mark_request(self):
+        """Учет первого обслуженного запроса страницы после запуска"""
+        if self.first_request_seconds is None and self.__started_at is not None:
+            self.first_request_seconds = time.monotonic() - self.__started_at
+
+    def get_state(self) -> dict:
+        return {'status': self.status, 'error': self.error, 'index_version': SortedPhotoCacheBase.INDEX_VERSION,
+                'ready_seconds': self.ready_seconds, 'first_request_seconds': self.first_request_seconds}
+
+    def __load(self):
+        try:
+            (self.__reload_func or reload_caches)()
+        except Exception as e:
+            logger.exception("Failed to load index caches")
+            with self.__lock:
+                self.status = FAILED
+                self.error = str(e)
+            return
+        self.__start_shards()
+        self.__set_ready()
+
+    def __start_shards(self):
+        """Запуск шардов (один раз); без снимка или при ошибке страницы ищутся по кэшам процесса"""
+        if self.cnt_shards <= 0 or self.shard_coordinator is not None:
+            return
+        if self.snapshot_directory is None:
+            logger.warning("Index shards need a snapshot directory, serving pages from the local index")
+            return
+        try:
+            self.shard_coordinator = ShardCoordinator.from_snapshot_directory(
+                self.snapshot_directory, cnt_shards=self.cnt_shards,
+                processes=self.shard_client == PROCESS_SHARD_CLIENT)
+        except Exception:
+            logger.exception("Failed to start index shards, serving pages from the local index")
+
+    def __set_ready(self):
+        with self.__lock:
+            self.status = READY
+            self.ready_seconds = time.monotonic() - self.__started_at
+
+
+def reload_caches():
+    """Перезагрузка кэшей тегов с последующим прогревом популярных запросов.
+        Если задан общий каталог снимков, индекс загружается из последнего снимка,
+        а при его отсутствии или повреждении строится по БД"""
+    snapshot = None
+    if INDEX_SNAPSHOT_DIR is not None:
+        try:
+            snapshot = IndexSnapshotStore(INDEX_SNAPSHOT_DIR).load()
+        except (IndexSnapshotError, OSError):
+            logger.exception("Failed to load index snapshot, building index from the database")
+    CacheManager.load_photos_cache(snapshot=snapshot)
+    search_warmer.warm()
 
 
 def load_start_cache():
     """Загрузка исходных кэшей"""
-    if LOAD_CACHES_ON_START:
-        load_cache_func = CacheManager.load_photos_cache
-        if LOAD_CACHES_ON_START_ASYNC:
-            t = threading.Thread(target=load_cache_func)
-            t.start()
-        else:
-            load_cache_func()
+    index_startup.start()
+
+
+index_startup = IndexStartup()
+metrics.set_gauge_callback('photo_likers_index_ready', lambda: int(index_startup.is_ready()))
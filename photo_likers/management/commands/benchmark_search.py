@@ -0,0 +1,31 @@
+import json
+from django.core.management.base import BaseCommand
+from django.utils.module_loading import import_string
+from photo_likers.benchmark import run_benchmarks
+
+
+class Command(BaseCommand):
+    help = "Benchmark merge, search and tag cache building on synthetic posting lists (no DB), output JSON"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--photos', type=int, default=100000)
+        parser.add_argument('--tags', type=int, default=10)
+        parser.add_argument('--density', type=float, default=0.1, help="probability of a photo to have a tag")
+        parser.add_argument('--seed', type=int, default=0)
+        parser.add_argument('--repeat', type=int, default=3)
+        parser.add_argument('--tag-counts', type=int, nargs='+', default=[0, 1, 2, 3])
+        parser.add_argument('--pages', type=int, nargs='+', default=[1, 10, 100, 1000])
+        parser.add_argument('--searcher', default='photo_likers.utils.sorted_list_searcher.SortedListSearcher',
+                            help="dotted path to the searcher class")
+        parser.add_argument('--output', help="file for JSON results (stdout by default)")
+
+    def handle(self, *args, **options):
+        res = run_benchmarks(cnt_photos=options['photos'], cnt_tags=options['tags'], density=options['density'],
+                             seed=options['seed'], repeat=options['repeat'], tag_counts=options['tag_counts'],
+                             page_numbers=options['pages'], searcher_class=import_string(options['searcher']))
+        res_json = json.dumps(res, indent=2)
+        if options['output']:
+            with open(options['output'], 'w') as output_file:
+                output_file.write(res_json)
+        else:
+            self.stdout.write(res_json)
@@ -0,0 +1,43 @@
+import json
+from django.core.management.base import BaseCommand, CommandError
+from django.utils.module_loading import import_string
+from photo_likers.search_harness import run_differential, run_swap_stress
+
+
+class Command(BaseCommand):
+    help = "Compare searchers with a brute-force reference on random posting lists, " \
+           "optionally with searches during index swaps, output JSON"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--cases', type=int, default=500)
+        parser.add_argument('--seed', type=int, default=0)
+        parser.add_argument('--max-photos', type=int, default=300)
+        parser.add_argument('--max-tags', type=int, default=4)
+        parser.add_argument('--searcher', nargs='+',
+                            default=['photo_likers.utils.sorted_list_searcher.SortedListSearcher'],
+                            help="dotted paths to the searcher classes to check")
+        parser.add_argument('--stress-threads', type=int, default=0,
+                            help="search threads for the index swap stress (0 - no stress run); "
+                                 "replaces the published index with random lists")
+        parser.add_argument('--stress-swaps', type=int, default=10)
+        parser.add_argument('--output', help="file for JSON results (stdout by default)")
+
+    def handle(self, *args, **options):
+        searcher_classes = [import_string(x) for x in options['searcher']]
+        res = {'differential': run_differential(cnt_cases=options['cases'], seed=options['seed'],
+                                                searcher_classes=searcher_classes,
+                                                max_photos=options['max_photos'], max_tags=options['max_tags'])}
+        if options['stress_threads'] > 0:
+            res['stress'] = [run_swap_stress(cnt_threads=options['stress_threads'], cnt_swaps=options['stress_swaps'],
+                                             seed=options['seed'], searcher_class=searcher_class)
+                             for searcher_class in searcher_classes]
+        res_json = json.dumps(res, indent=2)
+        if options['output']:
+            with open(options['output'], 'w') as output_file:
+                output_file.write(res_json)
+        else:
+            self.stdout.write(res_json)
+        cnt_mismatches = len(res['differential']['mismatches']) + \
+            sum(len(stress['mismatches']) for stress in res.get('stress', []))
+        if cnt_mismatches > 0:
+            raise CommandError("{0} mismatches found".format(cnt_mismatches))
@@ -0,0 +1,21 @@
+import json
+from django.core.management.base import BaseCommand, CommandError
+from photo_likers.cache_manager import CacheManager
+from photo_likers.index_snapshot import IndexSnapshotStore
+from photo_likers.settings import INDEX_SNAPSHOT_DIR, INDEX_SNAPSHOT_KEEP
+
+
+class Command(BaseCommand):
+    help = "Build the index from the database once and publish its snapshot for web nodes, output the manifest"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--dir', default=INDEX_SNAPSHOT_DIR, help="shared snapshot directory")
+        parser.add_argument('--keep', type=int, default=INDEX_SNAPSHOT_KEEP, help="number of snapshots to keep")
+
+    def handle(self, *args, **options):
+        if options['dir'] is None:
+            raise CommandError("Snapshot directory is not set (--dir or INDEX_SNAPSHOT_DIR)")
+        CacheManager.load_photos_cache()
+        manifest = IndexSnapshotStore(options['dir'], keep_snapshots=options['keep']).publish(
+            CacheManager.get_index_snapshot())
+        self.stdout.write(json.dumps(manifest, indent=2))
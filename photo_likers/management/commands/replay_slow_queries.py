@@ -0,0 +1,33 @@
+import json
+from django.core.management.base import BaseCommand
+from django.utils.module_loading import import_string
+from photo_likers.benchmark import replay_slow_queries
+from photo_likers.models import Tag
+from photo_likers.settings import SLOW_QUERY_LOG_PATH
+from photo_likers.slow_query_log import SlowQueryLog
+
+
+class Command(BaseCommand):
+    help = "Replay the slow query log against the current index and compare searchers, output JSON"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--log', default=SLOW_QUERY_LOG_PATH, help="slow query log file")
+        parser.add_argument('--searcher', nargs='+',
+                            default=['photo_likers.utils.sorted_list_searcher.SortedListSearcher'],
+                            help="dotted paths to the searcher classes to compare")
+        parser.add_argument('--repeat', type=int, default=3)
+        parser.add_argument('--limit', type=int, help="replay only the first N entries")
+        parser.add_argument('--output', help="file for JSON results (stdout by default)")
+
+    def handle(self, *args, **options):
+        entries = list(SlowQueryLog.read(options['log']))
+        if options['limit'] is not None:
+            entries = entries[:options['limit']]
+        res = replay_slow_queries(entries, searcher_classes=[import_string(x) for x in options['searcher']],
+                                  repeat=options['repeat'], tags=Tag.objects.all())
+        res_json = json.dumps(res, indent=2)
+        if options['output']:
+            with open(options['output'], 'w') as output_file:
+                output_file.write(res_json)
+        else:
+            self.stdout.write(res_json)
@@ -0,0 +1,104 @@
+import threading
+import time
+from collections import OrderedDict
+from contextlib import contextmanager
+
+COUNTER = 'counter'
+GAUGE = 'gauge'
+SUMMARY = 'summary'
+
+
+class MetricsRegistry:
+    """Простые метрики процесса (счетчики, измерители, суммы времен)
+        с выводом в текстовом формате Prometheus"""
+
+    def __init__(self):
+        self.__lock = threading.Lock()
+        self.__descriptions = OrderedDict()  # name -> (type, help)
+        self.__values = {}  # type: dict[str, dict[tuple, float]]
+        self.__gauge_callbacks = {}  # name -> callable() -> float
+
+    def describe(self, name: str, metric_type: str, help_text: str):
+        self.__descriptions[name] = (metric_type, help_text)
+
+    def inc(self, name: str, value: float = 1, labels: dict = None):
+        key = self.__labels_key(labels)
+        with self.__lock:
+            values = self.__values.setdefault(name, {})
+            values[key] = values.get(key, 0) + value
+
+    def observe(self, name: str, value: float, labels: dict = None):
+        """Наблюдение для суммы (summary): число наблюдений и их сумма"""
+        self.inc(name + '_count', 1, labels)
+        self.inc(name + '_sum', value, labels)
+
+    def set_gauge_callback(self, name: str, callback):
+        """Значение измерителя вычисляется при выводе метрик"""
+        self.__gauge_callbacks[name] = callback
+
+    def get_value(self, name: str, labels: dict = None) -> float:
+        return self.__values.get(name, {}).get(self.__labels_key(labels), 0)
+
+    def render(self) -> str:
+        lines = []
+        with self.__lock:
+            values = {name: dict(name_values) for name, name_values in self.__values.items()}
+        for name, callback in self.__gauge_callbacks.items():
+            values[name] = {(): callback()}
+
+        for name, (metric_type, help_text) in self.__descriptions.items():
+            lines.append('# HELP {0} {1}'.format(name, help_text))
+            lines.append('# TYPE {0} {1}'.format(name, metric_type))
+            suffixes = ['_count', '_sum'] if metric_type == SUMMARY else ['']
+            for suffix in suffixes:
+                name_values = values.get(name + suffix) or {(): 0}
+                for labels_key, value in sorted(name_values.items()):
+                    lines.append('{0}{1}{2} {3}'.format(name, suffix, self.__format_labels(labels_key), value))
+        return '\n'.join(lines) + '\n'
+
+    @staticmethod
+    def __labels_key(labels: dict) -> tuple:
+        return tuple(sorted(labels.items())) if labels else ()
+
+    @staticmethod
+    def __format_labels(labels_key: tuple) -> str:
+        if len(labels_key) == 0:
+            return ''
+        return '{' + ','.join('{0}="{1}"'.format(name, value) for name, value in labels_key) + '}'
+
+
+class RequestTimings:
+    """Замеры времени этапов обработки одного запроса.
+        Каждый этап также попадает в сумму photo_likers_stage_seconds"""
+
+    def __init__(self):
+        self.stages = OrderedDict()  # type: dict[str, float]
+
+    @contextmanager
+    def stage(self, name: str):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            elapsed = time.perf_counter() - start
+            self.stages[name] = self.stages.get(name, 0) + elapsed
+            metrics.observe('photo_likers_stage_seconds', elapsed, {'stage': name})
+
+    def get_server_timing_header(self) -> str:
+        """Значение заголовка Server-Timing (длительности в мс)"""
+        return ', '.join('{0};dur={1:.2f}'.format(name, seconds * 1000) for name, seconds in self.stages.items())
+
+
+metrics = MetricsRegistry()
+metrics.describe('photo_likers_stage_seconds', SUMMARY, 'Time spent in request processing stages')
+metrics.describe('photo_likers_search_cache_hits_total', COUNTER, 'Searches started from saved search info')
+metrics.describe('photo_likers_search_cache_misses_total', COUNTER, 'Searches without saved search info')
+metrics.describe('photo_likers_merge_iterations_total', COUNTER, 'Values of the first list checked by the merge')
+metrics.describe('photo_likers_merge_gallop_searches_total', COUNTER, 'Galloping searches in the merged lists')
+metrics.describe('photo_likers_merge_elements_scanned_total', COUNTER, 'Positions passed by the merge pointers')
+metrics.describe('photo_likers_tag_cache_lists', GAUGE, 'Tag lists loaded into the cache')
+metrics.describe('photo_likers_tag_cache_hashes', GAUGE, 'Photo hashes in loaded tag lists')
+metrics.describe('photo_likers_index_memory_bytes', GAUGE, 'Estimated memory of loaded tag lists')
+metrics.describe('photo_likers_index_evictions_total', COUNTER, 'Tag lists evicted to keep the memory budget')
+metrics.describe('photo_likers_likes_leaderboard_photos', GAUGE, 'Photos in the likes leaderboard')
+metrics.describe('photo_likers_index_ready', GAUGE, 'Whether the index finished loading after startup')
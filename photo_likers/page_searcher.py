@@ -1,27 +1,110 @@
+import time
 from django.core.paginator import Page
 from photo_likers.cache_manager import CacheManager
+from photo_likers.derived_list_builder import DerivedListBuilder, derived_list_builder
+from photo_likers.facet_counter import FacetCounter, FacetCounts
+from photo_likers.metrics import RequestTimings, metrics
 from photo_likers.models import Photo
 from photo_likers.photo_caches import SortedPhotoCacheBase
-from photo_likers.settings import PHOTOS_PER_PAGE
+from photo_likers.search_scheduler import SearchScheduler, search_scheduler
+from photo_likers.settings import PHOTOS_PER_PAGE, FACET_COUNTS_MAX_FOUND
+from photo_likers.sharded_index import ShardCoordinator
+from photo_likers.slow_query_log import SlowQueryLog, slow_query_log
 from photo_likers.utils.custom_paginator import CustomPaginator
 from photo_likers.utils.dummy_tag import DummyTag
-from photo_likers.utils.photo_request import PhotosRequest
-from photo_likers.utils.sorted_list_searcher import SortedListSearcher
-from photo_likers.utils.tag_condition import TagCondition
+from photo_likers.utils.photo_request import PhotosRequest, SortType
+from photo_likers.utils.range_filter import RangeFilter
+from photo_likers.utils.sorted_list_searcher import SortedListSearcher, SearchRequestInfo
+from photo_likers.tag_pair_index import TagPairIndex, tag_pair_index
+from photo_likers.user_likes_index import UserLikesIndex, user_likes_index
+from photo_likers.utils.liked_tag import LikedTag
+from photo_likers.utils.tag_condition import TagCondition, TagOrGroup, TagPairCondition
 
 
 class PageSearcher:
-    def __init__(self, photo_cache: SortedPhotoCacheBase, searcher_class=SortedListSearcher):
+    def __init__(self, photo_cache: SortedPhotoCacheBase, searcher_class=SortedListSearcher,
+                 scheduler: SearchScheduler = search_scheduler, timings: RequestTimings = None,
+                 slow_log: SlowQueryLog = slow_query_log, shard_coordinator: ShardCoordinator = None,
+                 user_likes: UserLikesIndex = user_likes_index,
+                 list_builder: DerivedListBuilder = derived_list_builder):
+        """:param shard_coordinator: поиск по шардам индекса для запросов с сортировкой по дате
+            только с условиями на теги (по умолчанию - поиск по спискам в кэше процесса)
+        :param user_likes: лайки пользователей для условия "лайкнуто мной"
+        :param list_builder: построение недостающих объединений и пересечений списков
+        """
         self.__photo_cache = photo_cache
+        self.__user_likes = user_likes
+        self.__list_builder = list_builder
+        self.__shard_coordinator = shard_coordinator
         self.__searcher_class = searcher_class
+        self.__scheduler = scheduler
+        self.__slow_log = slow_log
+        self.__timings = timings or RequestTimings()
+        # последний поиск страницы: (запрос, списки, информация о поиске, ключ сохраненного поиска)
+        self.__last_search = None
 
     def get_pagination_by_request(self, photo_request: PhotosRequest) -> Page:
-        ordered_conditions = self.__order_tag_conditions(photo_request)
-        ordered_photo_lists = [x for x in self.__photo_cache.load_necessary_caches(tag_conditions=ordered_conditions)]
-        return self.search_page_in_ordered_photo_lists(photo_request, ordered_conditions, ordered_photo_lists)
+        if self.__is_leaderboard_request(photo_request):
+            return self.get_leaderboard_page(photo_request)
+        if self.__shard_coordinator is not None and self.__is_shardable_request(photo_request):
+            return self.get_sharded_page(photo_request)
+        ordered_conditions = self.plan_tag_conditions(photo_request)
+        with self.__timings.stage('load_caches'):
+            ordered_photo_lists, search_cache_key = self.load_photo_lists_with_search_key(photo_request,
+                                                                                          ordered_conditions)
+        return self.search_page_in_ordered_photo_lists(photo_request, ordered_conditions, ordered_photo_lists,
+                                                       search_cache_key)
+
+    def load_photo_lists_with_search_key(self, photo_request: PhotosRequest, ordered_conditions):
+        """Списки фото для условий (см. load_ordered_photo_lists) и ключ сохраненного поиска по ним.
+            Ключ берется до и после чтения списков: если за это время изменились лайки фото
+            из списков запроса, ключа нет (None) и поиск не берется из кэша и не сохраняется
+
+        :return: tuple[list[list[tuple]], str]
+        """
+        plan_key = self.get_plan_key(ordered_conditions)
+        version = self.__photo_cache.version
+        search_cache_key = CacheManager.get_search_cache_key(photo_request, plan_key, version)
+        ordered_photo_lists = self.load_ordered_photo_lists(ordered_conditions)
+        if CacheManager.get_search_cache_key(photo_request, plan_key, version) != search_cache_key:
+            search_cache_key = None
+        return ordered_photo_lists, search_cache_key
+
+    def load_ordered_photo_lists(self, ordered_conditions):
+        """Списки фото для условий на теги, групп "хотя бы один из тегов" (объединения списков),
+            пар тегов (готовые пересечения), условия "лайкнуто мной" (список лайков пользователя)
+            и условий на диапазоны по другому полю в заданном порядке.
+            Недостающее объединение строится в полосе дорогих поисков (см. SearchScheduler.run_expensive),
+            а если полоса занята, объединение для запроса мержится без сохранения
+
+        :return: list[list[tuple]]
+        """
+        photo_cache = self.__photo_cache
+        tag_lists = photo_cache.load_necessary_caches(
+            tag_conditions=[condition for condition in ordered_conditions
+                            if isinstance(condition, TagCondition) and not isinstance(condition.tag, LikedTag)])
+        res = []
+        for condition in ordered_conditions:
+            if isinstance(condition, RangeFilter):
+                field_cache = CacheManager.CACHE_TYPES[SortType(condition.field)].at_version(photo_cache.version)
+                res.append(photo_cache.load_range_list(condition, field_cache))
+            elif isinstance(condition, TagOrGroup):
+                res.append(self.__list_builder.get_or_build(
+                    photo_cache.get_union_cache_key(condition),
+                    lambda group=condition: photo_cache.get_union_list(group),
+                    lambda group=condition: self.__scheduler.run_expensive(
+                        lambda: photo_cache.load_union_list(group),
+                        lambda: photo_cache.merge_union_list(group))))
+            elif isinstance(condition, TagPairCondition):
+                res.append(photo_cache.load_pair_list(condition))
+            elif isinstance(condition.tag, LikedTag):
+                res.append(self.__user_likes.get_list(condition.tag.user_id, photo_cache))
+            else:
+                res.append(next(tag_lists))
+        return res
 
     def search_page_in_ordered_photo_lists(self, photo_request: PhotosRequest, ordered_conditions,
-                                           ordered_photo_lists) -> Page:
+                                           ordered_photo_lists, search_cache_key: str) -> Page:
         """Поиск фото с заданной страницы по заданным условиям на теги
             для заданного типа кэша (по лайкам или по датам).
 
@@ -37,38 +120,251 @@ class PageSearcher:
             Причем, если поиск выполнялся ранее, то мы знаем общее кол-во страниц и также
             просматривать приходится фоток не более, чем при поиске 50-ти страниц
             (параметр SEARCH_CACHES_MEMORY_PAGE_STEP)
+
+            Поиск выполняется через планировщик (SearchScheduler): дорогие поиски без
+            сохраненной информации ограничены по числу одновременных, а по истечении
+            дедлайна возвращается частичная страница с приблизительным числом страниц
+            (такой результат не сохраняется в кэш)
+
+            Условия на диапазон по полю сортировки сужают поиск до отрезка первого списка
+
+        :param search_cache_key: ключ сохраненного поиска, взятый при чтении списков
+            (см. load_photo_lists_with_search_key)
         """
-        photo_cache = self.__photo_cache
-        search_info = CacheManager.get_search_cache(photo_request)
+        photo_hashes, search_info = self.search_photo_hashes(photo_request, ordered_conditions, ordered_photo_lists,
+                                                             search_cache_key)
+        res_list_photo_ids = [self.__photo_cache.get_photo_id_by_hash(hash_value) for hash_value in photo_hashes]
+        with self.__timings.stage('fetch_photos'):
+            res_list = self.__fetch_photos(res_list_photo_ids)
+
+        return Page(object_list=res_list, number=photo_request.page_number,
+                    paginator=CustomPaginator(num_pages=search_info.num_pages,
+                                              is_approximate=search_info.is_approximate))
+
+    def search_photo_hashes(self, photo_request: PhotosRequest, ordered_conditions, ordered_photo_lists,
+                            search_cache_key: str):
+        """Хэши фото страницы и информация о поиске (см. search_page_in_ordered_photo_lists):
+            поиск с сохраненной информацией, ее сохранение в кэш, без получения фото из БД
+
+        :return: tuple[list[tuple], SearchRequestInfo]
+        """
+        search_info = CacheManager.get_search_cache(search_cache_key)
         search_not_cached = search_info is None
-        searcher = self.__searcher_class(sorted_lists=ordered_photo_lists,
-                                         inclusion_indicators=[condition.inclusive for condition in ordered_conditions],
-                                         page_step=CacheManager.SEARCH_CACHES_MEMORY_PAGE_STEP)
+        metrics.inc('photo_likers_search_cache_misses_total' if search_not_cached
+                    else 'photo_likers_search_cache_hits_total')
+        searcher = self.__create_searcher(photo_request, ordered_conditions, ordered_photo_lists)
+
+        def search(compute_search_info, deadline):
+            return searcher.search_page(page_number=photo_request.page_number,
+                                        search_info=search_info,
+                                        compute_search_info=compute_search_info,
+                                        deadline=deadline)
 
-        photo_hashes, search_info = searcher.search_page(page_number=photo_request.page_number,
-                                                         search_info=search_info,
-                                                         compute_search_info=search_not_cached)
+        start = time.perf_counter()
+        with self.__timings.stage('search'):
+            photo_hashes, search_info = self.__scheduler.schedule(search, ordered_photo_lists, search_info)
+        self.__report_merge_stats(searcher)
+        self.__log_if_slow(photo_request, ordered_conditions, ordered_photo_lists, searcher,
+                           time.perf_counter() - start, search_not_cached, search_info.is_approximate)
 
-        if search_not_cached:
-            CacheManager.save_search_cache(photo_request, search_info)
+        if search_not_cached and not search_info.is_approximate:
+            CacheManager.save_search_cache(search_cache_key, search_info)
+        self.__last_search = (photo_request, ordered_photo_lists, search_info, search_cache_key)
+        return photo_hashes, search_info
 
-        # список фото получаем и переупорядочиваем одним запросом,
-        # чтобы не делать 20 запросов к БД
-        res_list_photo_ids = [photo_cache.get_photo_id_by_hash(hash_value) for hash_value in photo_hashes]
-        res_list = sorted(Photo.objects.filter(id__in=res_list_photo_ids).all(),
-                          key=lambda photo: res_list_photo_ids.index(photo.id))
+    def get_leaderboard_page(self, photo_request: PhotosRequest) -> Page:
+        """Страница без условий на теги при сортировке по лайкам
+            берется напрямую из живого рейтинга по лайкам
+        """
+        leaderboard = CacheManager.LIKES_LEADERBOARD
+        with self.__timings.stage('search'):
+            photo_hashes = leaderboard.get_page(photo_request.page_number)
+        res_list_photo_ids = [self.__photo_cache.get_photo_id_by_hash(hash_value) for hash_value in photo_hashes]
+        with self.__timings.stage('fetch_photos'):
+            res_list = leaderboard.get_photos(res_list_photo_ids, fetch_photos=self.__fetch_photos)
+        return Page(object_list=res_list, number=photo_request.page_number,
+                    paginator=CustomPaginator(num_pages=leaderboard.get_num_pages()))
 
+    def get_sharded_page(self, photo_request: PhotosRequest) -> Page:
+        """Страница из шардов индекса, разбитого по диапазонам id фото (см. ShardCoordinator)"""
+        include_tag_ids = [x.tag.id for x in photo_request.tags_conditions if x.inclusive] or [DummyTag().id]
+        exclude_tag_ids = [x.tag.id for x in photo_request.tags_conditions if not x.inclusive]
+        with self.__timings.stage('search'):
+            photo_hashes, num_pages = self.__shard_coordinator.search_page(
+                photo_request.sort_field.value, include_tag_ids, exclude_tag_ids, photo_request.page_number)
+        res_list_photo_ids = [self.__photo_cache.get_photo_id_by_hash(hash_value) for hash_value in photo_hashes]
+        with self.__timings.stage('fetch_photos'):
+            res_list = self.__fetch_photos(res_list_photo_ids)
         return Page(object_list=res_list, number=photo_request.page_number,
-                    paginator=CustomPaginator(num_pages=search_info.num_pages))
+                    paginator=CustomPaginator(num_pages=num_pages))
+
+    def refresh_search_info(self, photo_request: PhotosRequest) -> SearchRequestInfo:
+        """Полный пересчет и сохранение в кэш информации о поиске
+            (числа страниц и отметок) для запроса. Используется для прогрева кэша
+        """
+        ordered_conditions = self.plan_tag_conditions(photo_request)
+        ordered_photo_lists, search_cache_key = self.load_photo_lists_with_search_key(photo_request,
+                                                                                      ordered_conditions)
+        searcher = self.__create_searcher(photo_request, ordered_conditions, ordered_photo_lists)
+        _, search_info = searcher.search_page(page_number=1, compute_search_info=True)
+        CacheManager.save_search_cache(search_cache_key, search_info)
+        return search_info
+
+    def get_facet_counts(self, photo_request: PhotosRequest, tags, max_found: int = FACET_COUNTS_MAX_FOUND) \
+            -> FacetCounts:
+        """Число результатов для ссылок на добавление условий на теги (см. FacetCounter).
+            Считается по найденным фото из информации о поиске, с которой была найдена страница
+            запроса (get_pagination_by_request), один раз для запроса и хранится вместе с ней.
+            Отдельный поиск не выполняется: если страница найдена без поиска по спискам
+            (рейтинг по лайкам, шарды) или поиск был приблизительным, чисел нет (None).
+            Для широких запросов (найдено больше max_found фото) числа тоже не считаются
+
+        :param tags: iterable[Tag]
+        """
+        if self.__last_search is None or self.__last_search[0] is not photo_request:
+            return None
+        _, ordered_photo_lists, search_info, search_cache_key = self.__last_search
+        if search_info.is_approximate:
+            return None
+        if search_info.facet_counts is not None:
+            return search_info.facet_counts
+        if search_info.matches is None and len(ordered_photo_lists) > 1:
+            return None
+
+        main_list = ordered_photo_lists[0]
+        if search_info.matches is not None:
+            if len(search_info.matches) > max_found:
+                return None
+            result_hashes = (main_list[position] for position in search_info.matches)
+        else:
+            start, end = self.get_sort_field_bounds(photo_request, main_list) or (0, len(main_list) - 1)
+            if end - start > max_found:
+                return None
+            result_hashes = main_list[start:end]
+        search_info.facet_counts = FacetCounter(self.__photo_cache).count(result_hashes, tags)
+        CacheManager.save_search_cache(search_cache_key, search_info)
+        return search_info.facet_counts
+
+    @staticmethod
+    def __is_shardable_request(photo_request: PhotosRequest) -> bool:
+        """Шарды ищут только по условиям на отдельные теги. Шард - неизменный снимок индекса,
+            в котором не меняются лайки, поэтому запросы с сортировкой по лайкам идут в живой индекс
+        """
+        return photo_request.sort_field == SortType.dates and len(photo_request.range_filters) == 0 and \
+            photo_request.get_liked_condition() is None and \
+            all(isinstance(x, TagCondition) for x in photo_request.tags_conditions)
+
+    def __create_searcher(self, photo_request, ordered_conditions, ordered_photo_lists):
+        return self.__searcher_class(sorted_lists=ordered_photo_lists,
+                                     inclusion_indicators=[condition.inclusive for condition in ordered_conditions],
+                                     page_step=CacheManager.SEARCH_CACHES_MEMORY_PAGE_STEP,
+                                     bounds=self.get_sort_field_bounds(photo_request, ordered_photo_lists[0]))
+
+    @staticmethod
+    def get_sort_field_bounds(photo_request: PhotosRequest, main_list):
+        """Отрезок [start, end) первого списка по условиям на диапазон по полю сортировки
+            или None, если таких условий нет"""
+        res = None
+        for range_filter in photo_request.range_filters:
+            if range_filter.field != photo_request.sort_field.value:
+                continue
+            start, end = range_filter.get_bounds(main_list)
+            if res is not None:
+                start, end = max(res[0], start), min(res[1], end)
+            res = (start, max(start, end))
+        return res
+
+    @staticmethod
+    def get_plan_key(ordered_conditions) -> str:
+        """Ключ плана поиска: условия в порядке обхода списков"""
+        return ",".join(condition.key() for condition in ordered_conditions)
+
+    @staticmethod
+    def get_plan(ordered_conditions, ordered_photo_lists):
+        """Описание плана поиска: списки в порядке обхода и их длины"""
+        plan = []
+        for condition, photo_list in zip(ordered_conditions, ordered_photo_lists):
+            if isinstance(condition, RangeFilter):
+                step = {'range': condition.key()}
+            elif isinstance(condition, TagOrGroup):
+                step = {'tags': [tag.id for tag in condition.tags]}
+            elif isinstance(condition, TagPairCondition):
+                step = {'pair': [tag.id for tag in condition.tags]}
+            else:
+                step = {'tag': condition.tag.id}
+            step.update(inclusive=condition.inclusive, size=len(photo_list) - 1)
+            plan.append(step)
+        return plan
+
+    @staticmethod
+    def __report_merge_stats(searcher):
+        merge_stats = getattr(searcher, 'merge_stats', None)
+        if merge_stats is not None:
+            metrics.inc('photo_likers_merge_iterations_total', merge_stats.iterations)
+            metrics.inc('photo_likers_merge_gallop_searches_total', merge_stats.gallop_searches)
+            metrics.inc('photo_likers_merge_elements_scanned_total', merge_stats.elements_scanned)
+
+    def __log_if_slow(self, photo_request, ordered_conditions, ordered_photo_lists, searcher, seconds: float,
+                      search_not_cached: bool, is_approximate: bool):
+        if not self.__slow_log.is_slow(seconds):
+            return
+        liked_condition = photo_request.get_liked_condition()
+        self.__slow_log.record(sort_field=photo_request.sort_field.value,
+                               tag_keys=[condition.key() for condition in photo_request.tags_conditions],
+                               range_keys=[range_filter.key() for range_filter in photo_request.range_filters],
+                               page_number=photo_request.page_number,
+                               plan=self.get_plan(ordered_conditions, ordered_photo_lists),
+                               merge_stats=getattr(searcher, 'merge_stats', None), seconds=seconds,
+                               search_cached=not search_not_cached, is_approximate=is_approximate,
+                               user_id=liked_condition.tag.user_id if liked_condition is not None else None)
+
+    @staticmethod
+    def __is_leaderboard_request(photo_request: PhotosRequest) -> bool:
+        return photo_request.sort_field == SortType.likes and len(photo_request.tags_conditions) == 0 \
+               and len(photo_request.range_filters) == 0 and CacheManager.LIKES_LEADERBOARD.is_loaded
+
+    @staticmethod
+    def __fetch_photos(photo_ids):
+        """Список фото получаем и переупорядочиваем одним запросом,
+            чтобы не делать 20 запросов к БД"""
+        return sorted(Photo.objects.filter(id__in=photo_ids).all(),
+                      key=lambda photo: photo_ids.index(photo.id))
 
     @staticmethod
     def __is_checkpoint(searcher):
         return searcher.cnt_found % (PHOTOS_PER_PAGE * CacheManager.SEARCH_CACHES_MEMORY_PAGE_STEP) == 0
 
+    def plan_tag_conditions(self, photo_request: PhotosRequest, pair_index: TagPairIndex = tag_pair_index):
+        """Порядок обхода списков (см. order_tag_conditions), в котором пары тегов без построенного
+            пересечения заменены двумя условиями: пересечение строится в фоне, а поиск пока
+            мержит списки тегов пары
+        """
+        photo_cache = self.__photo_cache
+        res = []
+        for condition in self.order_tag_conditions(photo_request, pair_index=pair_index):
+            if not isinstance(condition, TagPairCondition) or photo_cache.has_pair_list(condition):
+                res.append(condition)
+                continue
+            pair_cache = photo_cache.at_version(photo_cache.version)
+            self.__list_builder.build_in_background(pair_cache.get_pair_cache_key(condition),
+                                                    lambda pair=condition: pair_cache.get_pair_list(pair),
+                                                    lambda pair=condition: pair_cache.load_pair_list(pair))
+            res.extend(TagCondition(tag=tag, inclusive=True) for tag in condition.tags)
+        return res
+
     @staticmethod
-    def __order_tag_conditions(photo_request):
+    def order_tag_conditions(photo_request, pair_index: TagPairIndex = tag_pair_index):
+        """Порядок обхода списков: готовые пересечения пар тегов, включающие теги, исключающие теги.
+            Условия на диапазон по полю, отличному от поля сортировки, - включающие списки:
+            без включающих тегов первым идет такой список вместо списка всех фото (DummyTag)
+        """
         ordered_conditions = sorted(photo_request.tags_conditions, key=lambda x: x.key(), reverse=True)
         """ @:type list[TagCondition] """
+        ordered_conditions = pair_index.plan(ordered_conditions)
+        range_conditions = [range_filter for range_filter in photo_request.range_filters
+                            if range_filter.field != photo_request.sort_field.value]
         if len(ordered_conditions) == 0 or not ordered_conditions[0].inclusive:
-            ordered_conditions.insert(0, TagCondition(tag=DummyTag(), inclusive=True))
+            ordered_conditions[0:0] = range_conditions or [TagCondition(tag=DummyTag(), inclusive=True)]
+        else:
+            ordered_conditions[1:1] = range_conditions
         return ordered_conditions
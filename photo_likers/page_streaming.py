@@ -0,0 +1,36 @@
+from django.core.cache import cache
+from django.template.loader import get_template, render_to_string
+from photo_likers.page_searcher import PageSearcher
+from photo_likers.settings import STREAM_HEAD_CACHE_SECONDS, STREAM_HEAD_CACHE_TEMPLATE_KEY
+from photo_likers.utils.photo_request import PhotosRequest
+
+STREAM_PARAMETER = 'stream'
+PAGE_TAIL = "\n</body>\n</html>\n"
+
+
+def get_page_head(context: dict) -> str:
+    """Начало страницы до пагинации (шапка, сортировка и ссылки на теги).
+        Не зависит от поиска и пользователя, поэтому кэшируется"""
+    key = STREAM_HEAD_CACHE_TEMPLATE_KEY.format("|".join(
+        str(context[name]) for name in ['sort_field', 'tags_list', 'page_number', 'range_query']))
+    head = cache.get(key)
+    if head is None:
+        head = render_to_string('photos_head.html', context)
+        cache.set(key, head, STREAM_HEAD_CACHE_SECONDS)
+    return head
+
+
+def stream_photos_page(request, page_searcher: PageSearcher, photo_request: PhotosRequest, context: dict):
+    """Части страницы с фото по мере готовности: шапка - до поиска, пагинация - после поиска,
+        дальше по одному фото, так что страница целиком не собирается в памяти
+
+    :param context: dict контекст шаблона photos.html без фото
+    """
+    yield get_page_head(context)
+    page = page_searcher.get_pagination_by_request(photo_request)
+    context = dict(context, photos=page)
+    yield render_to_string('photos_pagination.html', context, request)
+    figure_template = get_template('photo_figure.html')
+    for photo in page:
+        yield figure_template.render(dict(context, photo=photo), request)
+    yield PAGE_TAIL
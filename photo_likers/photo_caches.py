@@ -1,10 +1,17 @@
 from datetime import datetime, date
-from django.core.cache import cache
+from django.core.cache import caches
+from photo_likers.index_memory import IndexMemoryManager
 from photo_likers.models import Photo, Tag
-from photo_likers.settings import LIKES_CACHE_TEMPLATE_KEY, DATE_CACHE_TEMPLATE_KEY
+from photo_likers.settings import LIKES_CACHE_TEMPLATE_KEY, DATE_CACHE_TEMPLATE_KEY, INDEX_CACHE_ALIAS, \
+    INDEX_COMPRESSED_LISTS, RANGE_CACHE_TEMPLATE_KEY, UNION_CACHE_TEMPLATE_KEY, PAIR_CACHE_TEMPLATE_KEY
+from photo_likers.utils.compressed_posting_list import CompressedPostingList
 from photo_likers.utils.dummy_tag import DummyTag
+from photo_likers.utils.sorted_list_utils import reversed_list_replace, sorted_list_union, sorted_list_merge, \
+    find_place_in_reversed_list
+from photo_likers.utils.tag_condition import TagCondition
 
 PHOTO_KEY = 'photo'
+index_cache = caches[INDEX_CACHE_ALIAS]
 
 
 class SortedPhotoCacheBase:
@@ -14,12 +21,37 @@ class SortedPhotoCacheBase:
        чтобы обновлять соответственно и кэши
     """
     sort_field = None  # type: int
+    # учет памяти под списки тегов всех видов сортировки
+    INDEX_MEMORY = IndexMemoryManager()
+    # загруженные производные списки (условия на диапазоны, объединения и пересечения тегов):
+    # ключ -> (вид сортировки, версия индекса, условие на диапазон или None).
+    # Изменения лайков применяются к ним как к спискам тегов, а удаляются только списки
+    # диапазонов лайков, состав которых изменился (см. drop_derived_lists)
+    DERIVED_LIST_KEYS = {}  # type: dict[str, tuple]
+    # опубликованная версия индекса: новая версия строится рядом с текущей
+    # и публикуется заменой этого номера (см. CacheManager.load_photos_cache)
+    INDEX_VERSION = 0
+    # ключи кэша индекса по версиям - для удаления старых версий
+    VERSION_KEYS = {}  # type: dict[int, set[str]]
+
+    def __init__(self, version: int = None):
+        """:param version: версия индекса, из которой читает и в которую пишет объект
+            (None - всегда опубликованная версия)"""
+        self.__version = version
+
+    @property
+    def version(self) -> int:
+        return self.__version if self.__version is not None else SortedPhotoCacheBase.INDEX_VERSION
+
+    def at_version(self, version: int):
+        """Кэш того же вида сортировки, закрепленный за версией индекса
+            (запрос читает все списки из одной версии, даже если за время поиска опубликована новая)"""
+        return type(self)(version=version)
 
     def get_photo_hashes_for_tag(self, tag_id: int):
-        return cache.get(self.get_tag_cache_key(tag_id))[PHOTO_KEY]
+        return index_cache.get(self.get_tag_cache_key(tag_id))[PHOTO_KEY]
 
-    @staticmethod
-    def get_tag_cache_key(tag_id: int) -> str:
+    def get_tag_cache_key(self, tag_id: int) -> str:
         raise NotImplementedError("Not implemented!")
 
     @staticmethod
@@ -43,31 +75,287 @@ class SortedPhotoCacheBase:
         """
         for condition in tag_conditions:
             key = self.get_tag_cache_key(condition.tag.id)
-            if key not in cache:
+            tag_res = index_cache.get(key)
+            if tag_res is None:
+                self.INDEX_MEMORY.note_miss(key)
                 tag = Tag.objects.get(id=condition.tag.id) if DummyTag().id != condition.tag.id else DummyTag()
                 snapshot_date = datetime.now()
                 tag_photos = tag.photo_set.filter(created_date__lte=snapshot_date)
                 yield self.load_one_tag_cache(tag=tag, tag_photos=tag_photos, snapshot_date=snapshot_date)
             else:
-                yield cache.get(key)[PHOTO_KEY]
+                self.INDEX_MEMORY.touch(key)
+                yield tag_res[PHOTO_KEY]
 
-    def load_one_tag_cache(self, tag: Tag, tag_photos: list, snapshot_date: datetime):
+    def load_one_tag_cache(self, tag: Tag, tag_photos: list, snapshot_date: datetime,
+                           compressed: bool = INDEX_COMPRESSED_LISTS):
         tag_photo_hashes = sorted([self.get_photo_hash(photo) for photo in tag_photos], reverse=True)
         # добавляем фиктивное значение в конец списка,
         # чтобы не проверять при поиске на каждой итерации
         tag_photo_hashes.append(self.get_min_hash())
+        return self.save_tag_list(tag_id=tag.id, tag_photo_hashes=tag_photo_hashes, snapshot_date=snapshot_date,
+                                  compressed=compressed)
+
+    def save_tag_list(self, tag_id: int, tag_photo_hashes: list, snapshot_date: datetime,
+                      compressed: bool = INDEX_COMPRESSED_LISTS):
+        """Запись готового упорядоченного списка тега (с фиктивным значением в конце) в кэш индекса"""
+        if compressed:
+            tag_photo_hashes = CompressedPostingList.from_sorted(tag_photo_hashes)
         tag_res = {'snapshot': snapshot_date, PHOTO_KEY: tag_photo_hashes}
-        cache.set(self.get_tag_cache_key(tag.id), tag_res)
+        key = self.get_tag_cache_key(tag_id)
+        index_cache.set(key, tag_res)
+        self.__account_list(key, tag_photo_hashes, pinned=tag_id == DummyTag().id)
         return tag_photo_hashes
 
+    def get_indexed_hashes(self, photos):
+        """Хэши фото в том виде, в каком они сейчас в индексе этой версии (в списке DummyTag):
+            лайки в БД и в индексе могут расходиться (изменения применяются к индексу после
+            сохранения пачки, версия из снимка дополняется изменениями после снимка).
+            Хэш по полям фото проверяется поиском места в списке, а для фото с другим хэшем
+            список просматривается один раз. Фото, которых нет в индексе, пропускаются
+
+        :param photos: iterable[Photo]
+        :return: list[tuple]
+        """
+        all_photos_list = next(self.load_necessary_caches(
+            tag_conditions=[TagCondition(tag=DummyTag(), inclusive=True)]))
+        res = []
+        changed_photo_ids = set()
+        for photo in photos:
+            hash_value = self.get_photo_hash(photo)
+            if self.__contains_hash(all_photos_list, hash_value):
+                res.append(hash_value)
+            else:
+                changed_photo_ids.add(photo.id)
+        if len(changed_photo_ids) > 0:
+            res.extend(hash_value for hash_value in all_photos_list
+                       if self.get_photo_id_by_hash(hash_value) in changed_photo_ids)
+        return res
+
+    def load_range_list(self, range_filter, field_cache):
+        """Список всех фото из диапазона по полю другого вида сортировки (как список тега).
+            Фото из диапазона - отрезок списка DummyTag в кэше field_cache
+
+        :param range_filter: RangeFilter
+        :param field_cache: SortedPhotoCacheBase кэш, упорядоченный по полю диапазона (той же версии)
+        :return: list[tuple]
+        """
+        key = RANGE_CACHE_TEMPLATE_KEY.format(self.sort_field, range_filter.key(), self.version)
+        tag_res = self.__get_derived_list(key)
+        if tag_res is not None:
+            return tag_res
+
+        all_photos_condition = [TagCondition(tag=DummyTag(), inclusive=True)]
+        field_list = next(field_cache.load_necessary_caches(tag_conditions=all_photos_condition))
+        start, end = range_filter.get_bounds(field_list)
+        photo_ids = {field_cache.get_photo_id_by_hash(hash_value) for hash_value in field_list[start:end]}
+        all_photos_list = next(self.load_necessary_caches(tag_conditions=all_photos_condition))
+        range_photo_hashes = [hash_value for hash_value in all_photos_list
+                              if self.get_photo_id_by_hash(hash_value) in photo_ids]
+        range_photo_hashes.append(self.get_min_hash())
+        return self.__save_derived_list(key, range_photo_hashes, range_filter)
+
+    def get_union_cache_key(self, tag_group) -> str:
+        return UNION_CACHE_TEMPLATE_KEY.format(self.sort_field, tag_group.key(), self.version)
+
+    def get_union_list(self, tag_group):
+        """Построенное объединение списков тегов группы или None"""
+        return self.__get_derived_list(self.get_union_cache_key(tag_group))
+
+    def load_union_list(self, tag_group):
+        """Объединение списков тегов группы "хотя бы один из тегов"
+
+        :param tag_group: TagOrGroup
+        :return: list[tuple]
+        """
+        key = self.get_union_cache_key(tag_group)
+        tag_res = self.__get_derived_list(key)
+        if tag_res is not None:
+            return tag_res
+        return self.__save_derived_list(key, self.merge_union_list(tag_group))
+
+    def merge_union_list(self, tag_group):
+        """Объединение списков тегов группы без сохранения в кэш индекса
+
+        :param tag_group: TagOrGroup
+        :return: list[tuple]
+        """
+        tag_lists = list(self.load_necessary_caches(
+            tag_conditions=[TagCondition(tag=tag, inclusive=True) for tag in tag_group.tags]))
+        return sorted_list_union(tag_lists)
+
+    def get_pair_cache_key(self, tag_pair) -> str:
+        return PAIR_CACHE_TEMPLATE_KEY.format(self.sort_field, tag_pair.key(), self.version)
+
+    def get_pair_list(self, tag_pair):
+        """Построенное пересечение списков пары тегов или None"""
+        return self.__get_derived_list(self.get_pair_cache_key(tag_pair))
+
+    def has_pair_list(self, tag_pair) -> bool:
+        """Построено ли пересечение пары (без чтения списка)"""
+        return index_cache.has_key(self.get_pair_cache_key(tag_pair))
+
+    def load_pair_list(self, tag_pair):
+        """Пересечение списков пары включающих тегов
+
+        :param tag_pair: TagPairCondition
+        :return: list[tuple]
+        """
+        key = self.get_pair_cache_key(tag_pair)
+        tag_res = self.__get_derived_list(key)
+        if tag_res is not None:
+            return tag_res
+        tag_lists = list(self.load_necessary_caches(
+            tag_conditions=[TagCondition(tag=tag, inclusive=True) for tag in tag_pair.tags]))
+        pair_photo_hashes = [value for value, _ in sorted_list_merge(tag_lists, [True] * len(tag_lists))]
+        pair_photo_hashes.append(self.get_min_hash())
+        return self.__save_derived_list(key, pair_photo_hashes)
+
+    @staticmethod
+    def drop_derived_lists(likes_changes=None) -> int:
+        """Удаление производных списков (при изменении значений полей фото).
+            При изменении лайков удаляются только списки условий на диапазон лайков,
+            из диапазона которых фото вышли или в который вошли: состав остальных списков
+            от лайков не зависит, и хэши в них меняются apply_derived_hash_changes
+
+        :param likes_changes: dict[int, tuple[int, int]] id фото -> (старое, новое число лайков);
+            None - удаляются все производные списки
+        :return: число удаленных списков
+        """
+        keys = [key for key, (_, _, range_filter) in list(SortedPhotoCacheBase.DERIVED_LIST_KEYS.items())
+                if likes_changes is None or SortedPhotoCacheBase.__is_changed_by_likes(range_filter, likes_changes)]
+        for key in keys:
+            SortedPhotoCacheBase.DERIVED_LIST_KEYS.pop(key, None)
+        index_cache.delete_many(keys)
+        for key in keys:
+            SortedPhotoCacheBase.INDEX_MEMORY.discard(key)
+        return len(keys)
+
+    @staticmethod
+    def register_index_key(key: str, version: int):
+        """Учет ключа кэша индекса версии (для удаления вместе с версией)"""
+        SortedPhotoCacheBase.VERSION_KEYS.setdefault(version, set()).add(key)
+
+    @staticmethod
+    def drop_index_versions(keep_version: int) -> int:
+        """Удаление всех значений кэша индекса версий, кроме keep_version
+            (в том числе дозагруженных запросами, начатыми на старой версии)
+
+        :return: число удаленных ключей
+        """
+        keys = []
+        for version in [x for x in SortedPhotoCacheBase.VERSION_KEYS if x != keep_version]:
+            keys.extend(SortedPhotoCacheBase.VERSION_KEYS.pop(version))
+        index_cache.delete_many(keys)
+        for key in keys:
+            SortedPhotoCacheBase.INDEX_MEMORY.discard(key)
+            SortedPhotoCacheBase.DERIVED_LIST_KEYS.pop(key, None)
+        return len(keys)
+
+    @staticmethod
+    def __is_changed_by_likes(range_filter, likes_changes) -> bool:
+        return range_filter is not None and range_filter.field == SortedPhotoLikeCache.sort_field and any(
+            range_filter.contains(old_likes_cnt) != range_filter.contains(new_likes_cnt)
+            for old_likes_cnt, new_likes_cnt in likes_changes.values())
+
+    def apply_hash_changes(self, tag_id: int, hash_changes):
+        """Замена хэшей фото в загруженном кэше тега одним изменением
+
+        :param tag_id: int
+        :param hash_changes: list[tuple[tuple, tuple]] пары (старый хэш, новый хэш)
+        """
+        key = self.get_tag_cache_key(tag_id)
+        tag_res = index_cache.get(key)
+        if tag_res is None:
+            return
+        # новый хэш тоже удаляется: повторное применение изменения не добавит фото второй раз
+        # (изменения, накопленные за время построения версии, могут уже быть в ней)
+        tag_res[PHOTO_KEY] = reversed_list_replace(tag_res[PHOTO_KEY],
+                                                   removed_values=[hash_value for change in hash_changes
+                                                                   for hash_value in change],
+                                                   added_values=[new_hash for _, new_hash in hash_changes])
+        index_cache.set(key, tag_res)
+        self.__account_list(key, tag_res[PHOTO_KEY])
+
+    def apply_derived_hash_changes(self, hash_changes):
+        """Замена хэшей фото в загруженных производных списках этого вида сортировки и версии,
+            в которых есть фото из изменений (кроме списков диапазонов по тому же полю:
+            их состав меняется, и они удаляются drop_derived_lists)
+
+        :param hash_changes: list[tuple[tuple, tuple]] пары (старый хэш, новый хэш)
+        """
+        for key, (sort_field, version, range_filter) in list(SortedPhotoCacheBase.DERIVED_LIST_KEYS.items()):
+            if sort_field != self.sort_field or version != self.version \
+                    or (range_filter is not None and range_filter.field == self.sort_field):
+                continue
+            tag_res = index_cache.get(key)
+            if tag_res is None:
+                continue
+            photo_hashes = tag_res[PHOTO_KEY]
+            list_changes = [change for change in hash_changes
+                            if any(self.__contains_hash(photo_hashes, hash_value) for hash_value in change)]
+            if len(list_changes) == 0:
+                continue
+            tag_res[PHOTO_KEY] = reversed_list_replace(photo_hashes,
+                                                       removed_values=[hash_value for change in list_changes
+                                                                       for hash_value in change],
+                                                       added_values=[new_hash for _, new_hash in list_changes])
+            index_cache.set(key, tag_res)
+            self.__account_list(key, tag_res[PHOTO_KEY])
+
+    @staticmethod
+    def __contains_hash(photo_hashes, hash_value: tuple) -> bool:
+        return photo_hashes[find_place_in_reversed_list(hash_value, photo_hashes, 0)] == hash_value
+
+    def get_index_value(self, key: str):
+        """Значение кэша индекса с учетом обращения (None, если его нет)"""
+        value = index_cache.get(key)
+        if value is None:
+            self.INDEX_MEMORY.note_miss(key)
+        else:
+            self.INDEX_MEMORY.touch(key)
+        return value
+
+    def save_index_value(self, key: str, value, size_bytes: int):
+        """Запись в кэш индекса значения этой версии, которое не является списком тега
+            (например, битовой маски тега), с учетом его размера в бюджете памяти"""
+        index_cache.set(key, value)
+        self.register_index_key(key, self.version)
+        evicted_keys = self.INDEX_MEMORY.add_bytes(key, size_bytes)
+        if len(evicted_keys) > 0:
+            index_cache.delete_many(evicted_keys)
+
+    def __get_derived_list(self, key: str):
+        tag_res = index_cache.get(key)
+        if tag_res is None:
+            self.INDEX_MEMORY.note_miss(key)
+            return None
+        self.INDEX_MEMORY.touch(key)
+        return tag_res[PHOTO_KEY]
+
+    def __save_derived_list(self, key: str, photo_hashes, range_filter=None):
+        if INDEX_COMPRESSED_LISTS and type(photo_hashes) is list:
+            photo_hashes = CompressedPostingList.from_sorted(photo_hashes)
+        index_cache.set(key, {'snapshot': datetime.now(), PHOTO_KEY: photo_hashes})
+        SortedPhotoCacheBase.DERIVED_LIST_KEYS[key] = (self.sort_field, self.version, range_filter)
+        self.__account_list(key, photo_hashes)
+        return photo_hashes
+
+    def __account_list(self, key: str, tag_photo_hashes, pinned: bool = False):
+        """Учет размера списка и вытеснение холодных списков при превышении бюджета памяти.
+            Закрепляются только списки опубликованной или строящейся версии"""
+        self.register_index_key(key, self.version)
+        pinned = pinned and self.version >= SortedPhotoCacheBase.INDEX_VERSION
+        evicted_keys = self.INDEX_MEMORY.add(key, tag_photo_hashes, pinned=pinned)
+        if len(evicted_keys) > 0:
+            index_cache.delete_many(evicted_keys)
+
 
 class SortedPhotoLikeCache(SortedPhotoCacheBase):
     """Класс для работы с кэшем по фото для сортировки по лайкам"""
     sort_field = 0  # type: int
 
-    @staticmethod
-    def get_tag_cache_key(tag_id: int) -> str:
-        return LIKES_CACHE_TEMPLATE_KEY.format(tag_id)
+    def get_tag_cache_key(self, tag_id: int) -> str:
+        return LIKES_CACHE_TEMPLATE_KEY.format(tag_id, self.version)
 
     @staticmethod
     def get_photo_hash(photo: Photo) -> tuple:
@@ -79,9 +367,8 @@ class SortedPhotoDateCache(SortedPhotoCacheBase):
     sort_field = 1  # type: int
     SMALL_DATE = date(year=1, month=1, day=1)
 
-    @staticmethod
-    def get_tag_cache_key(tag_id: int) -> str:
-        return DATE_CACHE_TEMPLATE_KEY.format(tag_id)
+    def get_tag_cache_key(self, tag_id: int) -> str:
+        return DATE_CACHE_TEMPLATE_KEY.format(tag_id, self.version)
 
     @staticmethod
     def get_photo_hash(photo: Photo) -> tuple:
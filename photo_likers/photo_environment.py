@@ -1,7 +1,11 @@
-import pandas as pd
+from django.core.management.color import no_style
+from django.db import connection
+from django.db.models import Max
 
 from .models import Photo, Tag
 
+BULK_CREATE_BATCH_SIZE = 5000
+
 
 class PhotoEnvironment:
     """Генерация данных по фото для тестирования
@@ -22,34 +26,47 @@ class PhotoEnvironment:
         return res
 
     def setup_photos(self, cnt: int, likes_function, date_function, tags_function=None):
-        """:return: list[Photo]"""
-
-        def get_photo_from_dict(row: dict, i: int):
-            return Photo(path=row['src'], created_date=date_function(i), likes_cnt=likes_function(i))
-
-        def create_photo(row: dict, i: int):
-            photo = get_photo_from_dict(row, i)
-            photo.save()
-            if tags_function is not None:
-                photo.tags.add(*tags_function(photo))
-
-            return photo
+        """Фото создаются пачками через bulk_create с заранее выданными id,
+            чтобы tags_function могла использовать id фото, а связи с тегами
+            тоже вставлялись пачками
 
+        :return: list[Photo]
+        """
+        # pandas нужен только для генерации данных и не импортируется вместе с приложением
+        import pandas as pd
         df_photos = pd.read_csv(self.SAMPLE_PHOTOS_PATH, sep=';', parse_dates=True, infer_datetime_format=True)
-        if len(df_photos) > cnt:
-            df_photos = df_photos.iloc[:cnt, :]
+        paths = [str(x).strip('"') for x in df_photos['src'][:cnt]]
+        if cnt > len(paths):
+            paths.extend(str(x).strip('"') for x in df_photos['src'].sample(cnt - len(paths), replace=True))
 
-        df_photos = df_photos.applymap(lambda x: str(x).strip('"'))
+        start_id = (Photo.objects.aggregate(Max('id'))['id__max'] or 0) + 1
+        res = [Photo(id=start_id + i, path=path, created_date=date_function(i), likes_cnt=likes_function(i))
+               for i, path in enumerate(paths)]
+        self.save_photos(res, tags_function)
+        return res
 
-        res = []
-        i = 0
-        for id, row in df_photos.iterrows():
-            res.append(create_photo(row, i))
-            i += 1
+    @staticmethod
+    def save_photos(photos, tags_function=None, batch_size: int = BULK_CREATE_BATCH_SIZE):
+        """Сохранение фото с заданными id и их связей с тегами пачками
 
-        if cnt > len(res):
-            for id, row in df_photos.sample(cnt - len(res), replace=True).iterrows():
-                res.append(create_photo(row, i))
-                i += 1
+        :param photos: list[Photo]
+        :param tags_function: callable(Photo) -> list[Tag] (повторы тегов фото сохраняются один раз)
+        """
+        photo_tag_model = Photo.tags.through
+        for start in range(0, len(photos), batch_size):
+            batch = photos[start:start + batch_size]
+            Photo.objects.bulk_create(batch)
+            if tags_function is not None:
+                photo_tag_model.objects.bulk_create(
+                    [photo_tag_model(photo_id=photo.id, tag_id=tag_id)
+                     for photo in batch for tag_id in sorted({tag.id for tag in tags_function(photo)})])
+        PhotoEnvironment.reset_photo_sequences()
 
-        return res
+    @staticmethod
+    def reset_photo_sequences():
+        """После вставки с явными id сдвигаем последовательности id (нужно, например, для PostgreSQL)"""
+        sequence_sql = connection.ops.sequence_reset_sql(no_style(), [Photo])
+        if len(sequence_sql) > 0:
+            with connection.cursor() as cursor:
+                for sql in sequence_sql:
+                    cursor.execute(sql)
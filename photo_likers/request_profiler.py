@@ -0,0 +1,99 @@
+import cProfile
+import io
+import marshal
+import pstats
+import threading
+import time
+import uuid
+from collections import OrderedDict
+from photo_likers.settings import PROFILER_MIN_INTERVAL_SECONDS, PROFILER_MAX_STORED
+
+PROFILE_QUERY_PARAMETER = 'profile'
+PROFILE_HEADER = 'HTTP_X_PROFILE'
+
+
+class RequestProfiler:
+    """Профилирование (cProfile) поиска страницы для отдельных запросов.
+
+       Включается только для персонала флагом ?profile=1 или заголовком X-Profile: 1,
+       одновременно выполняется не более одного профилирования и не чаще раза
+       в min_interval_seconds, поэтому обычные запросы не замедляются.
+       Результаты хранятся в памяти процесса (последние max_stored) в формате pstats
+       и могут быть скачаны по id.
+    """
+
+    def __init__(self, min_interval_seconds: float = PROFILER_MIN_INTERVAL_SECONDS,
+                 max_stored: int = PROFILER_MAX_STORED):
+        self.min_interval_seconds = min_interval_seconds
+        self.max_stored = max_stored
+        self.__lock = threading.Lock()
+        self.__running = False
+        self.__last_start = None  # type: float
+        self.__profiles = OrderedDict()  # type: dict[str, dict]
+
+    @staticmethod
+    def is_requested(request) -> bool:
+        flag = request.GET.get(PROFILE_QUERY_PARAMETER) or request.META.get(PROFILE_HEADER)
+        return flag == '1' and request.user.is_authenticated and request.user.is_staff
+
+    def try_start(self) -> bool:
+        """Разрешение на профилирование с учетом ограничения частоты"""
+        with self.__lock:
+            now = time.monotonic()
+            if self.__running or \
+                    (self.__last_start is not None and now - self.__last_start < self.min_interval_seconds):
+                return False
+            self.__running = True
+            self.__last_start = now
+            return True
+
+    def profile(self, name: str, func, *args, **kwargs):
+        """Вызов func под профилировщиком (после успешного try_start)
+
+        :return: tuple(результат func, id профиля)
+        """
+        profiler = cProfile.Profile()
+        try:
+            res = profiler.runcall(func, *args, **kwargs)
+        finally:
+            profiler.create_stats()
+            profile_id = self.__save(name, profiler.stats)
+            with self.__lock:
+                self.__running = False
+        return res, profile_id
+
+    def get_stats_dump(self, profile_id: str) -> bytes:
+        """Профиль в формате pstats (как Profile.dump_stats) или None"""
+        profile = self.__profiles.get(profile_id)
+        return marshal.dumps(profile['stats']) if profile is not None else None
+
+    def get_stats_text(self, profile_id: str, sort_key: str = 'cumulative', limit: int = 50) -> str:
+        profile = self.__profiles.get(profile_id)
+        if profile is None:
+            return None
+        if sort_key not in pstats.Stats.sort_arg_dict_default:
+            sort_key = 'cumulative'
+        stream = io.StringIO()
+        stats = pstats.Stats(stream=stream)
+        stats.stats = profile['stats']
+        stats.get_top_level_stats()
+        stream.write('{0}\n'.format(profile['name']))
+        stats.sort_stats(sort_key).print_stats(limit)
+        return stream.getvalue()
+
+    def get_profiles(self):
+        """:return: list[tuple[str, str, float]] id, название и время профилей, новые первыми"""
+        with self.__lock:
+            return [(profile_id, profile['name'], profile['time'])
+                    for profile_id, profile in reversed(list(self.__profiles.items()))]
+
+    def __save(self, name: str, stats) -> str:
+        profile_id = uuid.uuid4().hex
+        with self.__lock:
+            self.__profiles[profile_id] = {'name': name, 'time': time.time(), 'stats': stats}
+            while len(self.__profiles) > self.max_stored:
+                self.__profiles.popitem(last=False)
+        return profile_id
+
+
+request_profiler = RequestProfiler()
@@ -4,25 +4,49 @@ import django
 os.environ.setdefault("DJANGO_SETTINGS_MODULE", "PhotoLikers.settings")
 django.setup()
 
+import argparse
+import pandas as pd
 from photo_likers.photo_environment import PhotoEnvironment
+from photo_likers.sample_generator import SampleDataGenerator, LIKES_UNIFORM, LIKES_ZIPF
 from photo_likers.models import Photo, Tag
-from random import randint, sample
-from datetime import datetime, timedelta
-
-if __name__ == "__main__":
-    env = PhotoEnvironment()
-    Photo.objects.all().delete()
-    Tag.objects.all().delete()
-    env.SAMPLE_PHOTOS_PATH = 'data\\test-photo.csv'
-    tags = env.setup_tags(cnt=100, name_function=lambda i: i)
 
 
-    # def tag_suit_photo(x, y): return x.id % 10 == y.id % 10
+def parse_args():
+    parser = argparse.ArgumentParser(description="Fill the database with sample liked and tagged photos")
+    parser.add_argument('--photos', type=int, default=1000000, help="number of photos")
+    parser.add_argument('--tags', type=int, default=100, help="number of tags")
+    parser.add_argument('--tags-per-photo', type=int, default=5)
+    parser.add_argument('--tag-block-size', type=int, default=10, help="photos get tags from one block of tags")
+    parser.add_argument('--tag-skew', type=float, default=0.0, help="0 - uniform choice of tags in a block")
+    parser.add_argument('--likes', choices=[LIKES_UNIFORM, LIKES_ZIPF], default=LIKES_UNIFORM)
+    parser.add_argument('--max-likes', type=int, default=1000)
+    parser.add_argument('--zipf-a', type=float, default=1.5)
+    parser.add_argument('--max-days', type=int, default=1000)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--chunk-size', type=int, default=10000)
+    parser.add_argument('--workers', type=int, default=1, help="number of generating processes")
+    parser.add_argument('--photos-csv', default='data\\test-photo.csv', help="csv with sample photo urls")
+    parser.add_argument('--csv', metavar='DIR', help="write csv files for LOAD DATA INFILE / COPY "
+                                                     "instead of inserting photos")
+    return parser.parse_args()
 
-    def tags_function(photo): return sample(tags[(photo.id % 10) * 10: ((photo.id % 10) + 1) * 10], 5)
 
-
-    env.setup_photos(1000000,
-                     likes_function=lambda i: randint(1, 1000),
-                     date_function=lambda i: datetime.now() - timedelta(days=randint(1, 1000)),
-                     tags_function=tags_function)
+if __name__ == "__main__":
+    args = parse_args()
+    Photo.objects.all().delete()
+    Tag.objects.all().delete()
+    tags = PhotoEnvironment.setup_tags(cnt=args.tags, name_function=lambda i: i)
+
+    paths = None
+    if os.path.exists(args.photos_csv):
+        paths = [str(x).strip('"') for x in pd.read_csv(args.photos_csv, sep=';')['src']]
+
+    generator = SampleDataGenerator(cnt_photos=args.photos, cnt_tags=args.tags, tags_per_photo=args.tags_per_photo,
+                                    tag_block_size=args.tag_block_size, tag_skew=args.tag_skew,
+                                    likes_distribution=args.likes, max_likes=args.max_likes, zipf_a=args.zipf_a,
+                                    max_days=args.max_days, seed=args.seed, chunk_size=args.chunk_size,
+                                    paths=paths)
+    if args.csv is not None:
+        print("Written: {0}, {1}".format(*generator.write_to_csv(args.csv, tags=tags, workers=args.workers)))
+    else:
+        generator.write_to_db(tags=tags, workers=args.workers)
@@ -0,0 +1,156 @@
+import csv
+import os
+from datetime import date, timedelta
+from multiprocessing import Pool
+
+import numpy as np
+
+from .models import Photo
+from .photo_environment import PhotoEnvironment
+
+LIKES_UNIFORM = 'uniform'
+LIKES_ZIPF = 'zipf'
+PHOTOS_CSV_NAME = 'photos.csv'
+PHOTO_TAGS_CSV_NAME = 'photo_tags.csv'
+
+
+class SampleDataGenerator:
+    """Быстрая генерация больших наборов фото для нагрузочного тестирования.
+
+       Лайки, даты и теги генерируются векторно (numpy) пачками по chunk_size фото,
+       каждая пачка - со своим seed, поэтому результат воспроизводим при любом числе
+       процессов-генераторов (workers). Пачки пишутся в БД через bulk_create
+       (фото и связи с тегами) либо в csv-файлы для LOAD DATA INFILE / COPY.
+
+       Теги устроены как в sample_data: фото с id получает tags_per_photo тегов
+       из блока тегов номер id % число_блоков. tag_skew > 0 делает выбор тегов
+       в блоке неравномерным (вес тега ранга r равен 1 / (r + 1) ** tag_skew).
+       Лайки - равномерные от 1 до max_likes или по закону Ципфа с параметром zipf_a.
+    """
+
+    def __init__(self, cnt_photos: int, cnt_tags: int = 100, tags_per_photo: int = 5, tag_block_size: int = 10,
+                 tag_skew: float = 0.0, likes_distribution: str = LIKES_UNIFORM, max_likes: int = 1000,
+                 zipf_a: float = 1.5, max_days: int = 1000, seed: int = 0, chunk_size: int = 10000,
+                 paths=None):
+        if likes_distribution not in (LIKES_UNIFORM, LIKES_ZIPF):
+            raise ValueError("Unknown likes distribution: {0}".format(likes_distribution))
+        if tags_per_photo > tag_block_size or cnt_tags < tag_block_size:
+            raise ValueError("Wrong tags settings")
+        self.cnt_photos = cnt_photos
+        self.cnt_tags = cnt_tags
+        self.tags_per_photo = tags_per_photo
+        self.tag_block_size = tag_block_size
+        self.tag_skew = tag_skew
+        self.likes_distribution = likes_distribution
+        self.max_likes = max_likes
+        self.zipf_a = zipf_a
+        self.max_days = max_days
+        self.seed = seed
+        self.chunk_size = chunk_size
+        self.paths = paths or ['https://picsum.photos/id/{0}/304/228'.format(i) for i in range(1000)]
+        self.today = date.today()
+
+    def generate_chunk(self, chunk_index: int, start_id: int):
+        """Генерация пачки фото
+
+        :return: dict[str, numpy.ndarray] с ключами
+            id, path_index, likes_cnt, days_ago, tag_photo_ids, tag_indices
+        """
+        chunk_start = chunk_index * self.chunk_size
+        cnt = min(self.chunk_size, self.cnt_photos - chunk_start)
+        random_state = np.random.RandomState([self.seed, chunk_index])
+        ids = np.arange(start_id + chunk_start, start_id + chunk_start + cnt, dtype=np.int64)
+
+        if self.likes_distribution == LIKES_ZIPF:
+            likes_cnt = np.minimum(random_state.zipf(self.zipf_a, cnt), self.max_likes)
+        else:
+            likes_cnt = random_state.randint(1, self.max_likes + 1, cnt)
+
+        # выбор тегов в блоке без повторений: берем tags_per_photo наибольших ключей u ** (1 / weight)
+        weights = 1.0 / (np.arange(self.tag_block_size) + 1.0) ** self.tag_skew
+        keys = random_state.random_sample((cnt, self.tag_block_size)) ** (1.0 / weights)
+        tags_in_block = np.argsort(-keys, axis=1)[:, :self.tags_per_photo]
+        cnt_blocks = self.cnt_tags // self.tag_block_size
+        tag_indices = (ids % cnt_blocks)[:, np.newaxis] * self.tag_block_size + tags_in_block
+
+        return {'id': ids,
+                'path_index': random_state.randint(0, len(self.paths), cnt),
+                'likes_cnt': likes_cnt,
+                'days_ago': random_state.randint(1, self.max_days + 1, cnt),
+                'tag_photo_ids': np.repeat(ids, self.tags_per_photo),
+                'tag_indices': tag_indices.ravel()}
+
+    def iter_chunks(self, start_id: int, workers: int = 1):
+        """Итератор по пачкам по порядку; при workers > 1 пачки
+            генерируются параллельно в отдельных процессах, пока основной процесс их пишет"""
+        cnt_chunks = (self.cnt_photos + self.chunk_size - 1) // self.chunk_size
+        args = [(self, chunk_index, start_id) for chunk_index in range(cnt_chunks)]
+        if workers <= 1:
+            for arg in args:
+                yield _generate_chunk(arg)
+        else:
+            with Pool(processes=workers) as pool:
+                for chunk in pool.imap(_generate_chunk, args):
+                    yield chunk
+
+    def write_to_db(self, tags, workers: int = 1, batch_size: int = 5000):
+        """Запись фото и связей с тегами в БД пачками через bulk_create
+
+        :param tags: list[Tag] теги в порядке индексов
+        """
+        photo_tag_model = Photo.tags.through
+        start_id = self.__get_start_id()
+        for chunk in self.iter_chunks(start_id=start_id, workers=workers):
+            created_dates = self.__get_dates(chunk['days_ago'])
+            Photo.objects.bulk_create(
+                [Photo(id=int(photo_id), path=self.paths[path_index], likes_cnt=int(likes_cnt),
+                       created_date=created_date)
+                 for photo_id, path_index, likes_cnt, created_date
+                 in zip(chunk['id'], chunk['path_index'], chunk['likes_cnt'], created_dates)],
+                batch_size=batch_size)
+            photo_tag_model.objects.bulk_create(
+                [photo_tag_model(photo_id=int(photo_id), tag_id=tags[tag_index].id)
+                 for photo_id, tag_index in zip(chunk['tag_photo_ids'], chunk['tag_indices'])],
+                batch_size=batch_size)
+        PhotoEnvironment.reset_photo_sequences()
+
+    def write_to_csv(self, directory: str, tags, workers: int = 1, start_id: int = None):
+        """Запись фото и связей с тегами в csv-файлы для прямой загрузки в БД
+            (LOAD DATA INFILE для MySQL или COPY для PostgreSQL)
+
+        :return: tuple[str, str] пути к файлам фото и связей с тегами
+        """
+        if start_id is None:
+            start_id = self.__get_start_id()
+        photo_tag_model = Photo.tags.through
+        photos_path = os.path.join(directory, PHOTOS_CSV_NAME)
+        photo_tags_path = os.path.join(directory, PHOTO_TAGS_CSV_NAME)
+        with open(photos_path, 'w', newline='') as photos_file, \
+                open(photo_tags_path, 'w', newline='') as photo_tags_file:
+            photos_writer = csv.writer(photos_file)
+            photo_tags_writer = csv.writer(photo_tags_file)
+            photos_writer.writerow(['id', 'path', 'likes_cnt', 'created_date'])
+            photo_tags_writer.writerow([photo_tag_model._meta.get_field('photo').column,
+                                        photo_tag_model._meta.get_field('tag').column])
+            for chunk in self.iter_chunks(start_id=start_id, workers=workers):
+                created_dates = self.__get_dates(chunk['days_ago'])
+                photos_writer.writerows(
+                    zip(chunk['id'], (self.paths[i] for i in chunk['path_index']), chunk['likes_cnt'],
+                        (created_date.isoformat() for created_date in created_dates)))
+                photo_tags_writer.writerows(
+                    zip(chunk['tag_photo_ids'], (tags[i].id for i in chunk['tag_indices'])))
+        return photos_path, photo_tags_path
+
+    def __get_dates(self, days_ago):
+        return [self.today - timedelta(days=int(days)) for days in days_ago]
+
+    @staticmethod
+    def __get_start_id():
+        return (Photo.objects.order_by('-id').values_list('id', flat=True).first() or 0) + 1
+
+
+def _generate_chunk(args):
+    """Функция верхнего уровня, чтобы передавать генерацию пачек в процессы"""
+    generator, chunk_index, start_id = args
+    return generator.generate_chunk(chunk_index, start_id)
+
@@ -0,0 +1,340 @@
+import random
+import threading
+import time
+from collections import namedtuple
+from datetime import datetime
+from photo_likers.settings import PHOTOS_PER_PAGE
+from photo_likers.sharded_index import IndexShard, LocalShardClient, ShardCoordinator
+from photo_likers.utils.compressed_posting_list import CompressedPostingList
+from photo_likers.utils.sorted_list_searcher import SortedListSearcher
+from photo_likers.utils.sorted_list_utils import sorted_list_merge
+
+HarnessTag = namedtuple('HarnessTag', ['id'])
+MIN_HASH = (-1, -1)
+ALL_PHOTOS_TAG_ID = 0
+
+
+class SearchCase:
+    """Случайные упорядоченные списки тегов и условия поиска по ним.
+
+       Список ALL_PHOTOS_TAG_ID содержит все фото, теги - случайные подмножества
+       разной плотности. Лайков мало, чтобы было много равных значений,
+       которые различаются только id фото
+    """
+
+    def __init__(self, tag_lists, include_tag_ids, exclude_tag_ids, bounds=None):
+        """:param tag_lists: dict[int, list[tuple]] id тега -> упорядоченный список хэшей (с фиктивным в конце)
+        :param bounds: tuple[int, int] отрезок [start, end) первого списка или None
+        """
+        self.tag_lists = tag_lists
+        self.include_tag_ids = include_tag_ids  # type: list[int]
+        self.exclude_tag_ids = exclude_tag_ids  # type: list[int]
+        self.bounds = bounds
+
+    @classmethod
+    def generate(cls, random_gen: random.Random, max_photos: int = 300, max_tags: int = 4):
+        tag_lists = get_random_tag_lists(random_gen, cnt_photos=random_gen.randint(0, max_photos),
+                                         cnt_tags=random_gen.randint(1, max_tags))
+        tag_ids = [tag_id for tag_id in tag_lists if tag_id != ALL_PHOTOS_TAG_ID]
+        random_gen.shuffle(tag_ids)
+        cnt_include = random_gen.randint(0, len(tag_ids))
+        cnt_exclude = random_gen.randint(0, len(tag_ids) - cnt_include)
+        case = cls(tag_lists, include_tag_ids=tag_ids[:cnt_include],
+                   exclude_tag_ids=tag_ids[cnt_include:cnt_include + cnt_exclude])
+        if random_gen.random() < 0.3:
+            main_list_len = len(case.get_lists()[0][0]) - 1
+            start = random_gen.randint(0, main_list_len)
+            case.bounds = (start, random_gen.randint(start, main_list_len))
+        return case
+
+    def get_lists(self):
+        """Списки в порядке обхода (включающие, без них - список всех фото, затем исключающие)
+            и индикаторы включения"""
+        include_tag_ids = self.include_tag_ids or [ALL_PHOTOS_TAG_ID]
+        sorted_lists = [self.tag_lists[tag_id] for tag_id in include_tag_ids + self.exclude_tag_ids]
+        return sorted_lists, [True] * len(include_tag_ids) + [False] * len(self.exclude_tag_ids)
+
+    def describe(self) -> dict:
+        return {'list_sizes': {tag_id: len(tag_list) - 1 for tag_id, tag_list in self.tag_lists.items()},
+                'include': self.include_tag_ids, 'exclude': self.exclude_tag_ids, 'bounds': self.bounds}
+
+
+def get_random_tag_lists(random_gen: random.Random, cnt_photos: int, cnt_tags: int):
+    """:return: dict[int, list[tuple]] список всех фото (ALL_PHOTOS_TAG_ID) и списки тегов 1..cnt_tags"""
+    max_likes = random_gen.choice([0, 3, 50])
+    photo_hashes = sorted(((random_gen.randint(0, max_likes), photo_id) for photo_id in range(1, cnt_photos + 1)),
+                          reverse=True)
+    tag_lists = {ALL_PHOTOS_TAG_ID: photo_hashes + [MIN_HASH]}
+    for tag_id in range(1, cnt_tags + 1):
+        density = random_gen.choice([0.0, 0.05, 0.3, 0.7, 1.0])
+        tag_lists[tag_id] = [hash_value for hash_value in photo_hashes if random_gen.random() < density] + [MIN_HASH]
+    return tag_lists
+
+
+def reference_search(sorted_lists, inclusion_indicators, bounds=None):
+    """Все найденные значения перебором по множествам: эталон для сравнения реализаций"""
+    start, end = bounds if bounds is not None else (0, len(sorted_lists[0]) - 1)
+    include_sets = [set(x) for x, inclusive in zip(sorted_lists[1:], inclusion_indicators[1:]) if inclusive]
+    exclude_values = set()
+    for sorted_list, inclusive in zip(sorted_lists, inclusion_indicators):
+        if not inclusive:
+            exclude_values.update(sorted_list)
+    return [value for value in sorted_lists[0][start:end]
+            if value not in exclude_values and all(value in include_set for include_set in include_sets)]
+
+
+def get_reference_page(values, page_number: int):
+    """:return: tuple[list, int] значения страницы и число страниц"""
+    return values[(page_number - 1) * PHOTOS_PER_PAGE:page_number * PHOTOS_PER_PAGE], \
+        (len(values) + PHOTOS_PER_PAGE - 1) // PHOTOS_PER_PAGE
+
+
+def check_rejected_page(search_funcs, page_number: int):
+    """Проверка, что номер страницы меньше 1 отклоняется (ValueError) во всех режимах
+
+    :param search_funcs: dict[str, callable()] режим -> поиск страницы page_number
+    :return: list[dict] расхождения
+    """
+    mismatches = []
+    for mode, search_func in search_funcs.items():
+        try:
+            actual = search_func()
+        except ValueError:
+            continue
+        except Exception as e:
+            actual = repr(e)
+        mismatches.append({'mode': mode, 'page': page_number, 'expected': 'ValueError', 'actual': actual})
+    return mismatches
+
+
+def check_searcher(searcher_class, sorted_lists, inclusion_indicators, bounds, page_numbers, page_step: int):
+    """Сравнение страниц и числа страниц реализации поиска с эталоном во всех режимах:
+        полный поиск, продолжение по битовому массиву найденных, продолжение с отметок
+        и поиск без сохраненной информации (только страница).
+        Номера страниц меньше 1 должны отклоняться
+
+    :return: list[dict] расхождения
+    """
+    values = reference_search(sorted_lists, inclusion_indicators, bounds)
+    searcher = searcher_class(sorted_lists=sorted_lists, inclusion_indicators=inclusion_indicators,
+                              page_step=page_step, bounds=bounds)
+    _, search_info = searcher.search_page(page_number=1, compute_search_info=True)
+    checkpoints_info = type(search_info)(num_pages=search_info.num_pages, checkpoints=search_info.checkpoints)
+    mismatches = []
+    for page_number in page_numbers:
+        if page_number < 1:
+            mismatches += [dict(mismatch, page_step=page_step) for mismatch in check_rejected_page({
+                'cold': lambda: searcher.search_page(page_number=page_number, compute_search_info=True),
+                'matches': lambda: searcher.search_page(page_number=page_number, search_info=search_info),
+                'checkpoints': lambda: searcher.search_page(page_number=page_number, search_info=checkpoints_info),
+                'no_info': lambda: searcher.search_page(page_number=page_number)}, page_number)]
+            continue
+        expected = get_reference_page(values, page_number)
+        page, cold_info = searcher.search_page(page_number=page_number, compute_search_info=True)
+        results = {'cold': (page, cold_info.num_pages),
+                   'matches': (searcher.search_page(page_number=page_number, search_info=search_info)[0],
+                               search_info.num_pages),
+                   'checkpoints': (searcher.search_page(page_number=page_number, search_info=checkpoints_info)[0],
+                                   checkpoints_info.num_pages),
+                   'no_info': (searcher.search_page(page_number=page_number)[0], expected[1])}
+        for mode, actual in results.items():
+            if list(actual[0]) != expected[0] or actual[1] != expected[1]:
+                mismatches.append({'mode': mode, 'page': page_number, 'page_step': page_step,
+                                   'expected': expected, 'actual': (list(actual[0]), actual[1])})
+    if bounds is None:
+        merged = [value for value, _ in sorted_list_merge(sorted_lists, inclusion_indicators)]
+        if merged != values:
+            mismatches.append({'mode': 'merge', 'expected': values, 'actual': merged})
+    return mismatches
+
+
+def check_shards(case: SearchCase, page_numbers, cnt_shards: int):
+    """Сравнение поиска по шардам (ShardCoordinator) с эталоном (только условия на теги)"""
+    sorted_lists, inclusion_indicators = case.get_lists()
+    values = reference_search(sorted_lists, inclusion_indicators)
+    max_photo_id = max([photo_id for _, photo_id in case.tag_lists[ALL_PHOTOS_TAG_ID]] + [0])
+    shard_size = max_photo_id // cnt_shards + 1
+    snapshot = {'lists': {0: case.tag_lists}}
+    coordinator = ShardCoordinator([LocalShardClient(IndexShard.from_snapshot(snapshot, i * shard_size,
+                                                                              (i + 1) * shard_size))
+                                    for i in range(cnt_shards)])
+    mismatches = []
+    for page_number in page_numbers:
+        if page_number < 1:
+            mismatches += [dict(mismatch, shards=cnt_shards) for mismatch in check_rejected_page({
+                'shards': lambda: coordinator.search_page(0, case.include_tag_ids or [ALL_PHOTOS_TAG_ID],
+                                                          case.exclude_tag_ids, page_number)}, page_number)]
+            continue
+        expected = get_reference_page(values, page_number)
+        actual = coordinator.search_page(0, case.include_tag_ids or [ALL_PHOTOS_TAG_ID], case.exclude_tag_ids,
+                                         page_number)
+        if list(actual[0]) != expected[0] or actual[1] != expected[1]:
+            mismatches.append({'mode': 'shards', 'page': page_number, 'shards': cnt_shards,
+                               'expected': expected, 'actual': (list(actual[0]), actual[1])})
+    return mismatches
+
+
+def run_differential_case(case_seed: int, searcher_classes=(SortedListSearcher,), page_steps=(1, 2, 50),
+                          max_photos: int = 300, max_tags: int = 4):
+    """Проверка всех реализаций на одном случайном наборе (по case_seed набор воспроизводится)
+
+    :return: tuple[int, list[dict]] число проверенных страниц и расхождения
+    """
+    random_gen = random.Random(case_seed)
+    case = SearchCase.generate(random_gen, max_photos=max_photos, max_tags=max_tags)
+    sorted_lists, inclusion_indicators = case.get_lists()
+    num_pages = get_reference_page(reference_search(sorted_lists, inclusion_indicators, case.bounds), 1)[1]
+    # и номера меньше 1 (должны отклоняться), и страницы после последней (пустые)
+    page_numbers = sorted({-1, 0, 1, max(num_pages, 1), num_pages + 1, num_pages + 10} |
+                          {random_gen.randint(1, num_pages + 1) for _ in range(3)})
+    page_step = random_gen.choice(page_steps)
+    engines = []
+    for searcher_class in searcher_classes:
+        engines.append((searcher_class.__name__, searcher_class, sorted_lists))
+        engines.append((searcher_class.__name__ + '/compressed', searcher_class,
+                        [CompressedPostingList.from_sorted(sorted_list) for sorted_list in sorted_lists]))
+    mismatches = []
+    for name, searcher_class, engine_lists in engines:
+        for mismatch in check_searcher(searcher_class, engine_lists, inclusion_indicators, case.bounds,
+                                       page_numbers, page_step):
+            mismatches.append(dict(mismatch, engine=name))
+    cnt_checks = len(engines) * len(page_numbers)
+    if case.bounds is None:
+        mismatches += [dict(mismatch, engine='ShardCoordinator')
+                       for mismatch in check_shards(case, page_numbers, cnt_shards=random_gen.randint(1, 3))]
+        cnt_checks += len(page_numbers)
+    return cnt_checks, [dict(mismatch, case_seed=case_seed, case=case.describe()) for mismatch in mismatches]
+
+
+def run_differential(cnt_cases: int, seed: int = 0, searcher_classes=(SortedListSearcher,), page_steps=(1, 2, 50),
+                     max_photos: int = 300, max_tags: int = 4):
+    """Дифференциальная проверка реализаций поиска (классов поиска на обычных и сжатых списках
+        и шардов) на случайных наборах: одинаковые страницы и число страниц с эталоном перебором.
+        Каждое расхождение содержит case_seed для воспроизведения через run_differential_case
+
+    :return: dict для сохранения в JSON
+    """
+    random_gen = random.Random(seed)
+    cnt_checks = 0
+    mismatches = []
+    for _ in range(cnt_cases):
+        case_checks, case_mismatches = run_differential_case(
+            random_gen.randrange(2 ** 32), searcher_classes=searcher_classes, page_steps=page_steps,
+            max_photos=max_photos, max_tags=max_tags)
+        cnt_checks += case_checks
+        mismatches += case_mismatches
+    return {'config': {'cases': cnt_cases, 'seed': seed, 'page_steps': list(page_steps),
+                       'searchers': [cls.__module__ + '.' + cls.__name__ for cls in searcher_classes]},
+            'checks': cnt_checks,
+            'mismatches': mismatches}
+
+
+def run_swap_stress(cnt_threads: int = 4, cnt_swaps: int = 5, cnt_photos: int = 300, cnt_tags: int = 3, seed: int = 0,
+                    searcher_class=SortedListSearcher):
+    """Поиски в нескольких потоках во время публикации новых версий индекса.
+
+       Версии загружаются из случайных снимков (CacheManager.load_photos_cache), поэтому
+       у каждой версии свои списки. Поток закрепляет опубликованную версию, ищет страницу
+       через PageSearcher (чтение списков с ключом сохраненного поиска и поиск с сохраненной
+       информацией этой версии) и сравнивает ее с эталоном по спискам, которые прочитал PageSearcher.
+       Если версия удалена, пока списки читались, поиск пропускается (запрос на странице
+       дочитал бы список из БД, а случайных списков в БД нет), как и приблизительный поиск,
+       остановленный по дедлайну планировщика
+
+    :return: dict для сохранения в JSON
+    """
+    from django.core.exceptions import ObjectDoesNotExist
+    from photo_likers.cache_manager import CacheManager
+    from photo_likers.page_searcher import PageSearcher
+    from photo_likers.photo_caches import SortedPhotoCacheBase, SortedPhotoLikeCache
+    from photo_likers.slow_query_log import SlowQueryLog
+    from photo_likers.tag_pair_index import TagPairIndex
+    from photo_likers.utils.dummy_tag import DummyTag
+    from photo_likers.utils.photo_request import PhotosRequest
+
+    class VersionDropped(Exception):
+        pass
+
+    class StressPhotoCache(SortedPhotoLikeCache):
+        """Списки версии без дочитывания из БД"""
+
+        def load_one_tag_cache(self, *args, **kwargs):
+            raise VersionDropped()
+
+    def get_snapshot(snapshot_seed: int) -> dict:
+        tag_lists = get_random_tag_lists(random.Random(snapshot_seed), cnt_photos=cnt_photos, cnt_tags=cnt_tags)
+        tag_lists[DummyTag().id] = tag_lists.pop(ALL_PHOTOS_TAG_ID)
+        # отметка по БД: фото и лайки из БД не добавляются к случайным спискам
+        return {'created': datetime.now(), 'high_water_mark': CacheManager.get_high_water_mark(),
+                'lists': {SortedPhotoLikeCache.sort_field: tag_lists}}
+
+    tags = [HarnessTag(id=tag_id) for tag_id in range(1, cnt_tags + 1)]
+    pair_index = TagPairIndex(enabled=False)
+    slow_log = SlowQueryLog(threshold_seconds=None)
+    stop = threading.Event()
+    lock = threading.Lock()
+    stats = {'searches': 0, 'skipped': 0}
+    mismatches = []
+
+    def search(random_gen: random.Random):
+        tag_ids = [tag.id for tag in tags]
+        random_gen.shuffle(tag_ids)
+        cnt_include = random_gen.randint(0, len(tag_ids))
+        include_tag_ids = tag_ids[:cnt_include]
+        exclude_tag_ids = tag_ids[cnt_include:random_gen.randint(cnt_include, len(tag_ids))]
+        page_number = random_gen.randint(1, 3)
+        photo_request = PhotosRequest(page_number=str(page_number), sort_field=str(SortedPhotoLikeCache.sort_field),
+                                      tags_conditions=";".join([str(x) for x in include_tag_ids] +
+                                                               ["-" + str(x) for x in exclude_tag_ids]), tags=tags)
+        version = SortedPhotoCacheBase.INDEX_VERSION
+        page_searcher = PageSearcher(StressPhotoCache(version=version), searcher_class=searcher_class,
+                                     slow_log=slow_log)
+        ordered_conditions = page_searcher.plan_tag_conditions(photo_request, pair_index=pair_index)
+        try:
+            sorted_lists, search_cache_key = page_searcher.load_photo_lists_with_search_key(photo_request,
+                                                                                            ordered_conditions)
+        except (VersionDropped, ObjectDoesNotExist):
+            return False
+        page, search_info = page_searcher.search_photo_hashes(photo_request, ordered_conditions, sorted_lists,
+                                                              search_cache_key)
+        if search_info.is_approximate:
+            return False
+        expected = get_reference_page(reference_search(sorted_lists, [x.inclusive for x in ordered_conditions]),
+                                      page_number)
+        if list(page) != expected[0] or search_info.num_pages != expected[1]:
+            with lock:
+                mismatches.append({'version': version, 'include': include_tag_ids, 'exclude': exclude_tag_ids,
+                                   'page': page_number, 'expected': expected,
+                                   'actual': (list(page), search_info.num_pages)})
+        return True
+
+    def run_searches(thread_seed: int):
+        random_gen = random.Random(thread_seed)
+        while not stop.is_set():
+            try:
+                searched = search(random_gen)
+            except Exception as e:
+                with lock:
+                    mismatches.append({'error': repr(e)})
+                continue
+            with lock:
+                stats['searches' if searched else 'skipped'] += 1
+
+    random_gen = random.Random(seed)
+    CacheManager.load_photos_cache(snapshot=get_snapshot(random_gen.randrange(2 ** 32)))
+    threads = [threading.Thread(target=run_searches, args=(random_gen.randrange(2 ** 32),),
+                                name="swap-stress-{0}".format(i), daemon=True) for i in range(cnt_threads)]
+    for thread in threads:
+        thread.start()
+    try:
+        for _ in range(cnt_swaps):
+            CacheManager.load_photos_cache(snapshot=get_snapshot(random_gen.randrange(2 ** 32)))
+            time.sleep(0.01)
+    finally:
+        stop.set()
+        for thread in threads:
+            thread.join()
+    return {'config': {'threads': cnt_threads, 'swaps': cnt_swaps, 'photos': cnt_photos, 'tags': cnt_tags,
+                       'seed': seed, 'searcher': searcher_class.__module__ + '.' + searcher_class.__name__},
+            'searches': stats['searches'], 'skipped': stats['skipped'],
+            'mismatches': mismatches}
@@ -0,0 +1,76 @@
+import threading
+import time
+from photo_likers.settings import SEARCH_DEADLINE_SECONDS, EXPENSIVE_SEARCH_COST, EXPENSIVE_SEARCH_CONCURRENCY, \
+    EXPENSIVE_SEARCH_QUEUE_SECONDS, EXPENSIVE_SEARCH_BUSY_SECONDS
+from photo_likers.utils.sorted_list_searcher import SearchRequestInfo
+
+
+class SearchScheduler:
+    """Планировщик поисков страниц с контролем допуска.
+
+       Запросы с сохраненными отметками (search_info) и запросы по коротким спискам
+       считаются дешевыми и выполняются сразу. Дорогие "холодные" поиски
+       (оценка стоимости по длинам списков тегов) идут в отдельную полосу
+       с ограниченным числом одновременных поисков, чтобы несколько широких запросов
+       не заняли все воркеры. Если полоса занята, ищется только сама страница
+       без подсчета общего числа страниц и не дольше busy_seconds: результат приблизительный
+       (часть страницы и оценка числа страниц), зато такие поиски не нагружают процесс.
+       У каждого поиска есть дедлайн, после которого возвращается частичная страница.
+    """
+
+    def __init__(self, deadline_seconds: float = SEARCH_DEADLINE_SECONDS,
+                 expensive_cost: int = EXPENSIVE_SEARCH_COST,
+                 expensive_concurrency: int = EXPENSIVE_SEARCH_CONCURRENCY,
+                 queue_seconds: float = EXPENSIVE_SEARCH_QUEUE_SECONDS,
+                 busy_seconds: float = EXPENSIVE_SEARCH_BUSY_SECONDS):
+        self.deadline_seconds = deadline_seconds
+        self.expensive_cost = expensive_cost
+        self.queue_seconds = queue_seconds
+        self.busy_seconds = busy_seconds
+        self.__expensive_lane = threading.BoundedSemaphore(expensive_concurrency)
+
+    @staticmethod
+    def estimate_cost(sorted_lists) -> int:
+        """Оценка числа просматриваемых элементов при полном поиске:
+            первый список просматривается целиком, по остальным делается
+            поиск для каждого его значения. По одному списку страница берется срезом
+        """
+        if len(sorted_lists) == 1:
+            return 0
+        return (len(sorted_lists[0]) - 1) * len(sorted_lists)
+
+    def is_expensive(self, sorted_lists, search_info: SearchRequestInfo) -> bool:
+        return search_info is None and self.estimate_cost(sorted_lists) >= self.expensive_cost
+
+    def schedule(self, search_func, sorted_lists, search_info: SearchRequestInfo):
+        """Выполнение поиска с учетом стоимости и дедлайна
+
+        :param search_func: callable(compute_search_info: bool, deadline: float) -> (list, SearchRequestInfo)
+        :param sorted_lists: list[list[tuple]] списки, по которым будет идти поиск
+        :param search_info: сохраненная информация о предыдущем поиске или None
+        """
+        deadline = time.monotonic() + self.deadline_seconds
+        if not self.is_expensive(sorted_lists, search_info):
+            return search_func(search_info is None, deadline)
+
+        if not self.__expensive_lane.acquire(timeout=self.queue_seconds):
+            return search_func(False, min(deadline, time.monotonic() + self.busy_seconds))
+        try:
+            return search_func(True, deadline)
+        finally:
+            self.__expensive_lane.release()
+
+    def run_expensive(self, func, busy_func):
+        """Выполнение дорогой работы вне поиска (например, построения объединения списков)
+            в полосе дорогих поисков. Место в полосе ждется не дольше queue_seconds,
+            после чего выполняется busy_func (например, объединение без сохранения в кэш)
+        """
+        if not self.__expensive_lane.acquire(timeout=self.queue_seconds):
+            return busy_func()
+        try:
+            return func()
+        finally:
+            self.__expensive_lane.release()
+
+
+search_scheduler = SearchScheduler()
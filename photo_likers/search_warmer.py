@@ -0,0 +1,84 @@
+import logging
+import threading
+from collections import Counter
+from photo_likers.cache_manager import CacheManager
+from photo_likers.page_searcher import PageSearcher
+from photo_likers.settings import SEARCH_WARMER_TOP_N, SEARCH_WARMER_INTERVAL_SECONDS
+from photo_likers.tag_pair_index import tag_pair_index
+from photo_likers.utils.photo_request import PhotosRequest
+
+logger = logging.getLogger(__name__)
+
+
+class SearchWarmer:
+    """Фоновый прогрев информации о поиске (SearchRequestInfo) для популярных запросов.
+
+       Считает частоты запросов по каноническому ключу (сортировка + условия на теги)
+       и периодически, раньше истечения SEARCH_CACHES_SECONDS_TIMEOUT, пересчитывает
+       отметки для top_n самых частых запросов. Также прогрев вызывается сразу после
+       перезагрузки кэшей тегов. Частоты уменьшаются вдвое на каждом цикле,
+       чтобы учитывать недавнюю популярность запросов.
+    """
+
+    def __init__(self, top_n: int = SEARCH_WARMER_TOP_N, interval_seconds: float = SEARCH_WARMER_INTERVAL_SECONDS):
+        self.top_n = top_n
+        self.interval_seconds = interval_seconds
+        self.__lock = threading.Lock()
+        self.__frequencies = Counter()
+        self.__requests = {}  # type: dict[str, PhotosRequest]
+        self.__stop_event = threading.Event()
+        self.__thread = None  # type: threading.Thread
+
+    def record(self, photo_request: PhotosRequest):
+        """Учет запроса в статистике частот (кроме запросов с условием "лайкнуто мной")"""
+        if photo_request.get_liked_condition() is not None:
+            return
+        key = CacheManager.get_search_key(photo_request)
+        with self.__lock:
+            self.__frequencies[key] += 1
+            self.__requests[key] = photo_request
+
+    def get_top_requests(self):
+        """:return: list[PhotosRequest] самые частые запросы"""
+        with self.__lock:
+            return [self.__requests[key] for key, _ in self.__frequencies.most_common(self.top_n)]
+
+    def warm(self):
+        """Обновление пересечений частых пар тегов и
+            пересчет информации о поиске для самых частых запросов"""
+        try:
+            tag_pair_index.refresh()
+        except Exception:
+            logger.exception("Failed to refresh tag pair index")
+        for photo_request in self.get_top_requests():
+            try:
+                PageSearcher(CacheManager.get_sorted_photo_cache(photo_request)).refresh_search_info(photo_request)
+            except Exception:
+                logger.exception("Failed to warm search cache for %s", CacheManager.get_search_key(photo_request))
+        self.__decay()
+
+    def start(self):
+        """Запуск фонового потока прогрева (повторный запуск ничего не делает)"""
+        if self.__thread is not None and self.__thread.is_alive():
+            return
+        self.__stop_event.clear()
+        self.__thread = threading.Thread(target=self.__run, name="search-warmer", daemon=True)
+        self.__thread.start()
+
+    def stop(self):
+        self.__stop_event.set()
+
+    def __run(self):
+        while not self.__stop_event.wait(self.interval_seconds):
+            self.warm()
+
+    def __decay(self):
+        with self.__lock:
+            for key in list(self.__frequencies):
+                self.__frequencies[key] //= 2
+                if self.__frequencies[key] == 0:
+                    del self.__frequencies[key]
+                    del self.__requests[key]
+
+
+search_warmer = SearchWarmer()
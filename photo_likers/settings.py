@@ -1,5 +1,90 @@
 PHOTOS_PER_PAGE = 20
-LIKES_CACHE_TEMPLATE_KEY = "likes_cache_tag_{0}"
-DATE_CACHE_TEMPLATE_KEY = "dates_cache_tag_{0}"
+# ключи списков тегов и производных списков содержат версию индекса (см. CacheManager.load_photos_cache)
+LIKES_CACHE_TEMPLATE_KEY = "likes_cache_tag_{0}_v{1}"
+DATE_CACHE_TEMPLATE_KEY = "dates_cache_tag_{0}_v{1}"
 LOAD_CACHES_ON_START = True
 LOAD_CACHES_ON_START_ASYNC = True
+# подсистема индекса запускается только в процессах, где эта переменная окружения равна "1"
+# (ее выставляет PhotoLikers/wsgi.py), и в runserver
+INDEX_STARTUP_ENV_VAR = "PHOTO_LIKERS_START_INDEX"
+# максимальное время поиска страницы (сек.), после которого возвращается частичная страница
+SEARCH_DEADLINE_SECONDS = 5
+# оценка стоимости поиска (число просматриваемых элементов), начиная с которой
+# поиск без сохраненных отметок считается дорогим
+EXPENSIVE_SEARCH_COST = 500000
+# сколько дорогих поисков может выполняться одновременно
+EXPENSIVE_SEARCH_CONCURRENCY = 1
+# сколько ждать (сек.) освобождения полосы дорогих поисков
+EXPENSIVE_SEARCH_QUEUE_SECONDS = 0.5
+# сколько может идти (сек.) поиск только страницы вместо дорогого поиска, когда полоса занята
+EXPENSIVE_SEARCH_BUSY_SECONDS = 0.1
+SEARCH_CACHE_TEMPLATE_KEY = "search_cache_{0}_v{1}_{2}"
+# списки фото с условием на диапазон по полю, отличному от поля сортировки
+RANGE_CACHE_TEMPLATE_KEY = "range_cache_{0}_{1}_v{2}"
+# объединения списков тегов для условий "хотя бы один из тегов"
+UNION_CACHE_TEMPLATE_KEY = "union_cache_{0}_{1}_v{2}"
+# готовые пересечения списков для частых пар включающих тегов
+PAIR_CACHE_TEMPLATE_KEY = "pair_cache_{0}_{1}_v{2}"
+# битовые маски id фото по тегам для подсчета числа результатов у ссылок на теги
+FACET_BITMAP_CACHE_TEMPLATE_KEY = "facet_bitmap_tag_{0}_v{1}"
+# фоновый прогрев информации о поиске для популярных запросов
+SEARCH_WARMER_ENABLED = True
+# для скольких самых частых запросов пересчитывать информацию о поиске
+SEARCH_WARMER_TOP_N = 50
+# период прогрева (сек.), должен быть меньше CacheManager.SEARCH_CACHES_SECONDS_TIMEOUT
+SEARCH_WARMER_INTERVAL_SECONDS = 300
+# для скольких первых страниц рейтинга по лайкам без тегов хранить фото в памяти
+LEADERBOARD_CACHED_PAGES = 5
+# лайки копятся в памяти и сохраняются пачкой при достижении размера или по таймеру (сек.)
+LIKES_BATCH_MAX_SIZE = 500
+LIKES_BATCH_FLUSH_SECONDS = 1.0
+# после скольких неудачных попыток сохранения пачка лайков отбрасывается
+LIKES_BATCH_MAX_RETRIES = 3
+# добавлять ли к странице с фото заголовок Server-Timing с длительностями этапов
+SERVER_TIMING_HEADER_ENABLED = True
+# поиски дольше порога (сек.) записываются в журнал медленных запросов (None - не записывать)
+SLOW_QUERY_THRESHOLD_SECONDS = 0.5
+SLOW_QUERY_LOG_PATH = "slow_queries.log"
+# профилирование отдельных запросов персоналом (?profile=1 или заголовок X-Profile: 1):
+# не чаще раза в PROFILER_MIN_INTERVAL_SECONDS сек., в памяти хранятся последние PROFILER_MAX_STORED профилей
+PROFILER_MIN_INTERVAL_SECONDS = 10
+PROFILER_MAX_STORED = 20
+# кэш django для списков тегов (индекса) и бюджет памяти под них (байт, None - без ограничения);
+# при превышении вытесняются холодные списки, списки DummyTag закреплены
+INDEX_CACHE_ALIAS = "photo_index"
+INDEX_MEMORY_BUDGET_BYTES = 2 * 1024 ** 3
+# со скольких обращений список считается горячим и получает второй шанс при вытеснении
+INDEX_HOT_HITS = 100
+# хранить списки тегов сжатыми (CompressedPostingList): в разы меньше памяти и быстрее
+# чтение из кэша, но мерж по сжатым спискам медленнее
+INDEX_COMPRESSED_LISTS = False
+# пары тегов с готовыми пересечениями: выбираются по статистике запросов при прогреве;
+# пара берется, если запрошена не менее TAG_PAIR_MIN_QUERIES раз и пересечение составляет
+# не более TAG_PAIR_MAX_SELECTIVITY от меньшего списка, в пределах бюджета памяти (байт)
+TAG_PAIR_INDEX_ENABLED = True
+TAG_PAIR_MAX_PAIRS = 100
+TAG_PAIR_MIN_QUERIES = 5
+TAG_PAIR_MAX_SELECTIVITY = 0.5
+TAG_PAIR_BUDGET_BYTES = 256 * 1024 ** 2
+# показывать у ссылок на добавление тегов число результатов (считается один раз для запроса)
+FACET_COUNTS_ENABLED = True
+# при скольких найденных фото числа не считаются (маска найденных строится проходом по ним)
+FACET_COUNTS_MAX_FOUND = 100000
+# общий каталог снимков индекса (None - каждый узел строит индекс по БД): снимок записывает
+# команда publish_index_snapshot, веб-узлы загружают его при старте; хранится INDEX_SNAPSHOT_KEEP снимков
+INDEX_SNAPSHOT_DIR = None
+INDEX_SNAPSHOT_KEEP = 2
+# для скольких наборов условий шард индекса помнит число найденных фото
+SHARD_COUNTS_CACHE_SIZE = 1000
+# страницы с сортировкой по дате только с условиями на теги ищутся по шардам последнего снимка индекса
+# (нужен INDEX_SNAPSHOT_DIR): число шардов (0 - без шардов) и где они работают:
+# "process" - в отдельных локальных процессах, "local" - в процессе веб-узла
+INDEX_SHARDS = 0
+INDEX_SHARD_CLIENT = "process"
+# отдавать страницу с фото потоком (или с параметром запроса ?stream=1): шапка с навигацией
+# отправляется до поиска (без чисел результатов у ссылок на теги) и кэшируется на STREAM_HEAD_CACHE_SECONDS сек.
+PHOTOS_STREAMING_ENABLED = False
+STREAM_HEAD_CACHE_SECONDS = 60
+STREAM_HEAD_CACHE_TEMPLATE_KEY = "photos_head_{0}"
+# для скольких пользователей держать в памяти лайкнутые фото (условие "лайкнуто мной")
+USER_LIKES_CACHE_SIZE = 1000
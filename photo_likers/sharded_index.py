@@ -0,0 +1,200 @@
+import heapq
+import itertools
+import multiprocessing
+import threading
+from collections import OrderedDict
+from photo_likers.index_snapshot import IndexSnapshotStore, IndexSnapshotError
+from photo_likers.settings import PHOTOS_PER_PAGE, SHARD_COUNTS_CACHE_SIZE
+from photo_likers.utils.sorted_list_utils import sorted_list_merge
+
+MIN_HASH = (-1, -1)
+# где работают шарды (см. INDEX_SHARD_CLIENT)
+PROCESS_SHARD_CLIENT = "process"
+LOCAL_SHARD_CLIENT = "local"
+
+
+class IndexShard:
+    """Часть индекса: упорядоченные списки тегов только для фото с id из [min_photo_id, max_photo_id).
+
+       Поиск по включающим и исключающим тегам - тот же мерж списков, что и для всего индекса,
+       но возвращаются только первые limit найденных значений и общее число найденных.
+       Шард не меняется, поэтому число найденных запоминается для условий (LRU),
+       и повторный поиск останавливается на limit значениях. Лайки после снимка в шард
+       не попадают, поэтому для страниц шарды используются только с сортировкой по дате
+       (см. PageSearcher), а сортировка по лайкам в шарде соответствует моменту снимка.
+    """
+
+    def __init__(self, min_photo_id: int, max_photo_id: int, lists, counts_cache_size: int = SHARD_COUNTS_CACHE_SIZE):
+        """:param lists: dict[int, dict[int, list[tuple]]] вид сортировки -> id тега -> список хэшей"""
+        self.min_photo_id = min_photo_id
+        self.max_photo_id = max_photo_id
+        self.__lists = lists
+        self.__counts_cache_size = counts_cache_size
+        self.__counts = OrderedDict()  # type: dict[tuple, int]
+        self.__lock = threading.Lock()
+
+    @classmethod
+    def from_snapshot(cls, snapshot: dict, min_photo_id: int, max_photo_id: int):
+        """Шард из снимка индекса (см. IndexSnapshotStore)"""
+        lists = {}
+        for sort_field, tag_lists in snapshot['lists'].items():
+            lists[sort_field] = {}
+            for tag_id, tag_list in tag_lists.items():
+                shard_list = [hash_value for hash_value in tag_list if min_photo_id <= hash_value[1] < max_photo_id]
+                shard_list.append(MIN_HASH)
+                lists[sort_field][tag_id] = shard_list
+        return cls(min_photo_id, max_photo_id, lists)
+
+    def search(self, sort_field: int, include_tag_ids, exclude_tag_ids, limit: int):
+        """Первые limit найденных хэшей и число всех найденных в шарде
+
+        :param include_tag_ids: list[int] включающие теги (хотя бы один, например, тег всех фото)
+        :param exclude_tag_ids: list[int] исключающие теги
+        :return: tuple[list[tuple], int]
+        """
+        tag_lists = self.__lists[sort_field]
+        # тега, созданного после снимка, в шарде нет - его список пустой
+        include_lists = sorted((tag_lists.get(tag_id, [MIN_HASH]) for tag_id in include_tag_ids), key=len)
+        exclude_lists = [tag_lists[tag_id] for tag_id in exclude_tag_ids if tag_id in tag_lists]
+        if len(include_lists) == 1 and len(exclude_lists) == 0:
+            return include_lists[0][:min(limit, len(include_lists[0]) - 1)], len(include_lists[0]) - 1
+
+        counts_key = (sort_field, tuple(sorted(include_tag_ids)), tuple(sorted(exclude_tag_ids)))
+        with self.__lock:
+            cnt_found = self.__counts.get(counts_key)
+        res = []
+        cnt_merged = 0
+        merge = sorted_list_merge(include_lists + exclude_lists,
+                                  [True] * len(include_lists) + [False] * len(exclude_lists))
+        try:
+            for value, _ in merge:
+                if len(res) < limit:
+                    res.append(value)
+                elif cnt_found is not None:
+                    break
+                cnt_merged += 1
+        finally:
+            merge.close()
+        if cnt_found is None:
+            cnt_found = cnt_merged
+            with self.__lock:
+                self.__counts[counts_key] = cnt_found
+                if len(self.__counts) > self.__counts_cache_size:
+                    self.__counts.popitem(last=False)
+        return res, cnt_found
+
+
+class LocalShardClient:
+    """Шард в том же процессе"""
+
+    def __init__(self, shard: IndexShard):
+        self.shard = shard
+        self.__result = None
+
+    def send(self, request: tuple):
+        self.__result = self.shard.search(*request)
+
+    def receive(self):
+        return self.__result
+
+    def close(self):
+        pass
+
+
+def run_shard_process(connection, snapshot_directory: str, min_photo_id: int, max_photo_id: int):
+    """Цикл процесса шарда: загрузка своей части снимка и ответы на запросы до получения None"""
+    shard = IndexShard.from_snapshot(IndexSnapshotStore(snapshot_directory).load(), min_photo_id, max_photo_id)
+    connection.send(True)
+    while True:
+        request = connection.recv()
+        if request is None:
+            break
+        try:
+            connection.send(shard.search(*request))
+        except Exception as e:
+            connection.send(e)
+    connection.close()
+
+
+class ProcessShardClient:
+    """Шард в отдельном локальном процессе: загружает свою часть последнего снимка индекса
+        из каталога и отвечает на запросы через pipe"""
+
+    def __init__(self, snapshot_directory: str, min_photo_id: int, max_photo_id: int):
+        self.__connection, child_connection = multiprocessing.Pipe()
+        self.__process = multiprocessing.Process(
+            target=run_shard_process, args=(child_connection, snapshot_directory, min_photo_id, max_photo_id),
+            name="index-shard-{0}-{1}".format(min_photo_id, max_photo_id), daemon=True)
+        self.__process.start()
+        child_connection.close()
+        self.receive()  # ожидание загрузки шарда
+
+    def send(self, request: tuple):
+        self.__connection.send(request)
+
+    def receive(self):
+        res = self.__connection.recv()
+        if isinstance(res, Exception):
+            raise res
+        return res
+
+    def close(self):
+        if self.__process.is_alive():
+            self.__connection.send(None)
+        self.__process.join()
+        self.__connection.close()
+
+
+class ShardCoordinator:
+    """Поиск страницы по шардам: запрос рассылается всем шардам (сначала отправка, потом ответы -
+        шарды в процессах работают параллельно), каждый возвращает первые page_number * PHOTOS_PER_PAGE
+        найденных значений, и их k-путевой мерж в порядке сортировки дает страницу.
+        Число страниц - по сумме чисел найденных в шардах
+    """
+
+    def __init__(self, clients):
+        """:param clients: list клиентов шардов (LocalShardClient, ProcessShardClient)"""
+        self.clients = clients
+        self.__lock = threading.Lock()
+
+    @classmethod
+    def from_snapshot_directory(cls, snapshot_directory: str, cnt_shards: int, max_photo_id: int = None,
+                                processes: bool = True):
+        """Шарды с равными диапазонами id фото по последнему снимку индекса
+
+        :param max_photo_id: наибольший id фото (по умолчанию - из отметки в манифесте снимка)
+        :param processes: запускать шарды в отдельных процессах (иначе - в этом процессе)
+        """
+        if max_photo_id is None:
+            manifest = IndexSnapshotStore(snapshot_directory).get_manifest()
+            if manifest is None:
+                raise IndexSnapshotError("No index snapshot in {0}".format(snapshot_directory))
+            max_photo_id = manifest['high_water_mark']['photo_id']
+        shard_size = max_photo_id // cnt_shards + 1
+        ranges = [(i * shard_size, (i + 1) * shard_size) for i in range(cnt_shards)]
+        if processes:
+            return cls([ProcessShardClient(snapshot_directory, min_id, max_id) for min_id, max_id in ranges])
+        snapshot = IndexSnapshotStore(snapshot_directory).load()
+        return cls([LocalShardClient(IndexShard.from_snapshot(snapshot, min_id, max_id)) for min_id, max_id in ranges])
+
+    def search_page(self, sort_field: int, include_tag_ids, exclude_tag_ids, page_number: int):
+        """:param page_number: номер страницы, начиная с 1 (ValueError для меньших)
+        :return: tuple[list[tuple], int] хэши фото страницы и число страниц
+        """
+        if page_number < 1:
+            raise ValueError("Page number must be positive: {0}".format(page_number))
+        limit = page_number * PHOTOS_PER_PAGE
+        request = (sort_field, list(include_tag_ids), list(exclude_tag_ids), limit)
+        # у клиента шарда один канал, поэтому запросы к шардам идут по одному
+        with self.__lock:
+            for client in self.clients:
+                client.send(request)
+            results = [client.receive() for client in self.clients]
+        merged = heapq.merge(*(shard_hashes for shard_hashes, _ in results), reverse=True)
+        page_hashes = list(itertools.islice(merged, limit - PHOTOS_PER_PAGE, limit))
+        cnt_found = sum(shard_cnt_found for _, shard_cnt_found in results)
+        return page_hashes, (cnt_found + PHOTOS_PER_PAGE - 1) // PHOTOS_PER_PAGE
+
+    def close(self):
+        for client in self.clients:
+            client.close()
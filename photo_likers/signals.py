@@ -0,0 +1,34 @@
+from django.db.models.signals import post_save, post_delete
+from django.dispatch import receiver
+from photo_likers.models import Photo
+
+
+def get_cache_manager():
+    """Менеджер кэшей; подсистема индекса импортируется при первом изменении фото,
+        а не при запуске приложения (см. PhotoLikersConfig.ready)"""
+    from photo_likers.cache_manager import CacheManager
+    return CacheManager
+
+
+def get_likes_leaderboard():
+    return get_cache_manager().LIKES_LEADERBOARD
+
+
+@receiver(post_save, sender=Photo)
+def update_likes_leaderboard(sender, instance: Photo, created: bool = False, **kwargs):
+    """Поддержание живого рейтинга по лайкам и списков тегов при сохранении фото.
+        Новые фото попадают в списки тегов только при перезагрузке индекса, поэтому фото,
+        которого еще нет в рейтинге, в него не добавляется: страницы без условий и с условиями
+        на теги показывают одни и те же фото"""
+    old_likes_cnt = get_likes_leaderboard().get_likes(instance.id)
+    if created or old_likes_cnt is None or old_likes_cnt == instance.likes_cnt:
+        return
+    likes_changes = {instance.id: (old_likes_cnt, instance.likes_cnt)}
+    get_cache_manager().apply_likes_changes(likes_changes)
+    from photo_likers.user_likes_index import user_likes_index
+    user_likes_index.apply_likes([], likes_changes)
+
+
+@receiver(post_delete, sender=Photo)
+def remove_from_likes_leaderboard(sender, instance: Photo, **kwargs):
+    get_likes_leaderboard().remove(instance.id)
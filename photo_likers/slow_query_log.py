@@ -0,0 +1,65 @@
+import json
+import threading
+import time
+from photo_likers.settings import SLOW_QUERY_THRESHOLD_SECONDS, SLOW_QUERY_LOG_PATH
+
+
+class SlowQueryLog:
+    """Журнал медленных поисков: по строке JSON на запрос, только дописывание в конец.
+
+       Запись содержит канонический запрос (тип сортировки, теги со знаком, страницу
+       и пользователя для условия "лайкнуто мной"),
+       план (порядок списков тегов, их длины, была ли сохраненная информация о поиске),
+       счетчики слияния и время, поэтому журнал можно воспроизвести на текущем индексе
+       (команда replay_slow_queries)
+    """
+
+    def __init__(self, path: str = SLOW_QUERY_LOG_PATH, threshold_seconds: float = SLOW_QUERY_THRESHOLD_SECONDS):
+        self.path = path
+        self.threshold_seconds = threshold_seconds
+        self.__lock = threading.Lock()
+
+    def is_slow(self, seconds: float) -> bool:
+        return self.threshold_seconds is not None and seconds >= self.threshold_seconds
+
+    def record(self, sort_field: int, tag_keys, page_number: int, plan, merge_stats, seconds: float,
+               search_cached: bool, is_approximate: bool, range_keys=(), user_id: int = None) -> bool:
+        """Запись поиска в журнал, если он дольше порога
+
+        :param tag_keys: list[str] теги со знаком (-id для исключающих) в порядке обхода
+        :param plan: list[dict] списки в порядке обхода: tag (или range), inclusive, size
+        :param range_keys: list[str] ключи условий на диапазоны (RangeFilter.key)
+        :param user_id: id пользователя для условия "лайкнуто мной" (None - условия нет)
+        :param merge_stats: MergeStats или None
+        :return: был ли поиск записан
+        """
+        if not self.is_slow(seconds):
+            return False
+        entry = {'time': time.time(), 'sort': sort_field, 'tags': sorted(tag_keys), 'page': page_number,
+                 'plan': plan, 'search_cached': search_cached, 'approximate': is_approximate,
+                 'seconds': round(seconds, 6)}
+        if len(range_keys) > 0:
+            entry['ranges'] = sorted(range_keys)
+        if user_id is not None:
+            entry['user'] = user_id
+        if merge_stats is not None:
+            entry.update(iterations=merge_stats.iterations, gallop_searches=merge_stats.gallop_searches,
+                         elements_scanned=merge_stats.elements_scanned)
+        line = json.dumps(entry, separators=(',', ':')) + '\n'
+        with self.__lock:
+            with open(self.path, 'a') as log_file:
+                log_file.write(line)
+        return True
+
+    @staticmethod
+    def read(path: str):
+        """Итератор по записям журнала (поврежденные строки пропускаются)"""
+        with open(path) as log_file:
+            for line in log_file:
+                try:
+                    yield json.loads(line)
+                except ValueError:
+                    continue
+
+
+slow_query_log = SlowQueryLog()
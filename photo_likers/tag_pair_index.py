@@ -0,0 +1,117 @@
+import itertools
+import sys
+import threading
+from collections import Counter
+from photo_likers.cache_manager import CacheManager
+from photo_likers.index_memory import HASH_BYTES
+from photo_likers.settings import TAG_PAIR_INDEX_ENABLED, TAG_PAIR_MAX_PAIRS, TAG_PAIR_MIN_QUERIES, \
+    TAG_PAIR_MAX_SELECTIVITY, TAG_PAIR_BUDGET_BYTES
+from photo_likers.utils.photo_request import PhotosRequest, SortType
+from photo_likers.utils.liked_tag import LikedTag
+from photo_likers.utils.sorted_list_utils import sorted_list_merge
+from photo_likers.utils.tag_condition import TagCondition, TagPairCondition
+
+
+class TagPairIndex:
+    """Готовые пересечения списков для частых пар включающих тегов.
+
+       Считает, как часто пары включающих тегов встречаются в запросах, и при обновлении
+       (refresh, вызывается при прогреве) выбирает самые частые пары, пересечение которых
+       заметно меньше меньшего из списков, в пределах бюджета памяти. Пересечения хранятся
+       в кэше индекса как производные списки, а планировщик (plan) заменяет ими пары условий.
+       Частоты уменьшаются вдвое на каждом обновлении.
+    """
+
+    def __init__(self, enabled: bool = TAG_PAIR_INDEX_ENABLED, max_pairs: int = TAG_PAIR_MAX_PAIRS,
+                 min_queries: int = TAG_PAIR_MIN_QUERIES, max_selectivity: float = TAG_PAIR_MAX_SELECTIVITY,
+                 budget_bytes: int = TAG_PAIR_BUDGET_BYTES):
+        self.enabled = enabled
+        self.max_pairs = max_pairs
+        self.min_queries = min_queries
+        self.max_selectivity = max_selectivity
+        self.budget_bytes = budget_bytes
+        self.__lock = threading.Lock()
+        self.__frequencies = Counter()  # type: Counter[tuple[int, int]]
+        self.__tags = {}  # id -> Tag
+        self.__pair_sizes = {}  # type: dict[tuple[int, int], int]  выбранные пары -> размер пересечения
+
+    def record(self, photo_request: PhotosRequest):
+        """Учет пар включающих тегов запроса (без условия "лайкнуто мной")"""
+        if not self.enabled:
+            return
+        tags = sorted((condition.tag for condition in photo_request.tags_conditions
+                       if isinstance(condition, TagCondition) and condition.inclusive
+                       and not isinstance(condition.tag, LikedTag)), key=lambda tag: tag.id)
+        if len(tags) < 2:
+            return
+        with self.__lock:
+            for first_tag, second_tag in itertools.combinations(tags, 2):
+                self.__frequencies[(first_tag.id, second_tag.id)] += 1
+                self.__tags[first_tag.id] = first_tag
+                self.__tags[second_tag.id] = second_tag
+
+    def get_pairs(self):
+        """:return: dict[tuple[int, int], int] выбранные пары и размеры их пересечений"""
+        return dict(self.__pair_sizes)
+
+    def refresh(self):
+        """Выбор пар по частотам запросов и построение их пересечений"""
+        if not self.enabled:
+            return
+        with self.__lock:
+            candidates = [(pair, [self.__tags[tag_id] for tag_id in pair])
+                          for pair, cnt in self.__frequencies.most_common(self.max_pairs) if cnt >= self.min_queries]
+            self.__decay()
+
+        pair_sizes = {}
+        used_bytes = 0
+        for pair, tags in candidates:
+            tag_pair = TagPairCondition(tags=tags)
+            tag_lists = list(CacheManager.CACHE_TYPES[SortType.likes].load_necessary_caches(
+                tag_conditions=[TagCondition(tag=tag, inclusive=True) for tag in tags]))
+            cnt_photos = sum(1 for _ in sorted_list_merge(tag_lists, [True] * len(tag_lists)))
+            if cnt_photos > self.max_selectivity * (min(len(x) for x in tag_lists) - 1):
+                continue
+            # пересечение хранится для каждого вида сортировки
+            pair_bytes = (sys.getsizeof([]) + HASH_BYTES * (cnt_photos + 1)) * len(CacheManager.CACHE_TYPES)
+            if used_bytes + pair_bytes > self.budget_bytes:
+                continue
+            for photo_cache in CacheManager.CACHE_TYPES.values():
+                photo_cache.load_pair_list(tag_pair)
+            used_bytes += pair_bytes
+            pair_sizes[pair] = cnt_photos
+        self.__pair_sizes = pair_sizes
+
+    def plan(self, ordered_conditions):
+        """Замена пар включающих условий на теги готовыми пересечениями
+            (сначала пары с наименьшим пересечением)
+
+        :param ordered_conditions: list[TagCondition]
+        :return: list условий, где заменяемые пары стоят первыми
+        """
+        pair_sizes = self.__pair_sizes
+        if len(pair_sizes) == 0:
+            return ordered_conditions
+        inclusive_conditions = {condition.tag.id: condition for condition in ordered_conditions
+                                if isinstance(condition, TagCondition) and condition.inclusive}
+        pairs = sorted((size, pair) for pair, size in pair_sizes.items()
+                       if pair[0] in inclusive_conditions and pair[1] in inclusive_conditions)
+        pair_conditions = []
+        used_tags = set()
+        for _, pair in pairs:
+            if pair[0] in used_tags or pair[1] in used_tags:
+                continue
+            used_tags.update(pair)
+            pair_conditions.append(TagPairCondition(tags=[inclusive_conditions[tag_id].tag for tag_id in pair]))
+        return pair_conditions + [condition for condition in ordered_conditions
+                                  if not (isinstance(condition, TagCondition) and condition.inclusive
+                                          and condition.tag.id in used_tags)]
+
+    def __decay(self):
+        for pair in list(self.__frequencies):
+            self.__frequencies[pair] //= 2
+            if self.__frequencies[pair] == 0:
+                del self.__frequencies[pair]
+
+
+tag_pair_index = TagPairIndex()
@@ -1,16 +1,52 @@
+import html
+import os
+import re
+import tempfile
+import threading
+import time
 from datetime import datetime, timedelta
+from unittest import mock
+from django.db import DatabaseError
+from django.db.models import F, Q
 from django.test import TestCase
 from django.urls import reverse
 from django.urls.exceptions import NoReverseMatch
 from PhotoLikers.settings import LOGIN_URL
 from photo_likers.utils.photo_request import PhotosRequest, SortType
-from photo_likers.utils.tag_condition import TagCondition
-from .loading_startup_cache import load_start_cache
+from photo_likers.utils.tag_condition import TagCondition, TagOrGroup
+from photo_likers.utils.range_filter import RangeFilter, LIKES_FIELD
+from .loading_startup_cache import IndexStartup
+from .apps import is_index_startup_enabled
 from .photo_environment import PhotoEnvironment
-from .settings import PHOTOS_PER_PAGE
+from .settings import PHOTOS_PER_PAGE, FACET_BITMAP_CACHE_TEMPLATE_KEY, INDEX_STARTUP_ENV_VAR
 from .user_environment import UserEnvironment
 from .cache_manager import CacheManager
-from photo_likers.utils.sorted_list_utils import find_place_in_reversed_list, sorted_list_merge
+from photo_likers.utils.sorted_list_utils import find_place_in_reversed_list, sorted_list_merge, \
+    SearchDeadlineExceeded, MergeStats, sorted_list_union
+from photo_likers.utils.sorted_list_searcher import SortedListSearcher, SearchRequestInfo
+from photo_likers.utils.rank_select_bitmap import RankSelectBitmap, popcount
+from photo_likers.search_scheduler import SearchScheduler
+from photo_likers.derived_list_builder import DerivedListBuilder
+from photo_likers.search_warmer import SearchWarmer
+from photo_likers.likes_leaderboard import LikesLeaderboard
+from photo_likers.likes_ingestion import LikesBatcher
+from photo_likers.models import Photo, PhotoLikes
+from photo_likers.sample_generator import SampleDataGenerator, LIKES_ZIPF
+from photo_likers.benchmark import run_benchmarks, replay_slow_queries
+from photo_likers.search_harness import run_differential, run_swap_stress
+from photo_likers.page_searcher import PageSearcher
+from photo_likers.slow_query_log import SlowQueryLog
+from photo_likers.tag_pair_index import TagPairIndex
+from photo_likers.index_snapshot import IndexSnapshotStore, IndexSnapshotError
+from photo_likers.sharded_index import ShardCoordinator, LOCAL_SHARD_CLIENT
+from photo_likers.photo_caches import index_cache, SortedPhotoCacheBase, SortedPhotoLikeCache, SortedPhotoDateCache
+from photo_likers.utils.dummy_tag import DummyTag
+from photo_likers.utils.liked_tag import LIKED_TAG_ID
+from photo_likers.user_likes_index import user_likes_index
+from photo_likers.metrics import metrics
+from photo_likers.index_memory import IndexMemoryManager, estimate_list_bytes
+from photo_likers.utils.indexable_skip_list import IndexableSkipList
+from photo_likers.utils.compressed_posting_list import CompressedPostingList
 
 
 class MyTests(TestCase):
@@ -18,7 +54,8 @@ class MyTests(TestCase):
         super().setUp()
         self.__user_environment = UserEnvironment()
         self.__photo_environment = PhotoEnvironment()
-        load_start_cache()
+        # загрузка исходных кэшей синхронно, чтобы фоновая загрузка не пересекалась с тестом
+        IndexStartup(load_async=False, warmer_enabled=False).start()
 
     def setup_user(self):
         user = self.__user_environment.create_user()
@@ -47,6 +84,234 @@ class MyTests(TestCase):
             i += 1
         self.assertEqual(i, len(expected_values))
 
+    def test_merger_stats(self):
+        sorted_lists = [[12, 10, 8, 6, 4, 2, -1], [12, 8, 4, -1], [8, -1]]
+        stats = MergeStats()
+        merge = sorted_list_merge(sorted_lists=sorted_lists, inclusion_indicators=[True, True, False], stats=stats)
+        self.assertEqual(next(merge)[0], 12)
+        merge.close()
+        self.assertEqual(stats.iterations, 1)
+        self.assertEqual(stats.gallop_searches, 2)
+        stats = MergeStats()
+        list(sorted_list_merge(sorted_lists=sorted_lists, inclusion_indicators=[True, True, False], stats=stats))
+        self.assertEqual(stats.iterations, 6)
+        self.assertEqual(stats.elements_scanned, 6 + 3 + 1)
+
+    def test_sorted_list_union(self):
+        sorted_lists = [[12, 10, 8, -1], [12, 9, 8, 3, -1], [-1]]
+        self.assertListEqual(sorted_list_union(sorted_lists), [12, 10, 9, 8, 3, -1])
+        self.assertListEqual([value for value, _ in sorted_list_merge([sorted_list_union(sorted_lists), [9, 3, 2, -1]],
+                                                                      [True, False])], [12, 10, 8])
+
+    def test_merger_deadline(self):
+        sorted_lists = [list(range(100000, -2, -1)), list(range(100000, -2, -2))]
+        with self.assertRaises(SearchDeadlineExceeded):
+            list(sorted_list_merge(sorted_lists=sorted_lists, inclusion_indicators=[True, True], deadline=0))
+
+    def test_searcher_deadline_returns_approximate_info(self):
+        sorted_lists = [list(range(100000, -2, -1)), list(range(100000, -2, -2))]
+        searcher = SortedListSearcher(sorted_lists=sorted_lists, inclusion_indicators=[True, True])
+        values, search_info = searcher.search_page(page_number=1, compute_search_info=True, deadline=0)
+        self.assertTrue(search_info.is_approximate)
+        self.assertLessEqual(len(values), PHOTOS_PER_PAGE)
+
+    def test_searcher_page_only_search_estimates_pages(self):
+        sorted_lists = [list(range(1000, -2, -1)), list(range(1000, -2, -2))]
+        searcher = SortedListSearcher(sorted_lists=sorted_lists, inclusion_indicators=[True, True])
+        values, search_info = searcher.search_page(page_number=1)
+        self.assertListEqual(values, list(range(1000, 1000 - 2 * PHOTOS_PER_PAGE, -2)))
+        self.assertTrue(search_info.is_approximate)
+        self.assertAlmostEqual(search_info.num_pages, 501 // PHOTOS_PER_PAGE + 1, delta=1)
+
+    def test_scheduler_busy_expensive_lane(self):
+        scheduler = SearchScheduler(expensive_cost=10, expensive_concurrency=1, queue_seconds=0, busy_seconds=0.01)
+        sorted_lists = [list(range(100, -2, -1)), list(range(100, -2, -2))]
+        compute_flags = []
+        deadlines = []
+
+        def search(compute_search_info, deadline):
+            compute_flags.append(compute_search_info)
+            deadlines.append(deadline - time.monotonic())
+            if len(compute_flags) == 1:
+                scheduler.schedule(search, sorted_lists, search_info=None)
+            return [], None
+
+        scheduler.schedule(search, sorted_lists, search_info=None)
+        self.assertListEqual(compute_flags, [True, False])
+        # поиск вне полосы ограничен коротким дедлайном
+        self.assertLessEqual(deadlines[1], 0.01)
+        # дорогая работа при занятой полосе не ждет ее освобождения
+        self.assertListEqual(scheduler.run_expensive(lambda: ['built'], lambda: ['busy']), ['built'])
+        self.assertListEqual(scheduler.run_expensive(
+            lambda: scheduler.run_expensive(lambda: ['built'], lambda: ['busy']), lambda: None), ['busy'])
+
+    def test_derived_list_builder_builds_once(self):
+        """Одновременные запросы недостающего списка ждут одно построение в полосе дорогих поисков"""
+        builder = DerivedListBuilder()
+        scheduler = SearchScheduler(expensive_concurrency=1)
+        built_lists = {}
+        builds = []
+        started = threading.Event()
+
+        def build():
+            builds.append(1)
+            started.set()
+            time.sleep(0.05)
+            built_lists['key'] = [1, 0]
+            return built_lists['key']
+
+        results = []
+        threads = [threading.Thread(target=lambda: results.append(builder.get_or_build(
+            'key', lambda: built_lists.get('key'), lambda: scheduler.run_expensive(build, build)))) for _ in range(4)]
+        threads[0].start()
+        started.wait()
+        for thread in threads[1:]:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(len(builds), 1)
+        self.assertListEqual(results, [[1, 0]] * len(threads))
+
+    def test_rank_select_bitmap(self):
+        positions = [0, 5, 63, 64, 700, 1023]
+        bitmap = RankSelectBitmap.from_positions(positions, size=1024)
+        self.assertEqual(len(bitmap), len(positions))
+        for k, position in enumerate(positions):
+            self.assertEqual(bitmap.select(k), position)
+            self.assertEqual(bitmap.rank(position), k)
+        self.assertEqual(bitmap.rank(1024), len(positions))
+        self.assertEqual(popcount((1 << 1000) - 1), 1000)
+        self.assertEqual(popcount(0), 0)
+        self.assertRaises(IndexError, lambda: bitmap.select(len(positions)))
+
+    def test_searcher_deep_pages(self):
+        """Страницы после отметок и через select совпадают с полным перебором"""
+        sorted_lists = [list(range(3000, -2, -1)), list(range(3000, -2, -3))]
+        expected_values = list(range(3000, -1, -3))
+        searcher = SortedListSearcher(sorted_lists=sorted_lists, inclusion_indicators=[True, True], page_step=2)
+        _, search_info = searcher.search_page(page_number=1, compute_search_info=True)
+        checkpoints_info = SearchRequestInfo(num_pages=search_info.num_pages, checkpoints=search_info.checkpoints)
+        for page_number in range(1, search_info.num_pages + 1):
+            page_values = expected_values[(page_number - 1) * PHOTOS_PER_PAGE:page_number * PHOTOS_PER_PAGE]
+            for info in [search_info, checkpoints_info]:
+                values, _ = searcher.search_page(page_number=page_number, search_info=info)
+                self.assertListEqual(values, page_values)
+        self.assertRaises(ValueError, lambda: searcher.search_page(page_number=0, search_info=search_info))
+
+    def test_searcher_single_list_slice(self):
+        sorted_list = list(range(1000, -2, -1))
+        values, search_info = SortedListSearcher(sorted_lists=[sorted_list], inclusion_indicators=[True]) \
+            .search_page(page_number=3)
+        self.assertListEqual(values, sorted_list[2 * PHOTOS_PER_PAGE:3 * PHOTOS_PER_PAGE])
+        self.assertEqual(search_info.num_pages, (1001 + PHOTOS_PER_PAGE - 1) // PHOTOS_PER_PAGE)
+
+    def test_compressed_posting_list(self):
+        sorted_list = [(likes_cnt, photo_id) for likes_cnt in range(30, 0, -1)
+                       for photo_id in range(likes_cnt * 10, 0, -3)] + [(-1, -1)]
+        compressed_list = CompressedPostingList.from_sorted(sorted_list)
+        self.assertEqual(len(compressed_list), len(sorted_list))
+        self.assertListEqual(list(compressed_list), sorted_list)
+        self.assertListEqual(compressed_list[100:140], sorted_list[100:140])
+        for value, start_index in [((25, 100), 0), ((25, 100), 500), ((0, 0), 3), ((31, 1), 7), (sorted_list[300], 2)]:
+            self.assertEqual(compressed_list.find_place(value, start_index),
+                             find_place_in_reversed_list(value, sorted_list, start_index))
+
+        other_list = sorted_list[::2] + [(-1, -1)]
+        lists = [sorted_list, other_list]
+        compressed_lists = [compressed_list, CompressedPostingList.from_sorted(other_list)]
+        for inclusion_indicators in [[True, True], [True, False]]:
+            self.assertListEqual([value for value, _ in sorted_list_merge(compressed_lists, inclusion_indicators)],
+                                 [value for value, _ in sorted_list_merge(lists, inclusion_indicators)])
+
+    def test_indexable_skip_list(self):
+        values = list(range(0, 200, 2))
+        skip_list = IndexableSkipList.from_sorted(values, expected_size=len(values))
+        skip_list.insert(51)
+        skip_list.remove(100)
+        values = sorted(values + [51])
+        values.remove(100)
+        self.assertListEqual(list(skip_list), values)
+        self.assertEqual(skip_list[26], values[26])
+        self.assertEqual(skip_list.index(51), values.index(51))
+        self.assertListEqual(list(skip_list.islice(90, 120)), values[90:120])
+        self.assertRaises(ValueError, lambda: skip_list.islice(-20, 0))
+        self.assertRaises(ValueError, lambda: skip_list.remove(100))
+
+    def test_likes_leaderboard_live_updates(self):
+        leaderboard = LikesLeaderboard()
+        leaderboard.load([(likes_cnt, likes_cnt + 1) for likes_cnt in range(99, -1, -1)] + [(-1, -1)])
+        self.assertEqual(leaderboard.get_num_pages(), (100 + PHOTOS_PER_PAGE - 1) // PHOTOS_PER_PAGE)
+        self.assertEqual(leaderboard.get_page(1)[0], (99, 100))
+
+        leaderboard.update(photo_id=1, likes_cnt=1000)
+        self.assertEqual(leaderboard.get_page(1)[0], (1000, 1))
+        self.assertEqual(leaderboard.get_page(2)[0], (99 - PHOTOS_PER_PAGE + 1, 100 - PHOTOS_PER_PAGE + 1))
+        leaderboard.remove(photo_id=1)
+        self.assertEqual(leaderboard.get_page(1)[0], (99, 100))
+        self.assertEqual(len(leaderboard), 99)
+        self.assertRaises(ValueError, lambda: leaderboard.get_page(0))
+
+    def test_sharded_search(self):
+        """Мерж первых значений шардов по диапазонам id дает ту же страницу и число страниц, что и весь индекс"""
+        likes = {photo_id: (photo_id * 37) % 101 for photo_id in range(1, 501)}
+        tag_ids = {1: [x for x in likes if x % 2 == 0], 2: [x for x in likes if x % 3 == 0], 999: list(likes)}
+        lists = {0: {tag_id: sorted(((likes[x], x) for x in ids), reverse=True) + [(-1, -1)]
+                     for tag_id, ids in tag_ids.items()}}
+        snapshot_directory = tempfile.mkdtemp()
+        IndexSnapshotStore(snapshot_directory).publish({'created': datetime.now(),
+                                                        'high_water_mark': {'photo_id': 500, 'like_id': 0},
+                                                        'lists': lists})
+        for processes in [False, True]:
+            coordinator = ShardCoordinator.from_snapshot_directory(snapshot_directory, cnt_shards=3, max_photo_id=500,
+                                                                   processes=processes)
+            for include, exclude in [([999], []), ([1], [2]), ([1, 2], []), ([999], [1, 2])]:
+                expected = [value for value, _ in sorted_list_merge([lists[0][x] for x in include + exclude],
+                                                                    [True] * len(include) + [False] * len(exclude))]
+                for page_number in [1, 4]:
+                    page_hashes, num_pages = coordinator.search_page(0, include, exclude, page_number)
+                    self.assertListEqual(page_hashes,
+                                         expected[(page_number - 1) * PHOTOS_PER_PAGE:page_number * PHOTOS_PER_PAGE])
+                    self.assertEqual(num_pages, (len(expected) + PHOTOS_PER_PAGE - 1) // PHOTOS_PER_PAGE)
+            self.assertRaises(ValueError, lambda: coordinator.search_page(0, [999], [], 0))
+            coordinator.close()
+
+    def test_index_memory_budget(self):
+        sorted_list = [(i, i) for i in range(100, -1, -1)]
+        list_bytes = estimate_list_bytes(sorted_list)
+        memory = IndexMemoryManager(budget_bytes=3 * list_bytes, hot_hits=2)
+        self.assertEqual(memory.add('all', sorted_list, pinned=True), [])
+        self.assertEqual(memory.add('hot', sorted_list), [])
+        self.assertEqual(memory.add('cold', sorted_list), [])
+        memory.touch('hot')
+        memory.touch('hot')
+        memory.touch('cold')
+        # горячий список получает второй шанс, закрепленный не вытесняется
+        self.assertEqual(memory.add('new', sorted_list), ['cold'])
+        self.assertEqual(memory.add('next', sorted_list), ['new'])
+        self.assertEqual(memory.add('last', sorted_list), ['hot'])
+        self.assertIn('all', memory)
+        self.assertEqual(memory.get_stats()['used_bytes'], 3 * list_bytes)
+        self.assertEqual(memory.evictions, 3)
+
+    def test_benchmark_results(self):
+        res = run_benchmarks(cnt_photos=500, cnt_tags=2, density=0.5, repeat=1, page_numbers=[1, 2])
+        self.assertSetEqual({x['name'] for x in res['results']},
+                            {'sorted_list_merge', 'sorted_list_merge_compressed', 'search_cold', 'search_warm',
+                             'load_one_tag_cache', 'memory'})
+        self.assertEqual(res['config']['photos'], 500)
+
+    def test_searchers_differential(self):
+        """Страницы и число страниц во всех режимах поиска совпадают с поиском перебором"""
+        res = run_differential(cnt_cases=200, seed=7)
+        self.assertGreater(res['checks'], 0)
+        self.assertListEqual(res['mismatches'], [])
+
+    def test_search_during_index_swaps(self):
+        """Поиски в нескольких потоках во время публикации новых версий индекса не смешивают версии"""
+        res = run_swap_stress(cnt_threads=3, cnt_swaps=4, cnt_photos=200)
+        self.assertGreater(res['searches'], 0)
+        self.assertListEqual(res['mismatches'], [])
+
     def test_photo_request_wrong_sort_type(self):
         self.assertRaises(Exception,
                           lambda x: PhotosRequest(page_number='1', sort_field='2', tags_conditions='', tags=[]))
@@ -94,6 +359,83 @@ class MyTests(TestCase):
         references.extend(remove_condition_references)
         self.assertSetEqual({x.ref for x in all_references}, {x.ref for x in references})
 
+    def test_search_key_canonical(self):
+        tags = self.__photo_environment.setup_tags(cnt=2, name_function=lambda i: i)
+
+        def get_key(tags_condition_expr):
+            return CacheManager.get_search_key(PhotosRequest(page_number='1', sort_field='0',
+                                                             tags_conditions=tags_condition_expr, tags=tags))
+
+        self.assertEqual(get_key("{0};-{1}".format(tags[0].id, tags[1].id)),
+                         get_key("-{1};{0}".format(tags[0].id, tags[1].id)))
+        self.assertNotEqual(get_key("{0};-{1}".format(tags[0].id, tags[1].id)),
+                            get_key("{0};{1}".format(tags[0].id, tags[1].id)))
+
+    def test_search_warmer_top_requests(self):
+        tags = self.__photo_environment.setup_tags(cnt=2, name_function=lambda i: i)
+        warmer = SearchWarmer(top_n=1)
+        for page_number in ['1', '2']:
+            warmer.record(PhotosRequest(page_number=page_number, sort_field='0',
+                                        tags_conditions=str(tags[0].id), tags=tags))
+        warmer.record(PhotosRequest(page_number='1', sort_field='0', tags_conditions=str(tags[1].id), tags=tags))
+        top_requests = warmer.get_top_requests()
+        self.assertEqual(len(top_requests), 1)
+        self.assertEqual(top_requests[0].tags_conditions[0].tag.id, tags[0].id)
+
+    def test_slow_query_log_replay(self):
+        user = self.setup_user()
+        user_likes_index.clear()
+        tags = self.__photo_environment.setup_tags(cnt=2, name_function=lambda i: i)
+        photos = self.__photo_environment.setup_photos(cnt=50, likes_function=lambda i: i,
+                                                       date_function=lambda i: datetime.now() - timedelta(days=i),
+                                                       tags_function=lambda photo: tags[:1 + photo.id % 2])
+        for photo in photos[:30]:
+            PhotoLikes.objects.create(photo=photo, user=user, like_date=datetime.now().date())
+        CacheManager().load_photos_cache()
+        photo_requests = [
+            PhotosRequest(page_number='2', sort_field='0',
+                          tags_conditions="-{1};{0}".format(tags[0].id, tags[1].id), tags=tags),
+            PhotosRequest(page_number='1', sort_field='0', tags_conditions="{0};{1}".format(tags[0].id, LIKED_TAG_ID),
+                          tags=tags, user_id=user.id)]
+        with tempfile.TemporaryDirectory() as directory:
+            slow_log = SlowQueryLog(path=os.path.join(directory, 'slow.log'), threshold_seconds=0)
+            pages = [PageSearcher(CacheManager.get_sorted_photo_cache(photo_request), slow_log=slow_log)
+                     .get_pagination_by_request(photo_request) for photo_request in photo_requests]
+            entries = list(SlowQueryLog.read(slow_log.path))
+
+        self.assertEqual(len(entries), 2)
+        self.assertEqual(entries[0]['tags'], sorted(["-{0}".format(tags[1].id), str(tags[0].id)]))
+        self.assertEqual([x['tag'] for x in entries[0]['plan']], [tags[0].id, tags[1].id])
+        self.assertGreater(entries[0]['elements_scanned'], 0)
+        self.assertNotIn('user', entries[0])
+        self.assertEqual(entries[1]['user'], user.id)
+        # запись без пользователя для условия "лайкнуто мной" (например, из старого журнала) пропускается
+        entries.append({key: value for key, value in entries[1].items() if key != 'user'})
+        res = replay_slow_queries(entries, searcher_classes=[SortedListSearcher], repeat=1, tags=tags)
+        self.assertEqual(len(res['results']), 2)
+        for result, page in zip(res['results'], pages):
+            self.assertEqual(result['searchers']['SortedListSearcher']['num_pages'], page.paginator.num_pages)
+        self.assertEqual(len(res['skipped']), 1)
+
+    def test_sample_generator_bulk_insert(self):
+        cnt_photos = 25
+        tags = self.__photo_environment.setup_tags(cnt=20, name_function=lambda i: i)
+        generator = SampleDataGenerator(cnt_photos=cnt_photos, cnt_tags=len(tags), tags_per_photo=3,
+                                        likes_distribution=LIKES_ZIPF, seed=1, chunk_size=10)
+        generator.write_to_db(tags=tags)
+        self.assertEqual(Photo.objects.count(), cnt_photos)
+        self.assertEqual(Photo.tags.through.objects.count(), 3 * cnt_photos)
+        for photo in Photo.objects.all():
+            block_tag_ids = {tag.id for tag in tags[(photo.id % 2) * 10:(photo.id % 2 + 1) * 10]}
+            self.assertTrue({tag.id for tag in photo.tags.all()} <= block_tag_ids)
+
+    def test_save_photos_duplicate_tags(self):
+        """Повторы тегов фото сохраняются одной связью"""
+        tags = self.__photo_environment.setup_tags(cnt=2, name_function=lambda i: i)
+        self.__photo_environment.setup_photos(cnt=3, likes_function=lambda i: i, date_function=lambda i: datetime.now(),
+                                              tags_function=lambda photo: [tags[0], tags[1], tags[0]])
+        self.assertEqual(Photo.tags.through.objects.count(), 3 * len(tags))
+
     def test_index_view(self):
         """Стартовая страница"""
         response = self.client.get(reverse('photo_likers:index'))
@@ -147,6 +489,524 @@ class MyTests(TestCase):
         photos.reverse()
         self.assertListEqual(list(photos_list), photos)
 
+    def test_likes_batch_updates_caches(self):
+        """Пачка лайков обновляет likes_cnt в БД и порядок фото в кэшах"""
+        user = self.setup_user()
+        cnt_tags = 10
+        cnt_photos = 10
+        tags = self.__photo_environment.setup_tags(cnt=cnt_tags, name_function=lambda i: i)
+        photos = self.__photo_environment.setup_photos(cnt=cnt_photos, likes_function=lambda i: i,
+                                                       date_function=lambda i: datetime.now() + timedelta(
+                                                           days=i - cnt_photos),
+                                                       tags_function=lambda photo: tags)
+        CacheManager().load_photos_cache()
+
+        users = [user] + [self.__user_environment.create_user(name=str(i)) for i in range(1, cnt_photos)]
+        batcher = LikesBatcher(max_batch_size=cnt_photos, flush_seconds=60)
+        for like_user in users:
+            # повторный лайк в пачке не учитывается
+            batcher.add_like(user=like_user, photo_id=photos[0].id)
+            batcher.add_like(user=like_user, photo_id=photos[0].id)
+        self.assertEqual(PhotoLikes.objects.count(), cnt_photos)
+        self.assertEqual(Photo.objects.get(id=photos[0].id).likes_cnt, cnt_photos)
+        # как и лайк, уже сохраненный в БД
+        batcher.add_like(user=user, photo_id=photos[0].id)
+        batcher.flush()
+        self.assertEqual(PhotoLikes.objects.count(), cnt_photos)
+        self.assertEqual(Photo.objects.get(id=photos[0].id).likes_cnt, cnt_photos)
+
+        for tags_list in ['', str(tags[0].id)]:
+            response = self.client.get(
+                path=reverse('photo_likers:photos', kwargs={'page_number': 1, 'sort_field': 0, 'tags_list': tags_list}))
+            self.assertEqual(response.context['photos'][0], photos[0])
+
+    def test_likes_batch_failure_is_retried(self):
+        """Неудачное сохранение пачки не роняет запрос лайка: пачка остается в очереди и сохраняется позже"""
+        user = self.setup_user()
+        photos = self.__photo_environment.setup_photos(cnt=1, likes_function=lambda i: i,
+                                                       date_function=lambda i: datetime.now())
+        save = getattr(LikesBatcher, '_LikesBatcher__save')
+        attempts = []
+
+        def save_failing_once(likes):
+            attempts.append(len(likes))
+            if len(attempts) == 1:
+                raise DatabaseError("Database is unavailable")
+            return save(likes)
+
+        batcher = LikesBatcher(max_batch_size=1, flush_seconds=60)
+        with mock.patch.object(LikesBatcher, '_LikesBatcher__save', side_effect=save_failing_once), \
+                self.assertLogs('photo_likers.likes_ingestion', level='ERROR'):
+            batcher.add_like(user=user, photo_id=photos[0].id)
+            self.assertEqual(PhotoLikes.objects.count(), 0)
+            batcher.flush()
+        self.assertListEqual(attempts, [1, 1])
+        self.assertEqual(PhotoLikes.objects.count(), 1)
+        self.assertEqual(Photo.objects.get(id=photos[0].id).likes_cnt, 1)
+
+    def test_new_photo_waits_for_index_reload(self):
+        """Фото, созданное после загрузки индекса, не попадает в рейтинг по лайкам раньше, чем в списки тегов,
+            а изменение лайков фото из индекса обновляет и рейтинг, и списки тегов"""
+        self.setup_user()
+        tags = self.__photo_environment.setup_tags(cnt=1, name_function=lambda i: i)
+        photos = self.__photo_environment.setup_photos(cnt=PHOTOS_PER_PAGE + 1, likes_function=lambda i: i,
+                                                       date_function=lambda i: datetime.now() - timedelta(days=i),
+                                                       tags_function=lambda photo: tags)
+        CacheManager().load_photos_cache()
+        new_photo = Photo(path='new', created_date=datetime.now(), likes_cnt=1000)
+        new_photo.save()
+        self.assertIsNone(CacheManager.LIKES_LEADERBOARD.get_likes(new_photo.id))
+        num_pages = []
+        for sort_field in [0, 1]:
+            response = self.client.get(path=reverse('photo_likers:photos', kwargs={
+                'page_number': 1, 'sort_field': sort_field, 'tags_list': ''}))
+            self.assertNotIn(new_photo, list(response.context['photos']))
+            num_pages.append(response.context['photos'].paginator.num_pages)
+        self.assertEqual(num_pages[0], num_pages[1])
+
+        photos[-1].likes_cnt = 2000
+        photos[-1].save()
+        for tags_list in ['', str(tags[0].id)]:
+            response = self.client.get(path=reverse('photo_likers:photos', kwargs={
+                'page_number': 1, 'sort_field': 0, 'tags_list': tags_list}))
+            self.assertEqual(response.context['photos'][0], photos[-1])
+
+    def test_likes_changes_keep_unaffected_lists(self):
+        """Изменение лайков меняет хэши в объединениях тегов, удаляет только списки диапазонов лайков,
+            состав которых изменился, и не сбрасывает сохраненные поиски по спискам без измененных фото
+        """
+        self.setup_user()
+        cnt_photos = 20
+        tags = self.__photo_environment.setup_tags(cnt=4, name_function=lambda i: i)
+        photos = self.__photo_environment.setup_photos(cnt=cnt_photos, likes_function=lambda i: i,
+                                                       date_function=lambda i: datetime.now() - timedelta(days=i),
+                                                       tags_function=lambda photo: tags[:2] if photo.id % 2
+                                                       else tags[2:])
+        CacheManager().load_photos_cache()
+        odd_group, even_group = TagOrGroup(tags=tags[:2]), TagOrGroup(tags=tags[2:])
+        likes_cache, dates_cache = SortedPhotoLikeCache(), SortedPhotoDateCache()
+        for photo_cache in [likes_cache, dates_cache]:
+            photo_cache.load_union_list(odd_group)
+            photo_cache.load_union_list(even_group)
+        likes_range = RangeFilter(field=LIKES_FIELD, min_value=5, max_value=9)
+        dates_cache.load_range_list(likes_range, likes_cache)
+        derived_keys = set(SortedPhotoCacheBase.DERIVED_LIST_KEYS)
+        odd_request = PhotosRequest(page_number="1", sort_field="0", tags_conditions=str(tags[0].id), tags=tags)
+        odd_key = CacheManager.get_search_cache_key(odd_request)
+
+        photo = next(photo for photo in photos if photo.id % 2 == 0 and photo.likes_cnt < 4)
+        CacheManager.apply_likes_changes({photo.id: (photo.likes_cnt, photo.likes_cnt + 1)})
+        self.assertSetEqual(set(SortedPhotoCacheBase.DERIVED_LIST_KEYS), derived_keys)
+        even_list = list(likes_cache.get_union_list(even_group))
+        self.assertIn((photo.likes_cnt + 1, photo.id), even_list)
+        self.assertNotIn((photo.likes_cnt, photo.id), even_list)
+        self.assertListEqual(even_list, sorted(even_list, reverse=True))
+        self.assertEqual(CacheManager.get_search_cache_key(odd_request), odd_key)
+
+        CacheManager.apply_likes_changes({photo.id: (photo.likes_cnt + 1, 5)})
+        self.assertSetEqual({range_filter is not None
+                             for _, _, range_filter in SortedPhotoCacheBase.DERIVED_LIST_KEYS.values()}, {False})
+
+    def test_photos_range_filters(self):
+        """Условия на диапазоны лайков и дат по полю сортировки и по другому полю"""
+        self.setup_user()
+        cnt_photos = 50
+        tags = self.__photo_environment.setup_tags(cnt=1, name_function=lambda i: i)
+        photos = self.__photo_environment.setup_photos(cnt=cnt_photos, likes_function=lambda i: i,
+                                                       date_function=lambda i: datetime.now() - timedelta(days=i),
+                                                       tags_function=lambda photo: tags if photo.id % 2 else [])
+        CacheManager().load_photos_cache()
+
+        def get_photos(sort_field, tags_list='', **range_query):
+            path = reverse('photo_likers:photos',
+                           kwargs={'page_number': 1, 'sort_field': sort_field, 'tags_list': tags_list})
+            response = self.client.get(path, range_query)
+            self.assertEqual(response.status_code, 200)
+            return list(response.context['photos'])
+
+        self.assertListEqual(get_photos(0, min_likes=10, max_likes=19), photos[19:9:-1])
+        self.assertListEqual(get_photos(1, min_likes=40), photos[40:])
+        self.assertListEqual(get_photos(0, days=5), photos[5::-1])
+        self.assertListEqual(get_photos(0, str(tags[0].id), max_likes=9),
+                             [photo for photo in photos[9::-1] if photo.id % 2])
+        self.assertListEqual(get_photos(1, "-{0}".format(tags[0].id), days=9, min_likes=3),
+                             [photo for photo in photos[3:10] if not photo.id % 2])
+
+        response = self.client.get(reverse('photo_likers:photos', kwargs={'page_number': 1, 'sort_field': 0,
+                                                                          'tags_list': ''}), {'min_likes': '-1'})
+        self.assertEqual(response.status_code, 400)
+        response = self.client.get(reverse('photo_likers:photos', kwargs={'page_number': 1, 'sort_field': 0,
+                                                                          'tags_list': ''}), {'days': '10' * 10})
+        self.assertEqual(response.status_code, 400)
+
+    def test_photos_or_group(self):
+        """Фото хотя бы с одним из двух тегов без третьего тега"""
+        self.setup_user()
+        cnt_photos = 60
+        tags = self.__photo_environment.setup_tags(cnt=3, name_function=lambda i: i)
+
+        def photo_tags(photo): return [tag for tag, divisor in zip(tags, [2, 3, 5]) if photo.id % divisor == 0]
+
+        photos = self.__photo_environment.setup_photos(cnt=cnt_photos, likes_function=lambda i: i,
+                                                       date_function=lambda i: datetime.now() - timedelta(days=i),
+                                                       tags_function=photo_tags)
+        CacheManager().load_photos_cache()
+        tags_list = "{0}|{1};-{2}".format(tags[1].id, tags[0].id, tags[2].id)
+        expected = [photo for photo in reversed(photos)
+                    if photo.id % 5 != 0 and (photo.id % 2 == 0 or photo.id % 3 == 0)]
+        for page_number in [1, 2]:
+            response = self.client.get(reverse('photo_likers:photos', kwargs={'page_number': page_number,
+                                                                              'sort_field': 0, 'tags_list': tags_list}))
+            self.assertEqual(response.status_code, 200)
+            self.assertListEqual(list(response.context['photos']),
+                                 expected[(page_number - 1) * PHOTOS_PER_PAGE:page_number * PHOTOS_PER_PAGE])
+        self.assertIn("-{0}".format(tags[2].id), [ref.ref for ref in response.context['tag_refs']])
+
+        photo_request = PhotosRequest(page_number='1', sort_field='0', tags_conditions=tags_list, tags=tags)
+        self.assertEqual(CacheManager.get_search_key(photo_request),
+                         "0#-{2};{0}|{1}".format(*sorted(tag.id for tag in tags[:2]), tags[2].id))
+        self.assertRaises(ValueError, lambda: PhotosRequest(page_number='1', sort_field='0', tags=tags,
+                                                            tags_conditions="-{0}|{1}".format(tags[0].id, tags[1].id)))
+
+    def test_photos_facet_counts(self):
+        """Число результатов у ссылок на добавление тегов совпадает с поиском по этим ссылкам"""
+        self.setup_user()
+        tags = self.__photo_environment.setup_tags(cnt=3, name_function=lambda i: i)
+
+        def photo_tags(photo): return [tag for tag, divisor in zip(tags, [2, 3, 5]) if photo.id % divisor == 0]
+
+        self.__photo_environment.setup_photos(cnt=90, likes_function=lambda i: i,
+                                              date_function=lambda i: datetime.now() - timedelta(days=i),
+                                              tags_function=photo_tags)
+        CacheManager().load_photos_cache()
+        for sort_field, tags_list in [(1, ''), (1, "{0}".format(tags[0].id)), (0, "-{0}".format(tags[1].id))]:
+            response = self.client.get(reverse('photo_likers:photos', kwargs={
+                'page_number': 1, 'sort_field': sort_field, 'tags_list': tags_list}))
+            add_refs = [ref for ref in response.context['tag_refs'] if ref.count is not None]
+            self.assertGreater(len(add_refs), 0)
+            for ref in add_refs:
+                photo_request = PhotosRequest(page_number='1', sort_field=str(sort_field), tags_conditions=ref.ref,
+                                              tags=tags)
+                ordered_conditions = PageSearcher.order_tag_conditions(photo_request)
+                sorted_lists = PageSearcher(CacheManager.get_sorted_photo_cache(photo_request)) \
+                    .load_ordered_photo_lists(ordered_conditions)
+                expected_cnt = sum(1 for _ in sorted_list_merge(
+                    sorted_lists, [condition.inclusive for condition in ordered_conditions]))
+                self.assertEqual(ref.count, expected_cnt, ref.ref)
+        facet_key = FACET_BITMAP_CACHE_TEMPLATE_KEY.format(tags[0].id, SortedPhotoCacheBase.INDEX_VERSION)
+        self.assertIn(facet_key, SortedPhotoCacheBase.INDEX_MEMORY)
+
+        # без найденной страницы (или для другого запроса) отдельный поиск для чисел не выполняется
+        photo_request = PhotosRequest(page_number='1', sort_field='0', tags_conditions=str(tags[0].id), tags=tags)
+        page_searcher = PageSearcher(CacheManager.get_sorted_photo_cache(photo_request))
+        self.assertIsNone(page_searcher.get_facet_counts(photo_request, tags))
+        page_searcher.get_pagination_by_request(photo_request)
+        # как и для широкого запроса
+        self.assertIsNone(page_searcher.get_facet_counts(photo_request, tags, max_found=0))
+        self.assertIsNotNone(page_searcher.get_facet_counts(photo_request, tags))
+
+    def test_photos_streaming(self):
+        """Страница, отданная потоком, содержит те же фото в том же порядке и ссылки на теги"""
+        self.setup_user()
+        tags = self.__photo_environment.setup_tags(cnt=2, name_function=lambda i: i)
+        photos = self.__photo_environment.setup_photos(cnt=10, likes_function=lambda i: i,
+                                                       date_function=lambda i: datetime.now() - timedelta(days=i),
+                                                       tags_function=lambda photo: tags[:photo.id % 2])
+        CacheManager().load_photos_cache()
+        path = reverse('photo_likers:photos', kwargs={'page_number': 1, 'sort_field': 0, 'tags_list': ''})
+        response = self.client.get(path, {'stream': '1', 'min_likes': '0', 'max_likes': '100'})
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(response.streaming)
+        content = b"".join(response.streaming_content).decode()
+        self.assertTrue(content.rstrip().endswith("</html>"))
+        # ссылки сравниваются после разбора атрибутов (в html & экранируется как &amp;)
+        hrefs = {html.unescape(href) for href in re.findall(r'href="([^"]*)"', content)}
+        for tag in tags:
+            self.assertIn(reverse('photo_likers:photos', kwargs={
+                'page_number': 1, 'sort_field': 0, 'tags_list': str(tag.id)}) + "?max_likes=100&min_likes=0", hrefs)
+        photos.reverse()
+        positions = [content.index("Likes {0};".format(photo.likes_cnt)) for photo in photos]
+        self.assertListEqual(positions, sorted(positions))
+        self.assertEqual(content.count("<figure>"), len(photos))
+        self.assertIn("csrfmiddlewaretoken", content)
+
+    def test_photos_liked_by_me(self):
+        """Условие "лайкнуто мной" по лайкам пользователя, в том числе вместе с тегом и после новых лайков"""
+        user = self.setup_user()
+        user_likes_index.clear()
+        tags = self.__photo_environment.setup_tags(cnt=1, name_function=lambda i: i)
+        photos = self.__photo_environment.setup_photos(cnt=10, likes_function=lambda i: i,
+                                                       date_function=lambda i: datetime.now() - timedelta(days=i),
+                                                       tags_function=lambda photo: tags[:photo.id % 2])
+        for photo in photos[:4]:
+            PhotoLikes.objects.create(photo=photo, user=user, like_date=datetime.now().date())
+        CacheManager().load_photos_cache()
+
+        def get_photos(tags_list):
+            response = self.client.get(reverse('photo_likers:photos', kwargs={
+                'page_number': 1, 'sort_field': 0, 'tags_list': tags_list}))
+            self.assertEqual(response.status_code, 200)
+            return list(response.context['photos'])
+
+        def expected_photos(photo_filter):
+            return list(Photo.objects.filter(photo_filter).order_by('-likes_cnt', '-id'))
+
+        liked_ids = [photo.id for photo in photos[:4]]
+        self.assertListEqual(get_photos(str(LIKED_TAG_ID)), expected_photos(Q(id__in=liked_ids)))
+        self.assertListEqual(get_photos("-{0}".format(LIKED_TAG_ID)), expected_photos(~Q(id__in=liked_ids)))
+        self.assertListEqual(get_photos("{0};{1}".format(tags[0].id, LIKED_TAG_ID)),
+                             expected_photos(Q(id__in=liked_ids) & Q(tags=tags[0])))
+
+        LikesBatcher(max_batch_size=1).add_like(user, photos[5].id)
+        liked_ids.append(photos[5].id)
+        self.assertListEqual(get_photos(str(LIKED_TAG_ID)), expected_photos(Q(id__in=liked_ids)))
+        # лайк другого пользователя меняет хэш фото в построенном списке лайков так же, как в списке тега
+        other_user = self.__user_environment.create_user(name='other')
+        LikesBatcher(max_batch_size=1).add_like(other_user, next(photo.id for photo in photos[:4] if photo.id % 2))
+        self.assertListEqual(get_photos("{0};{1}".format(tags[0].id, LIKED_TAG_ID)),
+                             expected_photos(Q(id__in=liked_ids) & Q(tags=tags[0])))
+
+        # хэши списка лайков берутся из индекса, даже если число лайков в БД другое
+        liked_photo = next(photo for photo in photos[:4] if photo.id % 2)
+        Photo.objects.filter(id=liked_photo.id).update(likes_cnt=F('likes_cnt') + 100)
+        user_likes_index.clear()
+        self.assertIn(liked_photo, get_photos("{0};{1}".format(tags[0].id, LIKED_TAG_ID)))
+
+    def test_index_version_swap(self):
+        """Перезагрузка строит новую версию индекса рядом со старой и публикует ее заменой номера версии"""
+        photos = self.__photo_environment.setup_photos(cnt=10, likes_function=lambda i: i,
+                                                       date_function=lambda i: datetime.now() - timedelta(days=i))
+        CacheManager().load_photos_cache()
+        photo_request = PhotosRequest(page_number='1', sort_field='0', tags_conditions='', tags=[])
+        old_cache = CacheManager.get_sorted_photo_cache(photo_request)
+        old_list = old_cache.get_photo_hashes_for_tag(DummyTag().id)
+        self.assertEqual(len(old_list), len(photos) + 1)
+
+        new_photos = self.__photo_environment.setup_photos(cnt=5, likes_function=lambda i: 100 + i,
+                                                           date_function=lambda i: datetime.now() - timedelta(days=i))
+        CacheManager().load_photos_cache()
+        new_cache = CacheManager.get_sorted_photo_cache(photo_request)
+        self.assertEqual(new_cache.version, old_cache.version + 1)
+        self.assertEqual(len(new_cache.get_photo_hashes_for_tag(DummyTag().id)), len(photos) + len(new_photos) + 1)
+        # списки старой версии удалены из кэша, но уже полученные запросом остаются целыми
+        self.assertIsNone(index_cache.get(old_cache.get_tag_cache_key(DummyTag().id)))
+        self.assertEqual(len(old_list), len(photos) + 1)
+
+        # изменение, уже попавшее в новую версию, при повторном применении не дублирует фото
+        photo = photos[0]
+        hash_change = ((photo.likes_cnt, photo.id), (photo.likes_cnt + 1, photo.id))
+        new_cache.apply_hash_changes(DummyTag().id, [hash_change])
+        new_cache.apply_hash_changes(DummyTag().id, [hash_change])
+        new_list = new_cache.get_photo_hashes_for_tag(DummyTag().id)
+        self.assertEqual(len(new_list), len(photos) + len(new_photos) + 1)
+        self.assertIn(hash_change[1], new_list)
+
+    def test_index_snapshot_publish_and_load(self):
+        """Узел загружает индекс из снимка с проверкой sha256 и догоняет фото и лайки, добавленные после снимка
+            (в том числе лайки со старой датой)"""
+        user = self.setup_user()
+        tags = self.__photo_environment.setup_tags(cnt=2, name_function=lambda i: i)
+        photos = self.__photo_environment.setup_photos(cnt=20, likes_function=lambda i: i,
+                                                       date_function=lambda i: datetime.now() - timedelta(days=i),
+                                                       tags_function=lambda photo: tags[:photo.id % 3])
+        CacheManager().load_photos_cache()
+        store = IndexSnapshotStore(tempfile.mkdtemp(), keep_snapshots=1)
+        manifest = store.publish(CacheManager.get_index_snapshot())
+        self.assertEqual(store.get_manifest(), manifest)
+
+        photo = photos[0]
+        PhotoLikes.objects.create(photo=photo, user=user, like_date=datetime.now().date() - timedelta(days=30))
+        Photo.objects.filter(id=photo.id).update(likes_cnt=photo.likes_cnt + 1)
+        new_photo = self.__photo_environment.setup_photos(cnt=1, likes_function=lambda i: 5,
+                                                          date_function=lambda i: datetime.now(),
+                                                          tags_function=lambda photo: tags[:1])[0]
+        CacheManager().load_photos_cache(snapshot=store.load())
+        photo_request = PhotosRequest(page_number='1', sort_field='0', tags_conditions='', tags=tags)
+        photo_cache = CacheManager.get_sorted_photo_cache(photo_request)
+        all_photos_list = photo_cache.get_photo_hashes_for_tag(DummyTag().id)
+        self.assertIn((photo.likes_cnt + 1, photo.id), all_photos_list)
+        self.assertEqual(len(all_photos_list), len(photos) + 2)
+        self.assertIn(photo_cache.get_photo_hash(new_photo), all_photos_list)
+        self.assertIn(photo_cache.get_photo_hash(new_photo), photo_cache.get_photo_hashes_for_tag(tags[0].id))
+        self.assertNotIn(photo_cache.get_photo_hash(new_photo), photo_cache.get_photo_hashes_for_tag(tags[1].id))
+        date_cache = CacheManager.CACHE_TYPES[SortType.dates]
+        self.assertIn(date_cache.get_photo_hash(new_photo), date_cache.get_photo_hashes_for_tag(DummyTag().id))
+        # повторная загрузка того же снимка не добавляет фото второй раз
+        CacheManager().load_photos_cache(snapshot=store.load())
+        self.assertEqual(len(photo_cache.at_version(SortedPhotoCacheBase.INDEX_VERSION)
+                             .get_photo_hashes_for_tag(DummyTag().id)), len(photos) + 2)
+
+        with open(os.path.join(store.directory, manifest['file']), 'ab') as snapshot_file:
+            snapshot_file.write(b'0')
+        self.assertRaises(IndexSnapshotError, store.load)
+
+    def test_tag_pair_index(self):
+        """Готовое пересечение частой пары тегов заменяет пару условий в плане поиска"""
+        cnt_photos = 60
+        tags = self.__photo_environment.setup_tags(cnt=3, name_function=lambda i: i)
+
+        def photo_tags(photo): return [tag for tag, divisor in zip(tags, [2, 3, 5]) if photo.id % divisor == 0]
+
+        photos = self.__photo_environment.setup_photos(cnt=cnt_photos, likes_function=lambda i: i,
+                                                       date_function=lambda i: datetime.now() - timedelta(days=i),
+                                                       tags_function=photo_tags)
+        CacheManager().load_photos_cache()
+        photo_request = PhotosRequest(page_number='1', sort_field='0', tags=tags,
+                                      tags_conditions="{0};{1};-{2}".format(tags[0].id, tags[1].id, tags[2].id))
+        pair_index = TagPairIndex(enabled=True, min_queries=2, max_selectivity=0.5)
+        pair_index.record(photo_request)
+        pair_index.refresh()
+        self.assertDictEqual(pair_index.get_pairs(), {})
+
+        pair_index.record(photo_request)
+        pair_index.record(photo_request)
+        pair_index.refresh()
+        pair = tuple(sorted(tag.id for tag in tags[:2]))
+        expected = [photo for photo in reversed(photos) if photo.id % 6 == 0 and photo.id % 5 != 0]
+        self.assertDictEqual(pair_index.get_pairs(), {pair: cnt_photos // 6})
+
+        ordered_conditions = PageSearcher.order_tag_conditions(photo_request, pair_index=pair_index)
+        self.assertListEqual([condition.key() for condition in ordered_conditions],
+                             ["{0}&{1}".format(*pair), "-{0}".format(tags[2].id)])
+        page_searcher = PageSearcher(CacheManager.get_sorted_photo_cache(photo_request))
+        page = page_searcher.search_page_in_ordered_photo_lists(
+            photo_request, ordered_conditions,
+            *page_searcher.load_photo_lists_with_search_key(photo_request, ordered_conditions))
+        self.assertListEqual(list(page), expected)
+
+        # без построенного пересечения поиск идет по спискам пары, а пересечение строится в фоне
+        list_builder = DerivedListBuilder()
+        photo_cache = CacheManager.get_sorted_photo_cache(photo_request)
+        page_searcher = PageSearcher(photo_cache, list_builder=list_builder)
+        index_cache.delete(photo_cache.get_pair_cache_key(ordered_conditions[0]))
+        planned_conditions = page_searcher.plan_tag_conditions(photo_request, pair_index=pair_index)
+        self.assertListEqual(sorted(condition.key() for condition in planned_conditions),
+                             sorted([str(pair[0]), str(pair[1]), "-{0}".format(tags[2].id)]))
+        page = page_searcher.search_page_in_ordered_photo_lists(
+            photo_request, planned_conditions,
+            *page_searcher.load_photo_lists_with_search_key(photo_request, planned_conditions))
+        self.assertListEqual(list(page), expected)
+        list_builder.join()
+        self.assertTrue(photo_cache.has_pair_list(ordered_conditions[0]))
+        self.assertListEqual([condition.key() for condition in
+                              page_searcher.plan_tag_conditions(photo_request, pair_index=pair_index)],
+                             [condition.key() for condition in ordered_conditions])
+
+    def test_index_startup_readiness(self):
+        """Индекс запускается только при явном включении и сообщает о готовности"""
+        self.assertTrue(is_index_startup_enabled(['gunicorn', 'PhotoLikers.wsgi'], {INDEX_STARTUP_ENV_VAR: '1'}))
+        self.assertTrue(is_index_startup_enabled(['manage.py', 'runserver', '--noreload'], {}))
+        self.assertFalse(is_index_startup_enabled(['manage.py', 'runserver'], {}))
+        self.assertFalse(is_index_startup_enabled(['gunicorn', 'PhotoLikers.wsgi'], {}))
+        self.assertFalse(is_index_startup_enabled(['celery', 'worker'], {}))
+        self.assertFalse(is_index_startup_enabled(['manage.py', 'migrate'], {}))
+
+        statuses = []
+        startup = IndexStartup(load_async=False, warmer_enabled=False,
+                               reload_func=lambda: statuses.append(startup.get_state()['status']))
+        self.assertEqual(startup.get_state()['status'], 'not_started')
+        self.assertFalse(startup.is_ready())
+        startup.start()
+        self.assertListEqual(statuses, ['loading'])
+        self.assertTrue(startup.is_ready())
+        self.assertIsNotNone(startup.get_state()['ready_seconds'])
+
+        def fail():
+            raise RuntimeError("no database")
+
+        startup = IndexStartup(load_async=False, warmer_enabled=False, reload_func=fail)
+        startup.start()
+        self.assertFalse(startup.is_ready())
+        self.assertEqual(startup.get_state()['status'], 'failed')
+        self.assertEqual(startup.get_state()['error'], "no database")
+
+        # процесс тестов общий индекс (index_startup) не запускает
+        response = self.client.get(reverse('photo_likers:ready'))
+        self.assertEqual(response.status_code, 503)
+        self.assertEqual(response.json()['status'], 'not_started')
+
+    def test_index_startup_shards(self):
+        """Шарды запускаются при старте индекса по последнему снимку и дают те же страницы по дате"""
+        self.setup_user()
+        tags = self.__photo_environment.setup_tags(cnt=2, name_function=lambda i: i)
+        self.__photo_environment.setup_photos(cnt=50, likes_function=lambda i: i,
+                                              date_function=lambda i: datetime.now() - timedelta(days=i),
+                                              tags_function=lambda photo: tags[:photo.id % 3])
+        CacheManager().load_photos_cache()
+        snapshot_directory = tempfile.mkdtemp()
+        IndexSnapshotStore(snapshot_directory).publish(CacheManager.get_index_snapshot())
+        # без каталога снимков страницы ищутся по кэшам процесса
+        startup = IndexStartup(load_async=False, warmer_enabled=False, reload_func=lambda: None, cnt_shards=2,
+                               snapshot_directory=None)
+        startup.start()
+        self.assertTrue(startup.is_ready())
+        self.assertIsNone(startup.shard_coordinator)
+        self.assertRaises(ValueError, lambda: IndexStartup(cnt_shards=2, shard_client='remote'))
+
+        startup = IndexStartup(load_async=False, warmer_enabled=False, reload_func=lambda: None, cnt_shards=2,
+                               shard_client=LOCAL_SHARD_CLIENT, snapshot_directory=snapshot_directory)
+        startup.start()
+        self.assertTrue(startup.is_ready())
+        self.assertEqual(len(startup.shard_coordinator.clients), 2)
+        for tags_list in ['', str(tags[0].id), "{0};-{1}".format(tags[0].id, tags[1].id)]:
+            photo_request = PhotosRequest(page_number='2', sort_field='1', tags_conditions=tags_list, tags=tags)
+            photo_cache = CacheManager.get_sorted_photo_cache(photo_request)
+            expected = PageSearcher(photo_cache).get_pagination_by_request(photo_request)
+            page = PageSearcher(photo_cache, shard_coordinator=startup.shard_coordinator) \
+                .get_pagination_by_request(photo_request)
+            self.assertListEqual(list(page), list(expected))
+            self.assertEqual(page.paginator.num_pages, expected.paginator.num_pages)
+        startup.shard_coordinator.close()
+
+    def test_photos_timings_and_metrics(self):
+        """Заголовок Server-Timing у страницы и метрики в формате Prometheus"""
+        self.setup_user()
+        response = self.client.get(
+            path=reverse('photo_likers:photos', kwargs={'page_number': 1, 'sort_field': 1, 'tags_list': ''}))
+        self.assertIn('search;dur=', response['Server-Timing'])
+        self.assertIn('render;dur=', response['Server-Timing'])
+
+        response = self.client.get(reverse('photo_likers:metrics'))
+        self.assertEqual(response.status_code, 200)
+        self.assertIn('photo_likers_stage_seconds_count{stage="search"}', response.content.decode())
+        self.assertGreater(metrics.get_value('photo_likers_search_cache_misses_total') +
+                           metrics.get_value('photo_likers_search_cache_hits_total'), 0)
+
+    def test_photos_profiled_for_staff(self):
+        """Профилирование по флагу только для персонала и не чаще заданного интервала"""
+        user = self.setup_user()
+        path = reverse('photo_likers:photos', kwargs={'page_number': 1, 'sort_field': 1, 'tags_list': ''})
+        response = self.client.get(path, {'profile': '1'})
+        self.assertNotIn('X-Profile-Url', response)
+
+        user.is_staff = True
+        user.save()
+        response = self.client.get(path, {'profile': '1'})
+        self.assertIn('X-Profile-Url', response)
+        response_profile = self.client.get(response['X-Profile-Url'])
+        self.assertEqual(response_profile.status_code, 200)
+        self.assertIn('get_pagination_by_request', response_profile.content.decode())
+        response_profile = self.client.get(response['X-Profile-Url'], {'format': 'pstats'})
+        self.assertEqual(response_profile['Content-Type'], 'application/octet-stream')
+
+        response = self.client.get(path, HTTP_X_PROFILE='1')
+        self.assertNotIn('X-Profile-Url', response)
+
+    def test_photos_zero_page(self):
+        """Нулевая страница - ошибка запроса, в том числе при сохраненной информации о поиске"""
+        self.setup_user()
+        tags = self.__photo_environment.setup_tags(cnt=1, name_function=lambda i: i)
+        self.__photo_environment.setup_photos(cnt=5, likes_function=lambda i: i,
+                                              date_function=lambda i: datetime.now() - timedelta(days=i),
+                                              tags_function=lambda photo: tags)
+        CacheManager().load_photos_cache()
+        for page_number in [1, 0]:
+            response = self.client.get(reverse('photo_likers:photos', kwargs={
+                'page_number': page_number, 'sort_field': 0, 'tags_list': "-{0}".format(tags[0].id)}))
+            self.assertEqual(response.status_code, 200 if page_number == 1 else 400)
+        self.assertRaises(ValueError, lambda: PhotosRequest(page_number='0', sort_field='0', tags_conditions='',
+                                                            tags=[]))
+
     def test_photos_wrong_sort_type(self):
         """Проверка что нет reverse при неправильном типе сортировки"""
         with self.assertRaises(NoReverseMatch):
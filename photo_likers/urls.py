@@ -8,5 +8,10 @@ urlpatterns = [
     url(r'^$', views.index, name='index'),
     url(r'^photos/sort=(?P<sort_field>[0-1])&tags=(?P<tags_list>[0-9|;|-]*)&page=(?P<page_number>[0-9]+)$',
         views.photos_view, name='photos'),
+    url(r'^photos/(?P<photo_id>[0-9]+)/like$', views.like_photo_view, name='like'),
     url(r'^login/$', login, name='login'),
+    url(r'^metrics$', views.metrics_view, name='metrics'),
+    url(r'^ready$', views.ready_view, name='ready'),
+    url(r'^profiles/$', views.profiles_view, name='profiles'),
+    url(r'^profiles/(?P<profile_id>[0-9a-f]+)$', views.profile_view, name='profile'),
 ]
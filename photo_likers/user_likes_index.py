@@ -0,0 +1,188 @@
+import itertools
+import threading
+from collections import OrderedDict
+from photo_likers.models import Photo
+from photo_likers.photo_caches import SortedPhotoCacheBase, SortedPhotoLikeCache, SortedPhotoDateCache
+from photo_likers.settings import USER_LIKES_CACHE_SIZE
+from photo_likers.utils.sorted_list_utils import reversed_list_replace
+
+# вид сортировки -> класс кэша (для хэшей новых фото в списках)
+PHOTO_CACHE_CLASSES = {cache_class.sort_field: cache_class for cache_class in (SortedPhotoLikeCache,
+                                                                                 SortedPhotoDateCache)}
+
+
+class UserLikes:
+    """Лайкнутые пользователем фото и построенные по ним списки"""
+
+    def __init__(self, photos, generation: int):
+        self.photos = photos  # type: dict[int, Photo]
+        self.lists = {}  # type: dict[tuple[int, int], list[tuple]]  (вид сортировки, версия индекса) -> список
+        self.generation = generation
+
+
+class UserLikesIndex:
+    """Лайки пользователей для условия "лайкнуто мной" (LikedTag).
+
+       Фото, лайкнутые пользователем, загружаются из БД одним запросом при первом поиске
+       с условием и хранятся для последних max_users пользователей (LRU). По ним строится
+       упорядоченный список хэшей того же вида, что и списки тегов, поэтому условие
+       включается в мерж как еще один включающий или исключающий список. Хэши берутся из индекса
+       той версии, по которой идет поиск (см. SortedPhotoCacheBase.get_indexed_hashes), а не из БД.
+       Загрузка лайков и построение списков идут вне общей блокировки: загрузку одного пользователя
+       ждут только запросы этого пользователя.
+       Новые лайки и изменения числа лайков применяются к загруженным пользователям
+       после сохранения пачки лайков (см. LikesBatcher): в построенных списках хэши заменяются
+       на месте, как в списках тегов. Поколение пользователя меняется
+       при каждом изменении и входит в ключ сохраненной информации о поиске
+    """
+
+    def __init__(self, max_users: int = USER_LIKES_CACHE_SIZE):
+        self.max_users = max_users
+        self.__users = OrderedDict()  # type: dict[int, UserLikes]
+        self.__photo_users = {}  # type: dict[int, set[int]]
+        # пользователи, лайки которых сейчас загружаются -> [окончание загрузки, были ли новые лайки за загрузку]
+        self.__loading = {}  # type: dict[int, list]
+        self.__generations = itertools.count()
+        self.__lock = threading.Lock()
+
+    def get_list(self, user_id: int, photo_cache: SortedPhotoCacheBase):
+        """Упорядоченный список хэшей лайкнутых фото для сортировки и версии кэша (с фиктивным значением в конце)"""
+        user_likes = self.__get_user_likes(user_id)
+        list_key = (photo_cache.sort_field, photo_cache.version)
+        with self.__lock:
+            res = user_likes.lists.get(list_key)
+            if res is not None:
+                return res
+            photos = list(user_likes.photos.values())
+            generation = user_likes.generation
+        res = sorted(photo_cache.get_indexed_hashes(photos), reverse=True)
+        res.append(photo_cache.get_min_hash())
+        with self.__lock:
+            # список сохраняется, только если лайки пользователя не менялись, пока он строился
+            if user_likes.generation == generation:
+                user_likes.lists = {key: value for key, value in user_likes.lists.items()
+                                    if key[0] != photo_cache.sort_field}
+                user_likes.lists[list_key] = res
+        return res
+
+    def get_photo_ids(self, user_id: int):
+        """:return: set[int] id лайкнутых пользователем фото"""
+        user_likes = self.__get_user_likes(user_id)
+        with self.__lock:
+            return set(user_likes.photos)
+
+    def get_generation(self, user_id: int) -> int:
+        return self.__get_user_likes(user_id).generation
+
+    def apply_likes(self, likes, likes_changes):
+        """Применение сохраненной пачки лайков к загруженным пользователям
+
+        :param likes: list[PhotoLikes] новые лайки
+        :param likes_changes: dict[int, tuple[int, int]] id фото -> (старое, новое число лайков)
+        """
+        with self.__lock:
+            for like in likes:
+                if like.user_id in self.__loading:
+                    self.__loading[like.user_id][1] = True
+            new_likes = {(like.user_id, like.photo_id) for like in likes
+                         if like.user_id in self.__users and like.photo_id not in self.__users[like.user_id].photos}
+        photos = {}
+        if len(new_likes) > 0:
+            photos = {photo.id: photo for photo in Photo.objects.filter(
+                id__in={photo_id for _, photo_id in new_likes}).only('id', 'likes_cnt', 'created_date')}
+
+        with self.__lock:
+            user_changes = {}  # type: dict[int, tuple[list, list]]  id пользователя -> (измененные фото, новые фото)
+            for photo_id in likes_changes:
+                for user_id in self.__photo_users.get(photo_id, ()):
+                    user_changes.setdefault(user_id, ([], []))[0].append(photo_id)
+            for user_id, photo_id in new_likes:
+                if photo_id in photos and user_id in self.__users and photo_id not in self.__users[user_id].photos:
+                    self.__users[user_id].photos[photo_id] = photos[photo_id]
+                    self.__photo_users.setdefault(photo_id, set()).add(user_id)
+                    user_changes.setdefault(user_id, ([], []))[1].append(photo_id)
+
+            for user_id, (changed_photo_ids, new_photo_ids) in user_changes.items():
+                user_likes = self.__users[user_id]
+                for photo_id in changed_photo_ids:
+                    user_likes.photos[photo_id].likes_cnt = likes_changes[photo_id][1]
+                user_likes.lists = {list_key: self.__apply_list_changes(list_key, photo_hashes, user_likes,
+                                                                        changed_photo_ids, new_photo_ids,
+                                                                        likes_changes)
+                                    for list_key, photo_hashes in user_likes.lists.items()}
+                user_likes.generation = next(self.__generations)
+
+    def clear(self):
+        with self.__lock:
+            self.__users.clear()
+            self.__photo_users.clear()
+
+    @staticmethod
+    def __apply_list_changes(list_key, photo_hashes, user_likes: UserLikes, changed_photo_ids, new_photo_ids,
+                             likes_changes):
+        """Замена хэшей фото с изменившимися лайками и добавление новых фото в копии списка
+            (по исходному списку может идти поиск). Для сортировки по лайкам хэши берутся
+            из изменений лайков, как и в списках тегов индекса
+        """
+        sort_field = list_key[0]
+        hash_changes = []  # type: list[tuple[tuple, tuple]]  (старый хэш, новый хэш)
+        for photo_id in new_photo_ids + (changed_photo_ids if sort_field == SortedPhotoLikeCache.sort_field else []):
+            if sort_field == SortedPhotoLikeCache.sort_field and photo_id in likes_changes:
+                old_likes_cnt, new_likes_cnt = likes_changes[photo_id]
+                hash_changes.append(((old_likes_cnt, photo_id), (new_likes_cnt, photo_id)))
+            else:
+                hash_value = PHOTO_CACHE_CLASSES[sort_field].get_photo_hash(user_likes.photos[photo_id])
+                hash_changes.append((hash_value, hash_value))
+        if len(hash_changes) == 0:
+            return photo_hashes
+        # новый хэш тоже удаляется, чтобы фото не попало в список дважды
+        removed_values = [hash_value for change in hash_changes for hash_value in change]
+        added_values = [new_hash for _, new_hash in hash_changes]
+        return reversed_list_replace(list(photo_hashes), removed_values=removed_values, added_values=added_values)
+
+    def __get_user_likes(self, user_id: int) -> UserLikes:
+        """Лайки пользователя: загружаются из БД один раз, одновременные запросы ждут этой загрузки"""
+        while True:
+            with self.__lock:
+                user_likes = self.__users.get(user_id)
+                if user_likes is not None:
+                    self.__users.move_to_end(user_id)
+                    return user_likes
+                loading = self.__loading.get(user_id)
+                if loading is None:
+                    loading = self.__loading[user_id] = [threading.Event(), False]
+                    break
+            loading[0].wait()
+        try:
+            while True:
+                photos = Photo.objects.filter(photolikes__user_id=user_id).distinct() \
+                    .only('id', 'likes_cnt', 'created_date')
+                photos = {photo.id: photo for photo in photos}
+                with self.__lock:
+                    # лайки, сохраненные во время запроса, могли в него не попасть - загружаем заново
+                    if loading[1]:
+                        loading[1] = False
+                        continue
+                    return self.__add_user(user_id, photos)
+        finally:
+            with self.__lock:
+                self.__loading.pop(user_id)
+            loading[0].set()
+
+    def __add_user(self, user_id: int, photos) -> UserLikes:
+        """Добавление загруженного пользователя с вытеснением самого давнего (под self.__lock)"""
+        user_likes = UserLikes(photos=photos, generation=next(self.__generations))
+        self.__users[user_id] = user_likes
+        for photo_id in user_likes.photos:
+            self.__photo_users.setdefault(photo_id, set()).add(user_id)
+        if len(self.__users) > self.max_users:
+            evicted_user_id, evicted = self.__users.popitem(last=False)
+            for photo_id in evicted.photos:
+                photo_users = self.__photo_users[photo_id]
+                photo_users.discard(evicted_user_id)
+                if len(photo_users) == 0:
+                    del self.__photo_users[photo_id]
+        return user_likes
+
+
+user_likes_index = UserLikesIndex()
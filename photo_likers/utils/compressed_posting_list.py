@@ -0,0 +1,124 @@
+from array import array
+from bisect import bisect_left
+
+# сколько значений в одном блоке
+BLOCK_SIZE = 128
+# сколько бит отводится под id фото в закодированном значении
+ID_BITS = 32
+ID_MASK = (1 << ID_BITS) - 1
+MIN_HASH = (-1, -1)
+
+
+class CompressedPostingList:
+    """Сжатый упорядоченный по убыванию список хэшей (ключ, id) с фиктивным значением в конце.
+
+       Хэш кодируется одним числом ключ << 32 | id. Значения разбиты на блоки по BLOCK_SIZE:
+       для блока хранится первое (наибольшее) значение - указатель для пропуска блоков,
+       и упакованные в одно число отступы остальных значений от первого с одинаковой
+       для блока шириной в битах. Поэтому доступ по индексу - O(1), а поиск места
+       значения (find_place) - бинарный поиск по первым значениям блоков и поиск внутри блока.
+
+       Поддерживает то, что нужно поиску от обычного списка: len, индексы, срезы и итерацию.
+       Хэши должны быть неотрицательными и id < 2 ** 32.
+    """
+
+    def __init__(self, cnt_values: int, neg_heads, widths, blocks):
+        self.cnt_values = cnt_values  # число значений без фиктивного
+        self.__neg_heads = neg_heads  # type: array  первые значения блоков со знаком минус (по возрастанию)
+        self.__widths = widths  # type: array  ширина отступа в битах для каждого блока
+        self.__blocks = blocks  # type: list[int]  упакованные отступы
+
+    @classmethod
+    def from_sorted(cls, sorted_hashes):
+        """Сжатие упорядоченного по убыванию списка хэшей (фиктивное значение в конце отбрасывается)
+
+        :param sorted_hashes: list[tuple[int, int]]
+        """
+        codes = [cls.__encode(hash_value) for hash_value in sorted_hashes if hash_value != MIN_HASH]
+        neg_heads = array('q')
+        widths = array('B')
+        blocks = []
+        for block_start in range(0, len(codes), BLOCK_SIZE):
+            block_codes = codes[block_start:block_start + BLOCK_SIZE]
+            head = block_codes[0]
+            width = max(1, (head - block_codes[-1]).bit_length())
+            packed = 0
+            for j in range(len(block_codes) - 1, -1, -1):
+                packed = (packed << width) | (head - block_codes[j])
+            neg_heads.append(-head)
+            widths.append(width)
+            blocks.append(packed)
+        return cls(len(codes), neg_heads, widths, blocks)
+
+    def __len__(self):
+        return self.cnt_values + 1
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [self[i] for i in range(*index.indices(len(self)))]
+        if index < 0:
+            index += len(self)
+        if index == self.cnt_values:
+            return MIN_HASH
+        if not 0 <= index < self.cnt_values:
+            raise IndexError("CompressedPostingList index out of range")
+        code = self.__get_code(index)
+        return code >> ID_BITS, code & ID_MASK
+
+    def __iter__(self):
+        for block_index, packed in enumerate(self.__blocks):
+            head = -self.__neg_heads[block_index]
+            width = self.__widths[block_index]
+            mask = (1 << width) - 1
+            for _ in range(min(BLOCK_SIZE, self.cnt_values - block_index * BLOCK_SIZE)):
+                code = head - (packed & mask)
+                yield code >> ID_BITS, code & ID_MASK
+                packed >>= width
+        yield MIN_HASH
+
+    def to_list(self):
+        return list(self)
+
+    def find_place(self, value: tuple, start_index: int) -> int:
+        """Первый индекс не меньше start_index со значением не больше value
+            (то же, что find_place_in_reversed_list для обычного списка)"""
+        if start_index >= self.cnt_values or value[0] < 0:
+            return max(start_index, self.cnt_values)
+        code = self.__encode(value)
+        if self.__get_code(start_index) <= code:
+            return start_index
+        start_block = start_index // BLOCK_SIZE
+        # первый блок, начинающийся со значения не больше искомого
+        next_block = bisect_left(self.__neg_heads, -code, start_block + 1)
+        block_index = next_block - 1
+        head = -self.__neg_heads[block_index]
+        width = self.__widths[block_index]
+        packed = self.__blocks[block_index]
+        mask = (1 << width) - 1
+        min_offset = head - code  # значения с отступом не меньше этого не больше искомого
+        lo = max(start_index - block_index * BLOCK_SIZE, 0)
+        hi = min(BLOCK_SIZE, self.cnt_values - block_index * BLOCK_SIZE)
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if (packed >> (mid * width)) & mask >= min_offset:
+                hi = mid
+            else:
+                lo = mid + 1
+        return block_index * BLOCK_SIZE + lo
+
+    def get_size_bytes(self) -> int:
+        """Оценка занимаемой памяти"""
+        return self.__neg_heads.itemsize * len(self.__neg_heads) + len(self.__widths) + \
+            sum((width * BLOCK_SIZE + 7) // 8 + 28 for width in self.__widths) + 8 * len(self.__blocks)
+
+    def __get_code(self, index: int) -> int:
+        block_index, j = divmod(index, BLOCK_SIZE)
+        width = self.__widths[block_index]
+        return -self.__neg_heads[block_index] - ((self.__blocks[block_index] >> (j * width)) & ((1 << width) - 1))
+
+    @staticmethod
+    def __encode(hash_value: tuple) -> int:
+        key, photo_id = hash_value
+        if key < 0 or not 0 <= photo_id <= ID_MASK:
+            raise ValueError("Hash can not be compressed: {0}".format(hash_value))
+        return (key << ID_BITS) | photo_id
@@ -3,8 +3,10 @@ class CustomPaginator:
         для экономии времени на переделывание шаблона страницы с фото и
     """
 
-    def __init__(self, num_pages: int):
+    def __init__(self, num_pages: int, is_approximate: bool = False):
         self.num_pages = num_pages
+        # число страниц оценено по части просмотренных фото
+        self.is_approximate = is_approximate
 
     def validate_number(self, number: int):
         try:
@@ -0,0 +1,157 @@
+import math
+import random
+
+
+class _Infinity:
+    """Значение фиктивного последнего узла, больше любого другого значения"""
+
+    def __lt__(self, other):
+        return False
+
+    def __le__(self, other):
+        return False
+
+    def __gt__(self, other):
+        return True
+
+    def __ge__(self, other):
+        return True
+
+
+class _Node:
+    __slots__ = ('value', 'next', 'width')
+
+    def __init__(self, value, level: int):
+        self.value = value
+        self.next = [None] * level  # type: list[_Node]
+        # width[i] - на сколько позиций вперед ведет ссылка next[i]
+        self.width = [1] * level  # type: list[int]
+
+
+class IndexableSkipList:
+    """Упорядоченный по возрастанию список (skip list с ширинами ссылок):
+        вставка, удаление, доступ по индексу и поиск индекса значения за O(log n)
+    """
+
+    def __init__(self, expected_size: int = 1000):
+        self.__max_level = max(1, int(math.log(max(expected_size, 2), 2)) + 1)
+        self.__tail = _Node(_Infinity(), 0)
+        self.__head = _Node(None, self.__max_level)
+        self.__head.next = [self.__tail] * self.__max_level
+        self.__size = 0
+
+    @classmethod
+    def from_sorted(cls, values, expected_size: int = 1000):
+        """Построение за O(n) по уже упорядоченным по возрастанию значениям"""
+        skip_list = cls(expected_size=expected_size)
+        max_level = skip_list.__max_level
+        last_nodes = [skip_list.__head] * max_level
+        last_positions = [0] * max_level
+        position = 0
+        for value in values:
+            position += 1
+            node = _Node(value, skip_list.__random_level())
+            for level in range(len(node.next)):
+                last_nodes[level].next[level] = node
+                last_nodes[level].width[level] = position - last_positions[level]
+                last_nodes[level] = node
+                last_positions[level] = position
+        for level in range(max_level):
+            last_nodes[level].next[level] = skip_list.__tail
+            last_nodes[level].width[level] = position + 1 - last_positions[level]
+        skip_list.__size = position
+        return skip_list
+
+    def __len__(self):
+        return self.__size
+
+    def __iter__(self):
+        return self.islice(0, self.__size)
+
+    def __getitem__(self, index: int):
+        if not 0 <= index < self.__size:
+            raise IndexError("Skip list index out of range")
+        return self.__get_node(index).value
+
+    def islice(self, start: int, stop: int):
+        """Итератор по значениям с индексами [start, stop) (ValueError при отрицательном start)"""
+        if start < 0:
+            raise ValueError("Negative start index: {0}".format(start))
+        return self.__iter_range(start, min(stop, self.__size))
+
+    def __iter_range(self, start: int, stop: int):
+        if start >= stop:
+            return
+        node = self.__get_node(start)
+        for _ in range(stop - start):
+            yield node.value
+            node = node.next[0]
+
+    def index(self, value) -> int:
+        """Индекс значения в списке (ValueError, если значения нет)"""
+        node = self.__head
+        position = 0
+        for level in reversed(range(self.__max_level)):
+            while node.next[level].value < value:
+                position += node.width[level]
+                node = node.next[level]
+        if node.next[0] is self.__tail or node.next[0].value != value:
+            raise ValueError("Value is not in the skip list")
+        return position
+
+    def insert(self, value):
+        chain = [None] * self.__max_level
+        steps_at_level = [0] * self.__max_level
+        node = self.__head
+        for level in reversed(range(self.__max_level)):
+            while node.next[level].value <= value:
+                steps_at_level[level] += node.width[level]
+                node = node.next[level]
+            chain[level] = node
+
+        new_node = _Node(value, self.__random_level())
+        steps = 0
+        for level in range(len(new_node.next)):
+            prev_node = chain[level]
+            new_node.next[level] = prev_node.next[level]
+            prev_node.next[level] = new_node
+            new_node.width[level] = prev_node.width[level] - steps
+            prev_node.width[level] = steps + 1
+            steps += steps_at_level[level]
+        for level in range(len(new_node.next), self.__max_level):
+            chain[level].width[level] += 1
+        self.__size += 1
+
+    def remove(self, value):
+        chain = [None] * self.__max_level
+        node = self.__head
+        for level in reversed(range(self.__max_level)):
+            while node.next[level].value < value:
+                node = node.next[level]
+            chain[level] = node
+        removed_node = chain[0].next[0]
+        if removed_node is self.__tail or removed_node.value != value:
+            raise ValueError("Value is not in the skip list")
+
+        for level in range(len(removed_node.next)):
+            prev_node = chain[level]
+            prev_node.width[level] += removed_node.width[level] - 1
+            prev_node.next[level] = removed_node.next[level]
+        for level in range(len(removed_node.next), self.__max_level):
+            chain[level].width[level] -= 1
+        self.__size -= 1
+
+    def __get_node(self, index: int) -> _Node:
+        node = self.__head
+        index += 1
+        for level in reversed(range(self.__max_level)):
+            while node.width[level] <= index:
+                index -= node.width[level]
+                node = node.next[level]
+        return node
+
+    def __random_level(self) -> int:
+        level = 1
+        while level < self.__max_level and random.getrandbits(1):
+            level += 1
+        return level
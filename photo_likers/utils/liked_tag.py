@@ -0,0 +1,12 @@
+LIKED_TAG_ID = 999999998
+
+
+class LikedTag:
+    """Специальный тег "лайкнуто мной": прикреплен к фото, которые лайкнул пользователь.
+       Список фото строится по лайкам пользователя (см. UserLikesIndex), а не по тегам фото
+    """
+
+    def __init__(self, user_id: int):
+        self.user_id = user_id
+        self.id = LIKED_TAG_ID
+        self.name = "liked by me"
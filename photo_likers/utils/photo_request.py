@@ -1,6 +1,9 @@
 from enum import Enum
+from urllib.parse import urlencode
 from photo_likers.models import Tag
-from photo_likers.utils.tag_condition import TagCondition, TagConditionsLink
+from photo_likers.utils.liked_tag import LikedTag, LIKED_TAG_ID
+from photo_likers.utils.range_filter import RangeFilter, RANGE_PARAMETERS
+from photo_likers.utils.tag_condition import TagCondition, TagConditionsLink, TagOrGroup
 
 
 class SortType(Enum):
@@ -9,34 +12,94 @@ class SortType(Enum):
 
 
 class PhotosRequest:
-    def __init__(self, page_number: str, sort_field: str, tags_conditions: str, tags):
+    def __init__(self, page_number: str, sort_field: str, tags_conditions: str, tags, range_query=None,
+                 user_id: int = None):
+        """:param range_query: параметры запроса с условиями на диапазоны лайков и дат (см. RangeFilter)
+        :param user_id: id пользователя для условия "лайкнуто мной" (LikedTag); None - без такого условия
+        """
         self.page_number = int(page_number)
+        if self.page_number < 1:
+            raise ValueError("Page number must be positive: {0}".format(page_number))
         self.sort_field = SortType(int(sort_field))
         self.__tags_dict = {tag.id: tag for tag in tags}
-        self.tags_conditions = [TagCondition(tag=self.__tags_dict[abs(int(x))]
-                                             , inclusive=int(x) > 0)
+        if user_id is not None:
+            self.__tags_dict[LIKED_TAG_ID] = LikedTag(user_id)
+        self.tags_conditions = [self.__parse_condition(x)
                                 for x in tags_conditions.split(";")
                                 if x != ""]
+        self.range_filters = RangeFilter.parse_query(range_query)  # type: list[RangeFilter]
+        self.__range_query = {name: range_query[name] for name in RANGE_PARAMETERS
+                              if range_query is not None and range_query.get(name, '') != ''}
+
+    def get_range_query_string(self) -> str:
+        """Параметры условий на диапазоны для ссылок ("?..." или пустая строка)"""
+        if len(self.__range_query) == 0:
+            return ""
+        return "?" + urlencode(sorted(self.__range_query.items()))
+
+    def __parse_condition(self, condition: str):
+        """Условие на тег ("5" или "-5") или группа "хотя бы один из тегов" ("3|5")"""
+        if "|" not in condition:
+            return TagCondition(tag=self.__tags_dict[abs(int(condition))], inclusive=int(condition) > 0)
+        tag_ids = [int(x) for x in condition.split("|")]
+        if any(tag_id <= 0 for tag_id in tag_ids):
+            raise ValueError("Only including tags can be joined by |: {0}".format(condition))
+        if len(tag_ids) > 1 and LIKED_TAG_ID in tag_ids:
+            raise ValueError("Liked photos can't be joined by |: {0}".format(condition))
+        group = TagOrGroup(tags=[self.__tags_dict[tag_id] for tag_id in tag_ids])
+        return group if len(group.tags) > 1 else TagCondition(tag=group.tags[0], inclusive=True)
+
+    def get_liked_condition(self):
+        """Условие "лайкнуто мной" или None"""
+        return next((x for x in self.tags_conditions if isinstance(x, TagCondition) and isinstance(x.tag, LikedTag)),
+                    None)
+
+    def get_tag_conditions_references(self, facet_counts=None):
+        """Генерация ссылок с параметрами для изменения условия на теги
 
-    def get_tag_conditions_references(self):
-        """Генерация ссылок с параметрами для изменения условия на теги"""
+        :param facet_counts: FacetCounts числа результатов для ссылок на добавление тегов
+        """
         refs = self.get_refs_to_exclude_existing_tag_conditions()
-        refs.extend(self.get_refs_to_add_all_tags_conditions())
+        refs.extend(self.get_refs_to_add_all_tags_conditions(facet_counts))
+        return refs
+
+    def get_refs_to_add_or_conditions(self):
+        """Ссылки на расширение последнего включающего условия еще одним тегом через "или" """
+        inclusive_conditions = [x for x in self.tags_conditions if x.inclusive]
+        if len(inclusive_conditions) == 0:
+            return []
+        last_condition = inclusive_conditions[-1]
+        last_tags = last_condition.tags if isinstance(last_condition, TagOrGroup) else [last_condition.tag]
+        if any(isinstance(tag, LikedTag) for tag in last_tags):
+            return []
+        refs = []  # type: list[TagConditionsLink]
+        for tag in self.__tags_dict.values():
+            if not isinstance(tag, LikedTag) and not any(x.have_tag(tag) for x in self.tags_conditions):
+                group = TagOrGroup(tags=last_tags + [tag])
+                conditions = [group if x is last_condition else x for x in self.tags_conditions]
+                refs.append(TagConditionsLink(group.name(), self.__get_reference_by_conditions(conditions)))
         return refs
 
-    def get_refs_to_add_all_tags_conditions(self):
+    def get_refs_to_add_all_tags_conditions(self, facet_counts=None):
         refs = []  # type: list[TagConditionsLink]
-        presented_tags = {x.tag.id for x in self.tags_conditions}
+        presented_tags = {tag.id for x in self.tags_conditions
+                          for tag in (x.tags if isinstance(x, TagOrGroup) else [x.tag])}
         for tag in self.__tags_dict.values():
             if tag.id not in presented_tags:
                 for inclusive in [True, False]:
-                    refs.append(self.get_ref_with_new_tag_condition(TagCondition(tag, inclusive)))
+                    ref = self.get_ref_with_new_tag_condition(TagCondition(tag, inclusive))
+                    if facet_counts is not None:
+                        ref.count = facet_counts.get_count(tag.id, inclusive)
+                    refs.append(ref)
         return refs
 
     def get_refs_to_exclude_existing_tag_conditions(self):
         refs = []  # type: list[TagConditionsLink]
         for tag_condition in self.tags_conditions:
-            conditions = self.__exclude_tag(self.tags_conditions, tag_condition.tag)
+            if isinstance(tag_condition, TagOrGroup):
+                conditions = [x for x in self.tags_conditions if x is not tag_condition]
+            else:
+                conditions = self.__exclude_tag(self.tags_conditions, tag_condition.tag)
             refs.append(TagConditionsLink("remove {0}".format(tag_condition.name())
                                           , self.__get_reference_by_conditions(conditions)))
         return refs
@@ -0,0 +1,94 @@
+from datetime import date, timedelta
+from photo_likers.photo_caches import SortedPhotoDateCache
+from photo_likers.utils.sorted_list_utils import find_place_in_reversed_list
+
+MIN_LIKES_PARAMETER = 'min_likes'
+MAX_LIKES_PARAMETER = 'max_likes'
+DAYS_PARAMETER = 'days'
+RANGE_PARAMETERS = [MIN_LIKES_PARAMETER, MAX_LIKES_PARAMETER, DAYS_PARAMETER]
+LIKES_FIELD = 0
+DATES_FIELD = 1
+# больше любого id фото (и помещается в сжатый список)
+MAX_PHOTO_ID = 2 ** 32 - 1
+
+
+class RangeFilter:
+    """Условие на диапазон ключа хэша фото: числа лайков (field=0)
+        или числа дней даты создания (field=1), границы включительно.
+
+       В списке, упорядоченном по тому же полю, диапазону соответствует непрерывный
+       отрезок, который находится двумя поисками места (get_bounds).
+       Для сортировки по другому полю условие работает как включающий тег
+       (см. SortedPhotoCacheBase.load_range_list)
+    """
+    inclusive = True
+
+    def __init__(self, field: int, min_value: int = None, max_value: int = None):
+        self.field = field
+        self.min_value = min_value
+        self.max_value = max_value
+
+    @classmethod
+    def parse_query(cls, query):
+        """Условия из параметров запроса min_likes, max_likes и days (за последние days дней)
+
+        :param query: dict-like (например, request.GET) или None
+        :return: list[RangeFilter]
+        """
+        if query is None:
+            return []
+        res = []
+        min_likes = cls.__parse_value(query.get(MIN_LIKES_PARAMETER))
+        max_likes = cls.__parse_value(query.get(MAX_LIKES_PARAMETER))
+        if min_likes is not None or max_likes is not None:
+            res.append(RangeFilter(LIKES_FIELD, min_value=min_likes, max_value=max_likes))
+        days = cls.__parse_value(query.get(DAYS_PARAMETER))
+        if days is not None:
+            if days > cls.get_days_key(date.today()):
+                # иначе дата начала раньше date.min и timedelta приводит к OverflowError
+                raise ValueError("Range of days is too large: {0}".format(days))
+            res.append(RangeFilter(DATES_FIELD, min_value=cls.get_days_key(date.today() - timedelta(days=days))))
+        return res
+
+    @classmethod
+    def from_key(cls, key: str):
+        field, min_value, max_value = key.split(':')
+        return RangeFilter(int(field), min_value=int(min_value) if min_value != '' else None,
+                           max_value=int(max_value) if max_value != '' else None)
+
+    @staticmethod
+    def get_days_key(day: date) -> int:
+        """Ключ хэша для даты, как в SortedPhotoDateCache"""
+        return (day - SortedPhotoDateCache.SMALL_DATE).days
+
+    def key(self) -> str:
+        return "{0}:{1}:{2}".format(self.field, '' if self.min_value is None else self.min_value,
+                                    '' if self.max_value is None else self.max_value)
+
+    def name(self) -> str:
+        return "{0} in [{1}, {2}]".format("likes" if self.field == LIKES_FIELD else "days",
+                                          self.min_value, self.max_value)
+
+    def contains(self, value: int) -> bool:
+        """Попадает ли значение поля в диапазон"""
+        return (self.min_value is None or value >= self.min_value) and \
+               (self.max_value is None or value <= self.max_value)
+
+    def get_bounds(self, sorted_list):
+        """Отрезок [start, end) значений из диапазона в упорядоченном по этому полю списке"""
+        start = 0
+        if self.max_value is not None:
+            start = find_place_in_reversed_list((self.max_value, MAX_PHOTO_ID), sorted_list, 0)
+        end = len(sorted_list) - 1
+        if self.min_value is not None:
+            end = find_place_in_reversed_list((self.min_value - 1, MAX_PHOTO_ID), sorted_list, start)
+        return start, max(start, end)
+
+    @staticmethod
+    def __parse_value(value):
+        if value is None or value == '':
+            return None
+        res = int(value)
+        if res < 0:
+            raise ValueError("Range value must be non-negative: {0}".format(value))
+        return res
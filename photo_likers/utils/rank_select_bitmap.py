@@ -0,0 +1,99 @@
+from array import array
+from bisect import bisect_right
+
+WORD_BITS = 64
+# для скольких слов хранить накопленное число единиц
+WORDS_PER_BLOCK = 8
+
+
+# число единиц в каждом значении байта (для подсчета без int.bit_count)
+BYTE_POPCOUNTS = bytes(bin(i).count('1') for i in range(256))
+
+
+def popcount(word: int) -> int:
+    """Число единичных битов неотрицательного числа любой длины"""
+    if hasattr(word, 'bit_count'):
+        return word.bit_count()
+    return sum(word.to_bytes((word.bit_length() + 7) // 8, 'little').translate(BYTE_POPCOUNTS))
+
+
+class RankSelectBitmap:
+    """Битовый массив с операциями rank/select за O(log n).
+
+       Хранит слова по 64 бита и накопленное число единиц перед каждым блоком
+       из WORDS_PER_BLOCK слов: rank - сумма по блокам и слову,
+       select - бинарный поиск блока и поиск бита внутри блока.
+    """
+
+    def __init__(self, size: int, words, block_ranks):
+        self.size = size
+        self.__words = words  # type: array
+        self.__block_ranks = block_ranks  # type: array
+        self.__cnt_ones = block_ranks[-1]
+
+    @classmethod
+    def from_positions(cls, positions, size: int):
+        """Построение по позициям единичных битов
+
+        :param positions: iterable[int] позиции (от 0 до size-1)
+        :param size: длина битового массива
+        """
+        cnt_words = (size + WORD_BITS - 1) // WORD_BITS
+        words = array('Q', [0]) * cnt_words
+        for position in positions:
+            words[position // WORD_BITS] |= 1 << (position % WORD_BITS)
+
+        block_ranks = array('L', [0])
+        cnt_ones = 0
+        for word_index in range(cnt_words):
+            cnt_ones += popcount(words[word_index])
+            if (word_index + 1) % WORDS_PER_BLOCK == 0 or word_index == cnt_words - 1:
+                block_ranks.append(cnt_ones)
+        return cls(size=size, words=words, block_ranks=block_ranks)
+
+    def __len__(self):
+        """Число единичных битов"""
+        return self.__cnt_ones
+
+    def __iter__(self):
+        """Позиции единичных битов по возрастанию"""
+        for word_index, word in enumerate(self.__words):
+            while word:
+                low_bit = word & -word
+                yield word_index * WORD_BITS + low_bit.bit_length() - 1
+                word ^= low_bit
+
+    def __contains__(self, position: int) -> bool:
+        return 0 <= position < self.size and \
+               (self.__words[position // WORD_BITS] >> (position % WORD_BITS)) & 1 == 1
+
+    def rank(self, position: int) -> int:
+        """Число единичных битов на позициях [0, position)"""
+        position = min(max(position, 0), self.size)
+        word_index, bit_index = divmod(position, WORD_BITS)
+        block_index = word_index // WORDS_PER_BLOCK
+        res = self.__block_ranks[block_index]
+        for i in range(block_index * WORDS_PER_BLOCK, word_index):
+            res += popcount(self.__words[i])
+        if bit_index > 0:
+            res += popcount(self.__words[word_index] & ((1 << bit_index) - 1))
+        return res
+
+    def select(self, k: int) -> int:
+        """Позиция k-го (с нуля) единичного бита"""
+        if not 0 <= k < self.__cnt_ones:
+            raise IndexError("Bitmap select out of range")
+        block_index = bisect_right(self.__block_ranks, k) - 1
+        k -= self.__block_ranks[block_index]
+        word_index = block_index * WORDS_PER_BLOCK
+        while True:
+            word = self.__words[word_index]
+            cnt_ones = popcount(word)
+            if k < cnt_ones:
+                break
+            k -= cnt_ones
+            word_index += 1
+        # снимаем k младших единиц, после чего нужный бит - младший
+        for _ in range(k):
+            word &= word - 1
+        return word_index * WORD_BITS + (word & -word).bit_length() - 1
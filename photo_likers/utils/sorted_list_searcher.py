@@ -1,49 +1,122 @@
+from array import array
 from photo_likers.settings import PHOTOS_PER_PAGE
-from photo_likers.utils.sorted_list_utils import sorted_list_merge
+from photo_likers.utils.rank_select_bitmap import RankSelectBitmap
+from photo_likers.utils.sorted_list_utils import sorted_list_merge, SearchDeadlineExceeded, MergeStats
 
 
 class SearchRequestInfo:
-    def __init__(self, num_pages: int, checkpoints):
+    def __init__(self, num_pages: int, checkpoints, is_approximate: bool = False, matches: RankSelectBitmap = None):
         self.checkpoints = checkpoints  # type: list[list[int]]
         self.num_pages = num_pages
+        # поиск был остановлен раньше конца списков, и число страниц - оценка
+        self.is_approximate = is_approximate
+        # битовый массив позиций найденных значений в первом списке:
+        # начало любой страницы находится через select без просмотра списков
+        self.matches = matches
+        # число результатов для ссылок на добавление тегов (FacetCounts), считается по необходимости
+        self.facet_counts = None
 
 
 class SortedListSearcher:
     def __init__(self, sorted_lists, inclusion_indicators,
-                 page_step: int = 50):
+                 page_step: int = 50, bounds=None):
+        """:param bounds: tuple[int, int] отрезок [start, end) первого списка, в котором идет поиск
+            (условие на диапазон по полю сортировки), по умолчанию - весь список"""
         self.__page_step = page_step
+        self.__bounds = bounds if bounds is not None else (0, len(sorted_lists[0]) - 1)
         self.__inclusion_indicators = inclusion_indicators  # type: list[bool]
         self.__sorted_lists = sorted_lists  # type: list[list[tuple(int,int)]]
+        self.merge_stats = MergeStats()  # статистика мержа по всем поискам этим объектом
+
+    def search_page(self, page_number: int, compute_search_info: bool = False, search_info: SearchRequestInfo = None,
+                    deadline: float = None):
+        """Поиск значений на странице.
+
+           Если compute_search_info, то списки просматриваются до конца для подсчета
+           числа страниц и отметок. Если search_info не задан и не требуется его расчет,
+           поиск останавливается на заполненной странице, а число страниц оценивается.
+           При истечении дедлайна возвращается найденная часть страницы
+           и приблизительный search_info.
+
+           Если список один, страница - просто срез списка. Если в search_info есть
+           битовый массив найденных значений, страница берется через select
+           за O(log n) на значение, независимо от номера страницы.
+           Номер страницы начинается с 1 (ValueError для меньших).
+        """
+        if page_number < 1:
+            raise ValueError("Page number must be positive: {0}".format(page_number))
+        if len(self.__sorted_lists) == 1:
+            return self.__search_page_in_single_list(page_number)
+        if search_info is not None and search_info.matches is not None and not compute_search_info:
+            return self.__select_page(search_info.matches, page_number), search_info
 
-    def search_page(self, page_number: int, compute_search_info: bool = False, search_info: SearchRequestInfo = None):
         res_values = []  # результирующие значения в пересечении
         checkpoints = []
-        if search_info is None or compute_search_info:
+        match_positions = array('L')  # позиции найденных значений в первом списке
+        search_from_start = search_info is None or compute_search_info
+        if search_from_start:
             cnt_found = 0  # число найденных значений, подходящих под фильтр
             start_pointers = [0] * len(self.__inclusion_indicators)
+            start_pointers[0] = self.__bounds[0]
             checkpoints.append(start_pointers.copy())
         else:
             cnt_found, start_pointers = self.__start_from_info(search_info, page_number)
 
-        for value, pointers in sorted_list_merge(sorted_lists=self.__sorted_lists,
-                                                 inclusion_indicators=self.__inclusion_indicators,
-                                                 start_indices=start_pointers.copy()):
-            if self.__belong_to_page(photo_index=cnt_found, page_number=page_number):
-                res_values.append(value)
-            cnt_found += 1
-
-            if compute_search_info:
-                if self.__is_checkpoint(cnt_found):
-                    checkpoints.append(pointers.copy())
-            elif len(res_values) == PHOTOS_PER_PAGE:
-                break
-        else:
-            if compute_search_info:
+        stop_pointers = None  # указатели, на которых поиск был остановлен раньше конца списков
+        merge = sorted_list_merge(sorted_lists=self.__sorted_lists,
+                                  inclusion_indicators=self.__inclusion_indicators,
+                                  start_indices=start_pointers.copy(),
+                                  deadline=deadline, stats=self.merge_stats, end_index=self.__bounds[1])
+        try:
+            for value, pointers in merge:
+                if self.__belong_to_page(photo_index=cnt_found, page_number=page_number):
+                    res_values.append(value)
+                cnt_found += 1
+
+                if search_from_start:
+                    match_positions.append(pointers[0])
+                    if self.__is_checkpoint(cnt_found):
+                        checkpoints.append(self.__get_checkpoint(pointers))
+                if not compute_search_info and len(res_values) == PHOTOS_PER_PAGE:
+                    stop_pointers = pointers
+                    break
+        except SearchDeadlineExceeded as e:
+            stop_pointers = e.pointers
+        finally:
+            merge.close()
+
+        if search_from_start:
+            if stop_pointers is None:
+                matches = RankSelectBitmap.from_positions(match_positions, size=len(self.__sorted_lists[0]))
                 search_info = SearchRequestInfo(num_pages=self.__get_pages_count(cnt_found),
-                                                checkpoints=checkpoints)
+                                                checkpoints=checkpoints, matches=matches)
+            else:
+                search_info = SearchRequestInfo(num_pages=self.__estimate_pages_count(cnt_found, stop_pointers[0]),
+                                                checkpoints=checkpoints, is_approximate=True)
 
         return res_values, search_info
 
+    def __search_page_in_single_list(self, page_number: int):
+        sorted_list = self.__sorted_lists[0]
+        bounds_start, bounds_end = self.__bounds
+        start = bounds_start + (page_number - 1) * PHOTOS_PER_PAGE
+        res_values = sorted_list[start:min(start + PHOTOS_PER_PAGE, bounds_end)]
+        return res_values, SearchRequestInfo(num_pages=self.__get_pages_count(bounds_end - bounds_start),
+                                             checkpoints=[[bounds_start]])
+
+    def __select_page(self, matches: RankSelectBitmap, page_number: int):
+        sorted_list = self.__sorted_lists[0]
+        start = (page_number - 1) * PHOTOS_PER_PAGE
+        return [sorted_list[matches.select(k)] for k in range(start, min(start + PHOTOS_PER_PAGE, len(matches)))]
+
+    @staticmethod
+    def __get_checkpoint(pointers):
+        """Отметка - указатели сразу после найденного значения,
+            чтобы при продолжении поиска оно не было найдено повторно"""
+        checkpoint = pointers.copy()
+        checkpoint[0] += 1
+        return checkpoint
+
     @staticmethod
     def __belong_to_page(photo_index, page_number):
         return (page_number - 1) * PHOTOS_PER_PAGE <= photo_index < page_number * PHOTOS_PER_PAGE
@@ -60,6 +133,14 @@ class SortedListSearcher:
         start_pointers = search_info.checkpoints[checkpoint_index]
         return cnt_found, start_pointers
 
+    def __estimate_pages_count(self, cnt_found, main_list_position):
+        """Оценка числа страниц по доле найденных значений
+            в просмотренной части первого списка"""
+        main_list_len = self.__bounds[1] - self.__bounds[0]
+        scanned = max(main_list_position - self.__bounds[0], 1)
+        estimated_cnt = max(cnt_found, cnt_found * main_list_len // scanned)
+        return self.__get_pages_count(estimated_cnt)
+
     @staticmethod
     def __get_pages_count(cnt_found):
         num_pages, rest = divmod(cnt_found, PHOTOS_PER_PAGE)
@@ -1,4 +1,36 @@
+import heapq
+import itertools
+import time
+
+# как часто (в итерациях мержа) проверять, не истек ли дедлайн поиска
+DEADLINE_CHECK_STEP = 1024
+# до скольких изменений список правится вставками/удалениями на месте, а не пересобирается
+SMALL_CHANGES_COUNT = 64
+
+
+class SearchDeadlineExceeded(Exception):
+    """Мерж списков не уложился в заданный дедлайн.
+       Хранит указатели в списках на момент остановки
+    """
+
+    def __init__(self, pointers):
+        super().__init__("Search deadline exceeded")
+        self.pointers = pointers  # type: list[int]
+
+
+class MergeStats:
+    """Статистика работы мержа (для метрик)"""
+
+    def __init__(self):
+        self.iterations = 0  # сколько значений первого списка проверено
+        self.gallop_searches = 0  # сколько раз искалось место значения в остальных списках
+        self.elements_scanned = 0  # на сколько позиций продвинулись указатели во всех списках
+
+
 def find_place_in_reversed_list(value: int, arr_values, start_index: int) -> int:
+    if type(arr_values) is not list:
+        # сжатый список (CompressedPostingList) ищет место пропуском блоков
+        return arr_values.find_place(value, start_index)
     j = start_index
     step = 1
     while j < len(arr_values) and arr_values[j] > value:
@@ -13,7 +45,56 @@ def find_place_in_reversed_list(value: int, arr_values, start_index: int) -> int
     return j
 
 
-def sorted_list_merge(sorted_lists, inclusion_indicators, start_indices=None):
+def reversed_list_replace(arr_values, removed_values, added_values):
+    """Удаление и добавление значений в упорядоченном по убыванию списке
+        (с фиктивным последним значением). Небольшое число изменений вносится
+        на месте, иначе список пересобирается за один проход мержем.
+
+        :param arr_values: list[object]
+        :param removed_values: iterable[object]
+        :param added_values: iterable[object]
+        :return: list[object] измененный список
+    """
+    if type(arr_values) is not list:
+        # сжатый список распаковывается, изменяется и сжимается заново
+        return type(arr_values).from_sorted(reversed_list_replace(arr_values.to_list(), removed_values, added_values))
+    removed_values = set(removed_values)
+    added_values = sorted(added_values, reverse=True)
+    if len(removed_values) + len(added_values) <= SMALL_CHANGES_COUNT:
+        for value in removed_values:
+            j = find_place_in_reversed_list(value, arr_values, 0)
+            if arr_values[j] == value:
+                del arr_values[j]
+        for value in added_values:
+            arr_values.insert(find_place_in_reversed_list(value, arr_values, 0), value)
+        return arr_values
+
+    kept_values = (value for value in arr_values[:-1] if value not in removed_values)
+    res = list(heapq.merge(kept_values, added_values, reverse=True))
+    res.append(arr_values[-1])
+    return res
+
+
+def sorted_list_union(sorted_lists):
+    """Объединение упорядоченных по убыванию списков (с фиктивным последним значением)
+        k-путевым мержем через кучу, без повторов. Результат - такой же список
+        с фиктивным значением в конце, поэтому его можно использовать в sorted_list_merge
+        как обычный список тега (и сохранять для него отметки поиска)
+
+        :param sorted_lists: list[list[object]]
+        :return: list[object]
+    """
+    res = []
+    for value in heapq.merge(*(itertools.islice(sorted_list, len(sorted_list) - 1) for sorted_list in sorted_lists),
+                             reverse=True):
+        if len(res) == 0 or res[-1] != value:
+            res.append(value)
+    res.append(sorted_lists[0][-1])
+    return res
+
+
+def sorted_list_merge(sorted_lists, inclusion_indicators, start_indices=None, deadline: float = None,
+                      stats: MergeStats = None, end_index: int = None):
     """Генератор, эффективно мержит упорядоченные по убыванию списки
         значений с учетом включения/исключения.
        Во всех списках последний элемент "фейковый" (заведомо меньше любого нефейкового значения)
@@ -23,33 +104,57 @@ def sorted_list_merge(sorted_lists, inclusion_indicators, start_indices=None):
        должен вернуть значения 12, 4 с соответствующими им индексами
        [0,0,*], [4, 2, _].
        Можно задать начальные индексы в спсиках.
+       Если задан дедлайн (по time.monotonic), то при его истечении
+       бросается SearchDeadlineExceeded с текущими указателями.
+       Если задан stats, то в него добавляется статистика мержа
+       (в том числе при досрочном закрытии генератора).
+       Если задан end_index, то просматриваются только значения первого списка до него.
 
         :param sorted_lists: list[list[object]]
         :param inclusion_indicators: list[bool]
         :param start_indices: list[list[int]]
+        :param deadline: float
+        :param stats: MergeStats
+        :param end_index: int
     """
     cnt_lists = len(inclusion_indicators)
     if start_indices is not None:
         pointers = start_indices
     else:
         pointers = [0] * cnt_lists
+    initial_pointers = pointers.copy()
+    if end_index is None:
+        end_index = len(sorted_lists[0]) - 1
 
-    while pointers[0] < len(sorted_lists[0]) - 1:
-        main_value = sorted_lists[0][pointers[0]]
-        smallest_inclusive_value = main_value
-        for pointer_index in range(1, cnt_lists):
-            i = find_place_in_reversed_list(main_value, sorted_lists[pointer_index],
-                                            pointers[pointer_index])
-            pointers[pointer_index] = i
-            # если в соответствующем списке нет заданного значения и условие
-            # включающее или наоборот, то это значение не подходит
-            if inclusion_indicators[pointer_index] != (sorted_lists[pointer_index][i] == main_value):
-                if inclusion_indicators[pointer_index]:
-                    smallest_inclusive_value = sorted_lists[pointer_index][i]
-                break
-        else:
-            yield main_value, pointers.copy()
+    iteration = 0
+    gallop_searches = 0
+    try:
+        while pointers[0] < end_index:
+            iteration += 1
+            if deadline is not None and iteration % DEADLINE_CHECK_STEP == 0 and time.monotonic() > deadline:
+                raise SearchDeadlineExceeded(pointers.copy())
+            main_value = sorted_lists[0][pointers[0]]
+            smallest_inclusive_value = main_value
+            for pointer_index in range(1, cnt_lists):
+                gallop_searches += 1
+                i = find_place_in_reversed_list(main_value, sorted_lists[pointer_index],
+                                                pointers[pointer_index])
+                pointers[pointer_index] = i
+                # если в соответствующем списке нет заданного значения и условие
+                # включающее или наоборот, то это значение не подходит
+                if inclusion_indicators[pointer_index] != (sorted_lists[pointer_index][i] == main_value):
+                    if inclusion_indicators[pointer_index]:
+                        smallest_inclusive_value = sorted_lists[pointer_index][i]
+                    break
+            else:
+                yield main_value, pointers.copy()
 
-        # не забываем двигать указатель в первом списке
-        pointers[0] = find_place_in_reversed_list(smallest_inclusive_value, sorted_lists[0],
-                                                  pointers[0] + 1)
+            # не забываем двигать указатель в первом списке
+            pointers[0] = find_place_in_reversed_list(smallest_inclusive_value, sorted_lists[0],
+                                                      pointers[0] + 1)
+    finally:
+        if stats is not None:
+            stats.iterations += iteration
+            stats.gallop_searches += gallop_searches
+            stats.elements_scanned += sum(pointer - initial_pointer
+                                          for pointer, initial_pointer in zip(pointers, initial_pointers))
@@ -4,9 +4,10 @@ from photo_likers.models import Tag
 class TagConditionsLink:
     """Сущность для отображения ссылок в шаблоне"""
 
-    def __init__(self, ref_name: str, ref: str):
+    def __init__(self, ref_name: str, ref: str, count: int = None):
         self.ref_name = ref_name
         self.ref = ref
+        self.count = count  # число фото по ссылке, если известно
 
 
 class TagCondition:
@@ -28,3 +29,48 @@ class TagCondition:
 
     def key(self) -> str:
         return str(self.tag.id * (-1 if not self.inclusive else 1))
+
+
+class TagOrGroup:
+    """Условие "хотя бы один из тегов" (в запросе - включающие теги через |).
+       Используется вместе с TagCondition как включающее условие:
+       для поиска по нему строится объединение списков тегов
+    """
+    inclusive = True
+
+    def __init__(self, tags):
+        self.tags = sorted({tag.id: tag for tag in tags}.values(), key=lambda tag: tag.id)  # type: list[Tag]
+
+    def __str__(self):
+        return "|".join(str(tag.id) for tag in self.tags)
+
+    def have_tag(self, tag: Tag) -> bool:
+        return tag is not None and any(x.id == tag.id for x in self.tags)
+
+    def name(self) -> str:
+        return "include " + " or ".join("#{0}".format(tag.name) for tag in self.tags)
+
+    def key(self) -> str:
+        return str(self)
+
+
+class TagPairCondition:
+    """Пара включающих тегов, для которой в индексе есть готовое пересечение списков.
+       Появляется только в плане поиска (PageSearcher.order_tag_conditions) вместо двух условий
+    """
+    inclusive = True
+
+    def __init__(self, tags):
+        self.tags = sorted(tags, key=lambda tag: tag.id)  # type: list[Tag]
+
+    def __str__(self):
+        return ";".join(str(tag.id) for tag in self.tags)
+
+    def have_tag(self, tag: Tag) -> bool:
+        return tag is not None and any(x.id == tag.id for x in self.tags)
+
+    def name(self) -> str:
+        return "include " + " and ".join("#{0}".format(tag.name) for tag in self.tags)
+
+    def key(self) -> str:
+        return "&".join(str(tag.id) for tag in self.tags)
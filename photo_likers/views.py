@@ -1,11 +1,25 @@
+from django.contrib.admin.views.decorators import staff_member_required
 from django.contrib.auth.decorators import login_required
-from django.http import HttpResponse, HttpRequest
-from django.shortcuts import render
+from django.http import HttpResponse, HttpRequest, Http404, HttpResponseBadRequest, JsonResponse, \
+    StreamingHttpResponse
+from django.middleware.csrf import get_token
+from django.shortcuts import render, redirect, get_object_or_404
+from django.urls import reverse
+from django.utils.http import is_safe_url
+from django.views.decorators.http import require_POST
 
-from photo_likers.models import Tag
+from photo_likers.metrics import RequestTimings, metrics
+from photo_likers.models import Tag, Photo
+from photo_likers.settings import SERVER_TIMING_HEADER_ENABLED, FACET_COUNTS_ENABLED, PHOTOS_STREAMING_ENABLED
 from photo_likers.utils.photo_request import PhotosRequest
 from .page_searcher import PageSearcher
 from .cache_manager import CacheManager
+from .likes_ingestion import likes_batcher
+from .loading_startup_cache import index_startup
+from .page_streaming import stream_photos_page, STREAM_PARAMETER
+from .request_profiler import request_profiler
+from .search_warmer import search_warmer
+from .tag_pair_index import tag_pair_index
 
 
 def index(request: HttpRequest):
@@ -15,20 +29,111 @@ def index(request: HttpRequest):
 @login_required
 def photos_view(request: HttpRequest, page_number: str = "1", sort_field: str = "0",
                 tags_list: str = "") -> HttpResponse:
-    """Основная view
+    """Основная view. Параметры запроса min_likes, max_likes и days (за последние days дней)
+        задают условия на диапазоны лайков и дат. При PHOTOS_STREAMING_ENABLED или ?stream=1
+        страница отдается потоком (см. stream_photos_page)
 
     :param request: HttpRequest
     :param page_number: номер страницы
     :param sort_field: 0-сортировка по лайкам, 1-по дате
-    :param tags_list: список тегов через ";" со знаком - или без
+    :param tags_list: список тегов через ";" со знаком - или без, включающие теги через "|" - "хотя бы один из"
     :return: HttpResponse
     """
-    photo_request = PhotosRequest(page_number=page_number, sort_field=sort_field, tags_conditions=tags_list, tags = Tag.objects.all())
-    tag_refs = photo_request.get_tag_conditions_references()
+    timings = RequestTimings()
+    with timings.stage('tags'):
+        tags = list(Tag.objects.all())
+        try:
+            photo_request = PhotosRequest(page_number=page_number, sort_field=sort_field, tags_conditions=tags_list,
+                                          tags=tags, range_query=request.GET, user_id=request.user.id)
+        except ValueError as e:
+            return HttpResponseBadRequest(str(e))
+        or_refs = photo_request.get_refs_to_add_or_conditions()
+    search_warmer.record(photo_request)
+    tag_pair_index.record(photo_request)
 
     sorted_cache = CacheManager.get_sorted_photo_cache(photo_request)
-    page = PageSearcher(sorted_cache).get_pagination_by_request(photo_request)
+    page_searcher = PageSearcher(sorted_cache, timings=timings, shard_coordinator=index_startup.shard_coordinator)
+    context = {'page_number': page_number, 'sort_field': sort_field, 'tags_list': tags_list, 'or_refs': or_refs,
+               'range_query': photo_request.get_range_query_string()}
+    profile_id = None
+    if request_profiler.is_requested(request) and request_profiler.try_start():
+        page, profile_id = request_profiler.profile(request.path, page_searcher.get_pagination_by_request,
+                                                    photo_request)
+    elif PHOTOS_STREAMING_ENABLED or request.GET.get(STREAM_PARAMETER) == '1':
+        # токен csrf для форм лайков, чтобы cookie попала в заголовки, отправляемые до тела
+        get_token(request)
+        context['tag_refs'] = photo_request.get_tag_conditions_references()
+        response = StreamingHttpResponse(stream_photos_page(request, page_searcher, photo_request, context),
+                                         content_type='text/html; charset=utf-8')
+        if SERVER_TIMING_HEADER_ENABLED:
+            response['Server-Timing'] = timings.get_server_timing_header()
+        index_startup.mark_request()
+        return response
+    else:
+        page = page_searcher.get_pagination_by_request(photo_request)
 
-    return render(request, 'photos.html',
-                  {'photos': page, 'page_number': page_number, 'sort_field': sort_field, 'tags_list': tags_list,
-                   'tag_refs': tag_refs})
+    facet_counts = None
+    if FACET_COUNTS_ENABLED:
+        with timings.stage('facets'):
+            facet_counts = page_searcher.get_facet_counts(photo_request, tags)
+    tag_refs = photo_request.get_tag_conditions_references(facet_counts)
+
+    with timings.stage('render'):
+        response = render(request, 'photos.html', dict(context, photos=page, tag_refs=tag_refs))
+    if SERVER_TIMING_HEADER_ENABLED:
+        response['Server-Timing'] = timings.get_server_timing_header()
+    if profile_id is not None:
+        response['X-Profile-Url'] = reverse('photo_likers:profile', kwargs={'profile_id': profile_id})
+    index_startup.mark_request()
+    return response
+
+
+def ready_view(request: HttpRequest) -> HttpResponse:
+    """Готовность индекса (для проверок балансировщика): 200, когда кэши загружены, иначе 503"""
+    return JsonResponse(index_startup.get_state(), status=200 if index_startup.is_ready() else 503)
+
+
+def metrics_view(request: HttpRequest) -> HttpResponse:
+    """Метрики процесса в текстовом формате Prometheus"""
+    return HttpResponse(metrics.render(), content_type='text/plain; version=0.0.4; charset=utf-8')
+
+
+@staff_member_required
+def profiles_view(request: HttpRequest) -> HttpResponse:
+    """Список сохраненных профилей запросов"""
+    lines = ['{0} {1} {2}'.format(profile_id, created, name)
+             for profile_id, name, created in request_profiler.get_profiles()]
+    return HttpResponse('\n'.join(lines) + '\n', content_type='text/plain; charset=utf-8')
+
+
+@staff_member_required
+def profile_view(request: HttpRequest, profile_id: str) -> HttpResponse:
+    """Профиль запроса: текстом (по умолчанию) или файлом pstats (?format=pstats)"""
+    if request.GET.get('format') == 'pstats':
+        stats_dump = request_profiler.get_stats_dump(profile_id)
+        if stats_dump is None:
+            raise Http404("Profile not found")
+        response = HttpResponse(stats_dump, content_type='application/octet-stream')
+        response['Content-Disposition'] = 'attachment; filename="{0}.pstats"'.format(profile_id)
+        return response
+    stats_text = request_profiler.get_stats_text(profile_id, sort_key=request.GET.get('sort', 'cumulative'))
+    if stats_text is None:
+        raise Http404("Profile not found")
+    return HttpResponse(stats_text, content_type='text/plain; charset=utf-8')
+
+
+@login_required
+@require_POST
+def like_photo_view(request: HttpRequest, photo_id: str) -> HttpResponse:
+    """Лайк фото: сохраняется пачкой вместе с другими лайками
+
+    :param request: HttpRequest
+    :param photo_id: id фото
+    :return: HttpResponse
+    """
+    photo = get_object_or_404(Photo, id=int(photo_id))
+    likes_batcher.add_like(user=request.user, photo_id=photo.id)
+    referer = request.META.get('HTTP_REFERER')
+    if not is_safe_url(referer, host=request.get_host()):
+        referer = reverse('photo_likers:index')
+    return redirect(referer)